@@ -0,0 +1,253 @@
+"""Token-cost admission control: per-tenant token buckets and fair queuing.
+
+Request-count rate limits treat a 10-token ping and a 512-token generation
+over a long prompt the same. Here every request is priced in tokens, as its
+prompt plus ``max_new_tokens``:
+
+* ``TokenLedger`` keeps a token bucket per API token (tenant). A request is
+  charged its estimated cost up front and rejected with a retry delay when
+  the bucket cannot cover it. Once the request finishes, the charge is
+  settled to the tokens actually used, so stopping early refunds the unused
+  completion budget.
+* ``FairQueue`` sits in front of a model's scheduler and admits a bounded
+  number of generations at a time. Waiting requests are served by priority
+  class (``interactive`` before ``batch``), then in start-time fair queuing
+  order: each tenant's requests are tagged with their cost divided by the
+  tenant's weight, so a tenant sending many large requests waits behind
+  tenants using less than their share, not the other way round.
+
+Tenants are configured in a JSON file mapping API tokens to
+``{"name", "tokens_per_minute", "burst", "weight"}``; tokens not listed
+share the default limits but each gets its own bucket and is queued as its
+own tenant.
+"""
+
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+PRIORITIES = ("interactive", "batch")
+CHARS_PER_TOKEN = 4  # prompt estimate before tokenization; settled afterwards
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class RateLimited(Exception):
+    def __init__(self, tenant: str, retry_after: float):
+        super().__init__(f"token rate limit exceeded for tenant {tenant!r}")
+        self.tenant = tenant
+        self.retry_after = retry_after
+
+
+@dataclass
+class Tenant:
+    name: str
+    tokens_per_minute: float = 0  # 0 = unlimited
+    burst: float = 0  # bucket size; 0 = one minute's worth
+    weight: float = 1.0  # share of the model under contention
+
+
+class TokenBucket:
+    """Refills at ``rate`` tokens/second up to ``capacity``.
+
+    A request costing more than the whole bucket is admitted once the bucket
+    is full, and leaves it in debt, so large requests are slowed, not refused.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self.level = capacity
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, cost: float) -> float:
+        """Take ``cost`` tokens and return 0, or return the seconds to wait for them."""
+        self._refill()
+        needed = min(cost, self.capacity)
+        if self.level >= needed:
+            self.level -= cost
+            return 0.0
+        return (needed - self.level) / self.rate
+
+    def give(self, amount: float):
+        """Return tokens (or take more, with a negative ``amount``)."""
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class Charge:
+    """An up-front charge against a tenant's bucket, settled once.
+
+    ``identity`` is who the request is queued as: the tenant's name, or for
+    API tokens without a tenant entry, a label of the token itself.
+    """
+
+    def __init__(
+        self, ledger: "TokenLedger", tenant: Tenant, bucket: Optional[TokenBucket], estimate: int, identity: str
+    ):
+        self.tenant = tenant
+        self.identity = identity
+        self.estimate = estimate
+        self.actual: Optional[int] = None
+        self._ledger = ledger
+        self._bucket = bucket
+
+    def settle(self, actual: int):
+        """Replace the estimate with the tokens actually used. Later calls are ignored."""
+        if self.actual is not None:
+            return
+        self.actual = actual
+        self._ledger._settle(self)
+
+
+class TokenLedger:
+    def __init__(self, tenants: Dict[str, Tenant], default: Tenant, max_default_buckets: int = 10000):
+        self.tenants = tenants
+        self.default = default
+        self.max_default_buckets = max_default_buckets
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._default_buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+        # tenant name -> settled tokens, and requests refused
+        self.tokens: Dict[str, int] = {}
+        self.rejected: Dict[str, int] = {}
+
+    def tenant(self, token: str) -> Tenant:
+        return self.tenants.get(token, self.default)
+
+    def _bucket(self, token: str, tenant: Tenant) -> Optional[TokenBucket]:
+        if tenant.tokens_per_minute <= 0:
+            return None
+        if token in self.tenants:
+            bucket = self._buckets.get(token)
+            if bucket is None:
+                bucket = self._buckets[token] = _new_bucket(tenant)
+            return bucket
+        bucket = self._default_buckets.get(token)
+        if bucket is None:
+            bucket = self._default_buckets[token] = _new_bucket(tenant)
+            while len(self._default_buckets) > self.max_default_buckets:
+                self._default_buckets.popitem(last=False)
+        else:
+            self._default_buckets.move_to_end(token)
+        return bucket
+
+    def charge(self, token: str, estimate: int) -> Charge:
+        """Charge ``estimate`` tokens to ``token``'s bucket; raises ``RateLimited``."""
+        tenant = self.tenant(token)
+        with self._lock:
+            bucket = self._bucket(token, tenant)
+            wait = bucket.take(estimate) if bucket is not None else 0.0
+            if wait > 0:
+                self.rejected[tenant.name] = self.rejected.get(tenant.name, 0) + 1
+                raise RateLimited(tenant.name, wait)
+        identity = tenant.name if token in self.tenants else tenant_label(token)
+        return Charge(self, tenant, bucket, estimate, identity)
+
+    def _settle(self, charge: Charge):
+        with self._lock:
+            if charge._bucket is not None:
+                charge._bucket.give(charge.estimate - charge.actual)
+            self.tokens[charge.tenant.name] = self.tokens.get(charge.tenant.name, 0) + charge.actual
+
+
+def _new_bucket(tenant: Tenant) -> TokenBucket:
+    rate = tenant.tokens_per_minute / 60
+    return TokenBucket(rate, tenant.burst or tenant.tokens_per_minute)
+
+
+def load_tenants(path: Optional[str]) -> Dict[str, Tenant]:
+    """Read ``{"<api token>": {"name": ..., "tokens_per_minute": ..., ...}}``."""
+    if not path:
+        return {}
+    with open(path) as fh:
+        raw = json.load(fh)
+    return {token: Tenant(**{"name": tenant_label(token), **spec}) for token, spec in raw.items()}
+
+
+def tenant_label(token: str) -> str:
+    """A stable name for an unnamed tenant that does not reveal its token."""
+    return "tenant-" + hashlib.sha256(token.encode("utf-8")).hexdigest()[:8]
+
+
+class QueueFull(RuntimeError):
+    """Raised by ``FairQueue.acquire`` when ``max_waiting`` requests already wait."""
+
+
+class FairQueue:
+    """Admit up to ``concurrency`` requests; queue the rest fairly (event loop only)."""
+
+    def __init__(self, concurrency: int, max_waiting: int = 0):
+        self.concurrency = concurrency
+        self.max_waiting = max_waiting
+        self.active = 0
+        self._virtual = 0.0  # start tag of the most recently admitted request
+        self._finish: Dict[str, float] = {}  # tenant -> finish tag of its last request
+        self._heap: List[tuple] = []
+        self._order = itertools.count()
+        self.max_tracked = 4096  # finish tags kept before those already in the past are pruned
+
+    def waiting(self, priority: str) -> int:
+        rank = PRIORITIES.index(priority)
+        return sum(1 for entry in self._heap if entry[0] == rank)
+
+    def _record(self, tenant: str, start: float, weight: float, cost: int):
+        self._finish[tenant] = start + cost / max(weight, 1e-6)
+        if len(self._finish) > self.max_tracked:
+            # A tag at or behind the virtual clock no longer changes anyone's start.
+            self._finish = {t: f for t, f in self._finish.items() if f > self._virtual}
+
+    async def acquire(self, tenant: str, weight: float, cost: int, priority: str = "interactive"):
+        cost = max(cost, 1)  # never cheaper than one token, so a finish tag cannot move back
+        start = max(self._virtual, self._finish.get(tenant, 0.0))
+        if self.active < self.concurrency and not self._heap:
+            self._record(tenant, start, weight, cost)
+            self.active += 1
+            self._virtual = start
+            return
+        if self.max_waiting and len(self._heap) >= self.max_waiting:
+            # Refused before its tag is recorded: work that never runs costs the tenant nothing.
+            raise QueueFull(f"admission queue is full ({len(self._heap)} waiting)")
+        self._record(tenant, start, weight, cost)
+        granted = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (PRIORITIES.index(priority), start, next(self._order), granted))
+        try:
+            await granted
+        except asyncio.CancelledError:
+            if granted.cancelled():
+                self._heap = [entry for entry in self._heap if entry[3] is not granted]
+                heapq.heapify(self._heap)
+            else:
+                self.release()  # admitted just as the waiter gave up
+            raise
+
+    def release(self):
+        """Free a slot and admit the next waiter, if any."""
+        self.active -= 1
+        while self._heap and self.active < self.concurrency:
+            _, start, _, granted = heapq.heappop(self._heap)
+            if granted.done():  # its request was cancelled while waiting
+                continue
+            self.active += 1
+            self._virtual = start
+            granted.set_result(None)
+
+
+def retry_after(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,202 @@
+"""Offline JSONL batch jobs.
+
+    python -m backend.batch_job --input prompts.jsonl --output results.jsonl
+
+Each input line is a JSON object with a ``prompt`` and optionally ``id``,
+``max_new_tokens``, ``temperature`` and ``seed``. For every input line, one
+output line is written as soon as that prompt finishes. Output is therefore
+in completion order. Each output line holds the input's ``index`` (its line
+number), ``id``, ``generated_text``, ``finish_reason`` and token counts.
+
+The output file doubles as the checkpoint. It is flushed and fsynced every
+``--checkpoint-every`` results. Rerunning the same command skips every index
+that already has a result; failed prompts and a partly written last line are
+retried.
+
+The job drives the model in-process rather than over HTTP and reads the same
+environment configuration as the server (``MODEL_ID``, ``DEVICE``,
+``MAX_BATCH_SIZE``, ...). Prompts are tokenized a window at a time and fed to
+the scheduler shortest first, so sequences admitted together share padded
+prefills.
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import structlog
+
+try:
+    from .engine import QueueFullError, SamplingParams
+except ImportError:  # run from backend/ as ``python batch_job.py`` rather than ``-m backend.batch_job``
+    from engine import QueueFullError, SamplingParams
+
+log = structlog.get_logger()
+
+
+def completed_indices(output_path: str) -> Set[int]:
+    """Indices already answered in ``output_path``.
+
+    A trailing line without a newline (an interrupted write) is truncated
+    away. Lines recording an error are not counted, so those prompts run
+    again.
+    """
+    done: Set[int] = set()
+    if not os.path.exists(output_path):
+        return done
+    good = 0
+    with open(output_path, "rb") as fh:
+        for line in fh:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if "error" not in record:
+                done.add(record["index"])
+            good += len(line)
+    if good < os.path.getsize(output_path):
+        with open(output_path, "r+b") as fh:
+            fh.truncate(good)
+    return done
+
+
+def _pending(input_path: str, done: Set[int]) -> Iterator[Tuple[int, Dict]]:
+    with open(input_path, encoding="utf-8") as fh:
+        for index, line in enumerate(fh):
+            if index in done or not line.strip():
+                continue
+            yield index, json.loads(line)
+
+
+def _windows(items: Iterator, size: int) -> Iterator[List]:
+    window = []
+    for item in items:
+        window.append(item)
+        if len(window) == size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def run_job(
+    tokenizer,
+    scheduler,
+    input_path: str,
+    output_path: str,
+    defaults: SamplingParams,
+    window: int = 1024,
+    max_inflight: int = 0,
+    checkpoint_every: int = 100,
+) -> Dict[str, float]:
+    """Generate a result for every pending line of ``input_path``."""
+    done = completed_indices(output_path)
+    max_inflight = max_inflight or 2 * scheduler.max_batch_size
+    inflight: Dict[Future, Tuple[int, Dict]] = {}
+    stats = {"skipped": len(done), "completed": 0, "failed": 0, "completion_tokens": 0}
+    started = time.perf_counter()
+
+    with open(output_path, "a", encoding="utf-8") as out:
+        def write(result: Dict):
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            written = stats["completed"] + stats["failed"]
+            if written % checkpoint_every == 0:
+                out.flush()
+                os.fsync(out.fileno())
+                log.info("batch_job_checkpoint", **stats)
+
+        def drain():
+            finished, _ = wait(list(inflight), return_when=FIRST_COMPLETED)
+            for future in finished:
+                index, record = inflight.pop(future)
+                base = {"index": index, "id": record.get("id")}
+                try:
+                    seq = future.result()
+                except Exception as exc:
+                    stats["failed"] += 1
+                    write({**base, "error": str(exc)})
+                    continue
+                stats["completed"] += 1
+                stats["completion_tokens"] += len(seq.output_ids)
+                write({
+                    **base,
+                    "generated_text": tokenizer.decode(seq.output_ids, skip_special_tokens=True),
+                    "finish_reason": seq.finish_reason,
+                    "prompt_tokens": len(seq.prompt_ids),
+                    "completion_tokens": len(seq.output_ids),
+                })
+
+        for chunk in _windows(_pending(input_path, done), window):
+            encoded = tokenizer([record["prompt"] for _, record in chunk])["input_ids"]
+            for (index, record), ids in sorted(zip(chunk, encoded), key=lambda item: len(item[1])):
+                params = SamplingParams(
+                    max_new_tokens=record.get("max_new_tokens", defaults.max_new_tokens),
+                    temperature=record.get("temperature", defaults.temperature),
+                    seed=record.get("seed", defaults.seed),
+                )
+                while len(inflight) >= max_inflight:
+                    drain()
+                while True:
+                    try:
+                        seq = scheduler.submit(ids, params)
+                        break
+                    except QueueFullError:
+                        drain()
+                    except ValueError as exc:  # e.g. an empty prompt
+                        seq = None
+                        stats["failed"] += 1
+                        write({"index": index, "id": record.get("id"), "error": str(exc)})
+                        break
+                if seq is not None:
+                    inflight[seq.future] = (index, record)
+        while inflight:
+            drain()
+        out.flush()
+        os.fsync(out.fileno())
+
+    elapsed = time.perf_counter() - started
+    stats["seconds"] = elapsed
+    stats["tokens_per_second"] = stats["completion_tokens"] / elapsed if elapsed else 0.0
+    return stats
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through the model offline.")
+    parser.add_argument("--input", required=True, help="JSONL file with one {\"prompt\": ...} object per line")
+    parser.add_argument("--output", required=True, help="JSONL results file; rerun to resume")
+    parser.add_argument("--model", default=None, help="Model id (defaults to MODEL_ID)")
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--window", type=int, default=1024, help="Prompts tokenized and length-sorted together")
+    parser.add_argument("--checkpoint-every", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    try:
+        from .main import MODEL_ID, registry
+    except ImportError:  # as above
+        from main import MODEL_ID, registry
+
+    handle = registry.load(args.model or MODEL_ID)
+    try:
+        stats = run_job(
+            handle.tokenizer,
+            handle.scheduler,
+            args.input,
+            args.output,
+            SamplingParams(max_new_tokens=args.max_new_tokens, temperature=args.temperature, seed=args.seed),
+            window=args.window,
+            checkpoint_every=args.checkpoint_every,
+        )
+    finally:
+        handle.scheduler.stop()
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Fit chat histories into a token budget.
+
+Chat prompts are rendered as ``"{role}: {content}\\n"`` per message followed by
+``"assistant: "``. Left alone, a long conversation grows the prompt, and so the
+prefill cost, with every turn until it no longer fits the model's context.
+``ChatContext`` counts tokens per rendered message and drops (or, for a single
+oversized message, truncates) history until the prompt fits the budget.
+
+Counts are cached by message content in an LRU. Each turn of a conversation
+resends the earlier messages, so normally only the newest message is
+tokenized. Counting messages separately can be off from tokenizing the joined
+prompt by a token or so per message boundary, and special tokens are counted
+per message rather than once. So a fit that lands within that slack of the
+budget is checked by tokenizing the rendered prompt, and fitted again with the
+overshoot taken off the budget when it is over.
+
+Strategies:
+
+``sliding_window``
+    Keep the most recent messages that fit.
+``system_recent``
+    Keep every system message, then the most recent other messages that fit.
+``middle``
+    Keep messages from both ends, the start (up to half the budget) and the
+    most recent, and drop the middle of the conversation.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+STRATEGIES = ("sliding_window", "system_recent", "middle")
+REFITS = 3  # attempts to shrink an estimated fit that tokenizes over budget
+ASSISTANT_PREFIX = "assistant: "
+ELISION = "\n...\n"
+
+Message = Tuple[str, str]  # (role, content)
+
+
+def render(messages: Sequence[Message]) -> str:
+    return "".join(f"{role}: {content}\n" for role, content in messages) + ASSISTANT_PREFIX
+
+
+@dataclass
+class ContextFit:
+    messages: List[Message]
+    prompt_tokens: int  # estimated from the per-message counts
+    dropped_messages: int = 0
+    dropped_tokens: int = 0  # from dropped messages and truncated content
+
+
+class ChatContext:
+    """Per-tokenizer token counting and history fitting."""
+
+    def __init__(self, tokenizer, cache_size: int = 10000):
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self._counts: "OrderedDict[bytes, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._prefix_tokens = len(self._encode(ASSISTANT_PREFIX))
+
+    def _encode(self, text: str) -> List[int]:
+        return self.tokenizer(text)["input_ids"]
+
+    def count(self, role: str, content: str) -> int:
+        """Tokens in one rendered message, cached."""
+        line = f"{role}: {content}\n"
+        key = hashlib.blake2b(line.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            n = self._counts.get(key)
+            if n is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return n
+            self.misses += 1
+        n = len(self._encode(line))
+        with self._lock:
+            self._counts[key] = n
+            while len(self._counts) > self.cache_size:
+                self._counts.popitem(last=False)
+        return n
+
+    def fit(self, messages: Sequence[Message], budget: Optional[int], strategy: str = "system_recent") -> ContextFit:
+        """Choose the messages (in order) whose rendered prompt fits ``budget`` tokens."""
+        if strategy not in STRATEGIES:
+            raise ValueError(f"context strategy must be one of {', '.join(STRATEGIES)}, got {strategy!r}")
+        messages = list(messages)
+        fit = self._fit(messages, budget, strategy)
+        if budget is None:
+            return fit
+        target = budget
+        for _ in range(REFITS):
+            if fit.prompt_tokens + len(fit.messages) + 1 <= budget:
+                break  # clear of the per-boundary error, no need to tokenize the prompt
+            fit.prompt_tokens = len(self._encode(render(fit.messages)))
+            over = fit.prompt_tokens - budget
+            if over <= 0:
+                break
+            target -= over
+            fit = self._fit(messages, target, strategy)
+        return fit
+
+    def _fit(self, messages: List[Message], budget: Optional[int], strategy: str) -> ContextFit:
+        counts = [self.count(role, content) for role, content in messages]
+        total = sum(counts) + self._prefix_tokens
+        if budget is None or total <= budget or not messages:
+            return ContextFit(messages, total)
+        room = budget - self._prefix_tokens
+
+        last = len(messages) - 1
+        if strategy == "system_recent":
+            pinned = [i for i, (role, _) in enumerate(messages) if role == "system" and i != last]
+            if sum(counts[i] for i in pinned) + counts[last] > room:
+                pinned = []  # the system prompt alone does not leave room for the question
+            keep = self._fill_recent(counts, set(pinned), room)
+        elif strategy == "middle":
+            head: List[int] = []
+            used = counts[last]
+            for i in range(last):
+                if used + counts[i] > room // 2:
+                    break
+                head.append(i)
+                used += counts[i]
+            keep = self._fill_recent(counts, set(head), room)
+        else:
+            keep = self._fill_recent(counts, set(), room)
+
+        kept = [messages[i] for i in sorted(keep)]
+        dropped_tokens = sum(c for i, c in enumerate(counts) if i not in keep)
+        if last not in keep:
+            # Even the newest message alone is over budget: cut its content down.
+            used = sum(counts[i] for i in keep)
+            role, content = messages[last]
+            content, cut = self._truncate(role, content, room - used, strategy == "middle")
+            kept.append((role, content))
+            dropped_tokens += cut
+            dropped_tokens -= counts[last]  # counted as dropped above; only ``cut`` was
+        prompt_tokens = total - dropped_tokens
+        return ContextFit(kept, prompt_tokens, len(messages) - len(kept), dropped_tokens)
+
+    @staticmethod
+    def _fill_recent(counts: List[int], keep: set, room: int) -> set:
+        """Add messages from newest to oldest while they fit; stop at the first that doesn't."""
+        keep = set(keep)
+        used = sum(counts[i] for i in keep)
+        for i in range(len(counts) - 1, -1, -1):
+            if i in keep:
+                continue
+            if used + counts[i] > room:
+                break
+            keep.add(i)
+            used += counts[i]
+        return keep
+
+    def _truncate(self, role: str, content: str, room: int, middle: bool) -> Tuple[str, int]:
+        """Shorten ``content`` so its rendered message fits ``room`` tokens; returns (content, tokens cut)."""
+        ids = self._encode(content)
+        overhead = self.count(role, "")
+        allowed = max(room - overhead, 0)
+        if middle and allowed > 0:
+            allowed = max(allowed - len(self._encode(ELISION)), 0)
+        cut = max(len(ids) - allowed, 0)
+        if not cut:
+            return content, 0
+        decode = lambda part: self.tokenizer.decode(part, skip_special_tokens=True)
+        if middle and allowed > 0:
+            half = allowed // 2
+            return decode(ids[:half]) + ELISION + decode(ids[len(ids) - (allowed - half):]), cut
+        return decode(ids[len(ids) - allowed:]) if allowed else "", cut
@@ -0,0 +1,248 @@
+"""CPU inference mode: precision, thread and affinity tuning.
+
+Used when ``DEVICE=cpu``, for the CPU-only nodes that take overflow traffic.
+Three knobs live here:
+
+* precision: ``fp32``; ``bf16`` (falls back to ``fp32`` when the CPU has no
+  native bf16 support); or ``int8``, which applies dynamic quantization to
+  every ``nn.Linear``;
+* an optional ``torch.compile``d decode path that falls back to eager if
+  compilation fails;
+* intra-op/inter-op thread counts and CPU pinning, where ``CPU_AFFINITY``
+  accepts a cpu list (``0-15,32-47``) or a NUMA node (``node0``).
+
+Pinning happens before the weights are loaded. Under Linux's default
+first-touch policy, the weights are then allocated on the pinned node's
+memory.
+
+Run this module to compare precisions against the fp32 baseline on a node::
+
+    python -m backend.cpu_runtime --model bigcode/starcoder2-3b --precisions fp32,bf16,int8
+"""
+
+import argparse
+import json
+import os
+import time
+import warnings
+from typing import Dict, List, Optional, Set
+
+import structlog
+import torch
+
+try:
+    from .engine import BatchScheduler, SamplingParams
+    from .registry import model_nbytes
+except ImportError:  # imported without the package by a top-level ``main``, or run from backend/ as a script
+    from engine import BatchScheduler, SamplingParams
+    from registry import model_nbytes
+
+log = structlog.get_logger()
+
+PRECISIONS = ("fp32", "bf16", "int8")
+
+
+def parse_cpu_list(spec: str) -> Set[int]:
+    """Parse ``"0-3,8,10-11"`` (the kernel's cpulist format) into cpu ids."""
+    cpus: Set[int] = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            cpus.update(range(int(lo), int(hi) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def affinity_cpus(spec: str) -> Set[int]:
+    """Resolve a ``CPU_AFFINITY`` value: a cpu list or ``nodeN``."""
+    spec = spec.strip()
+    if spec.startswith("node"):
+        path = f"/sys/devices/system/node/{spec}/cpulist"
+        with open(path, encoding="utf-8") as fh:
+            return parse_cpu_list(fh.read())
+    return parse_cpu_list(spec)
+
+
+def configure_cpu(affinity: str = "", threads: int = 0, interop_threads: int = 0) -> Dict[str, object]:
+    """Pin the process and size torch's thread pools.
+
+    Call this before any model work. Threads started later inherit the
+    affinity, and torch only accepts an inter-op pool size before the pool
+    is first used. With ``threads=0`` the intra-op pool is sized to the
+    pinned cpus.
+    """
+    if affinity:
+        cpus = affinity_cpus(affinity)
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+        else:
+            log.warning("cpu_affinity_unsupported", affinity=affinity)
+    if not threads and hasattr(os, "sched_getaffinity"):
+        threads = len(os.sched_getaffinity(0)) if affinity else 0
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            log.warning("interop_threads_already_set", requested=interop_threads,
+                        current=torch.get_num_interop_threads())
+    settings = {
+        "affinity": sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None,
+        "threads": torch.get_num_threads(),
+        "interop_threads": torch.get_num_interop_threads(),
+    }
+    log.info("cpu_configured", **settings)
+    return settings
+
+
+def bf16_supported() -> bool:
+    is_supported = getattr(torch.cpu, "_is_avx512_bf16_supported", None)
+    if is_supported is not None and is_supported():
+        return True
+    amx = getattr(torch.cpu, "_is_amx_tile_supported", None)
+    return bool(amx is not None and amx())
+
+
+def resolve_precision(precision: str) -> str:
+    precision = precision.lower()
+    if precision not in PRECISIONS:
+        raise ValueError(f"CPU precision must be one of {', '.join(PRECISIONS)}, got {precision!r}")
+    if precision == "bf16" and not bf16_supported():
+        log.warning("bf16_unsupported_falling_back", precision="fp32")
+        return "fp32"
+    return precision
+
+
+def load_dtype(precision: str) -> torch.dtype:
+    """dtype to pass to ``from_pretrained``; int8 quantizes from fp32."""
+    return torch.bfloat16 if precision == "bf16" else torch.float32
+
+
+def prepare_cpu_model(model, precision: str):
+    """Apply ``precision`` to a model loaded with ``load_dtype(precision)``."""
+    model.eval()
+    if precision == "int8":
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")  # torch.ao deprecation notices
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+class CompiledDecode:
+    """``torch.compile``d forward for decode steps, with an eager fallback.
+
+    Decode steps feed one token per row with a growing cache, so the graph is
+    compiled with dynamic shapes. Compilation happens on the first call (the
+    warm-up generation). If it fails, the error is logged and the eager model
+    is used from then on.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._compiled = torch.compile(model, dynamic=True)
+
+    def __call__(self, **kwargs):
+        if self._compiled is not None:
+            try:
+                return self._compiled(**kwargs)
+            except Exception:
+                log.exception("compiled_decode_failed_using_eager")
+                self._compiled = None
+        return self.model(**kwargs)
+
+
+# ---------------------------------------------------------------------------
+# Precision comparison
+# ---------------------------------------------------------------------------
+def measure(model, prompts: List[List[int]], max_new_tokens: int, decode_model=None) -> Dict[str, float]:
+    """Greedy-generate ``prompts`` as one batch and report throughput."""
+    scheduler = BatchScheduler(model, eos_token_id=None, max_batch_size=len(prompts), decode_model=decode_model)
+    scheduler.start()
+    params = SamplingParams(max_new_tokens=max_new_tokens, temperature=0.0)
+    try:
+        # The first pass warms allocators (and compiles, if enabled).
+        scheduler.submit(prompts[0], SamplingParams(max_new_tokens=2, temperature=0.0)).future.result()
+        started = time.perf_counter()
+        seqs = [scheduler.submit(p, params) for p in prompts]
+        tokens = sum(len(s.future.result().output_ids) for s in seqs)
+        elapsed = time.perf_counter() - started
+    finally:
+        scheduler.stop()
+    return {"tokens": tokens, "seconds": elapsed, "tokens_per_second": tokens / elapsed if elapsed else 0.0}
+
+
+def compare_precisions(
+    model_id: str,
+    precisions: List[str],
+    prompt: str = "def fibonacci(n):",
+    batch: int = 4,
+    max_new_tokens: int = 32,
+    compile_decode: bool = False,
+    token: Optional[str] = None,
+) -> List[Dict[str, object]]:
+    """Load ``model_id`` once per precision and report each against fp32."""
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_id, token=token)
+    prompts = [tokenizer(prompt)["input_ids"]] * batch
+    if "fp32" not in precisions:
+        precisions = ["fp32"] + list(precisions)
+    reports = []
+    for precision in precisions:
+        effective = resolve_precision(precision)
+        started = time.perf_counter()
+        model = AutoModelForCausalLM.from_pretrained(
+            model_id, token=token, torch_dtype=load_dtype(effective), low_cpu_mem_usage=True
+        )
+        model = prepare_cpu_model(model, effective)
+        load_seconds = time.perf_counter() - started
+        decode_model = CompiledDecode(model) if compile_decode else None
+        report = {
+            "precision": precision,
+            "effective_precision": effective,
+            "load_seconds": load_seconds,
+            "model_bytes": model_nbytes(model),
+            **measure(model, prompts, max_new_tokens, decode_model),
+        }
+        reports.append(report)
+        del model, decode_model
+    baseline = next(r for r in reports if r["precision"] == "fp32")
+    for report in reports:
+        report["speedup_vs_fp32"] = report["tokens_per_second"] / baseline["tokens_per_second"]
+        report["memory_vs_fp32"] = report["model_bytes"] / baseline["model_bytes"]
+    return reports
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Compare CPU inference precisions against fp32.")
+    parser.add_argument("--model", default=os.getenv("MODEL_ID", "bigcode/starcoder2-3b"))
+    parser.add_argument("--precisions", default="fp32,bf16,int8")
+    parser.add_argument("--prompt", default="def fibonacci(n):")
+    parser.add_argument("--batch", type=int, default=4)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--compile", action="store_true", help="Use the torch.compile'd decode path")
+    parser.add_argument("--threads", type=int, default=int(os.getenv("CPU_THREADS", "0")))
+    parser.add_argument("--interop-threads", type=int, default=int(os.getenv("CPU_INTEROP_THREADS", "0")))
+    parser.add_argument("--affinity", default=os.getenv("CPU_AFFINITY", ""))
+    args = parser.parse_args(argv)
+
+    settings = configure_cpu(args.affinity, args.threads, args.interop_threads)
+    reports = compare_precisions(
+        args.model,
+        [p.strip() for p in args.precisions.split(",") if p.strip()],
+        prompt=args.prompt,
+        batch=args.batch,
+        max_new_tokens=args.max_new_tokens,
+        compile_decode=args.compile,
+        token=os.getenv("HF_TOKEN"),
+    )
+    print(json.dumps({"model": args.model, "cpu": settings, "results": reports}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
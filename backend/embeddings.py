@@ -0,0 +1,175 @@
+"""Embeddings from the hidden states of an already-loaded causal LM.
+
+Code search needs one vector per snippet. This module gets those vectors
+from the model the server already holds for generation, so no second
+encoder stack is needed:
+
+* Inputs are sorted by token length and packed into batches of at most
+  ``max_batch_tokens`` padded tokens (``batches``). Each batch holds inputs
+  of similar length, so little of the forward pass is spent on padding.
+* A batch runs through the model's base transformer (no LM head). Its last
+  hidden states are pooled in one vectorized operation, as a masked mean
+  over the real tokens (``mean``) or the last real token (``last``), then
+  L2-normalized so that a dot product is the cosine similarity.
+* ``EmbeddingCache`` optionally keeps every vector on disk, keyed by a hash
+  of the model, pooling and text. Re-indexing an unchanged repository then
+  reads files instead of running the model.
+"""
+
+import array
+import base64
+import hashlib
+import os
+import sys
+from typing import Iterator, List, Optional
+
+import structlog
+import torch
+
+log = structlog.get_logger()
+
+POOLING = ("mean", "last")
+
+
+def batches(lengths: List[int], max_batch_tokens: int) -> Iterator[List[int]]:
+    """Group input indices shortest first, each group padding to at most ``max_batch_tokens``.
+
+    An input longer than ``max_batch_tokens`` gets a batch of its own.
+    """
+    batch: List[int] = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # Sorted, so the newest input is the longest and sets the padded width.
+        if batch and (len(batch) + 1) * lengths[i] > max_batch_tokens:
+            yield batch
+            batch = []
+        batch.append(i)
+    if batch:
+        yield batch
+
+
+def pool(hidden: torch.Tensor, mask: torch.Tensor, pooling: str) -> torch.Tensor:
+    """Pool right-padded ``[rows, positions, dim]`` hidden states to unit ``[rows, dim]`` float32 vectors."""
+    hidden = hidden.float()
+    if pooling == "mean":
+        weights = mask.to(hidden.dtype).unsqueeze(-1)
+        pooled = (hidden * weights).sum(dim=1) / weights.sum(dim=1).clamp(min=1)
+    elif pooling == "last":
+        last = (mask.sum(dim=1) - 1).clamp(min=0)
+        pooled = hidden[torch.arange(hidden.shape[0], device=hidden.device), last]
+    else:
+        raise ValueError(f"pooling must be one of {', '.join(POOLING)}, got {pooling!r}")
+    return torch.nn.functional.normalize(pooled, dim=-1)
+
+
+class Embedder:
+    """Runs padded batches through ``model`` and pools them. Call ``forward`` from one thread at a time."""
+
+    def __init__(self, model, max_batch_tokens: int = 8192):
+        self.model = model
+        self.max_batch_tokens = max_batch_tokens
+        base = getattr(model, "base_model", None)
+        # Skipping the LM head avoids a [rows, positions, vocab] logits tensor per batch.
+        self._base = base if base is not None and base is not model else None
+
+    @property
+    def device(self) -> torch.device:
+        return getattr(self.model, "device", torch.device("cpu"))
+
+    def batches(self, lengths: List[int]) -> Iterator[List[int]]:
+        return batches(lengths, self.max_batch_tokens)
+
+    @torch.inference_mode()
+    def forward(self, prompt_ids: List[List[int]], pooling: str = "mean") -> torch.Tensor:
+        """Embed one batch of token id lists; returns ``[len(prompt_ids), dim]`` float32 on the CPU."""
+        width = max(len(ids) for ids in prompt_ids)
+        input_ids = torch.zeros(len(prompt_ids), width, dtype=torch.long)
+        mask = torch.zeros(len(prompt_ids), width, dtype=torch.long)
+        for row, ids in enumerate(prompt_ids):
+            input_ids[row, :len(ids)] = torch.tensor(ids)
+            mask[row, :len(ids)] = 1
+        input_ids, mask = input_ids.to(self.device), mask.to(self.device)
+        if self._base is not None:
+            hidden = self._base(input_ids=input_ids, attention_mask=mask, use_cache=False).last_hidden_state
+        else:
+            out = self.model(input_ids=input_ids, attention_mask=mask, use_cache=False, output_hidden_states=True)
+            hidden = out.hidden_states[-1]
+        return pool(hidden, mask.to(hidden.device), pooling).cpu()
+
+    def embed(self, prompt_ids: List[List[int]], pooling: str = "mean") -> torch.Tensor:
+        """Embed any number of inputs in length-bucketed batches, returned in input order."""
+        rows: List[Optional[torch.Tensor]] = [None] * len(prompt_ids)
+        for batch in self.batches([len(ids) for ids in prompt_ids]):
+            for i, vector in zip(batch, self.forward([prompt_ids[i] for i in batch], pooling)):
+                rows[i] = vector
+        return torch.stack(rows)
+
+
+def pack(vector: torch.Tensor) -> bytes:
+    """Little-endian float32 bytes of a 1-d vector."""
+    packed = array.array("f", vector.tolist())
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack(data: bytes) -> torch.Tensor:
+    packed = array.array("f")
+    packed.frombytes(data)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return torch.tensor(packed, dtype=torch.float32)
+
+
+def encode_base64(vector: torch.Tensor) -> str:
+    """The OpenAI ``encoding_format: base64``: packed float32, base64-encoded."""
+    return base64.b64encode(pack(vector)).decode("ascii")
+
+
+def cache_key(model_id: str, pooling: str, text: str) -> str:
+    digest = hashlib.sha256()
+    for part in (model_id, pooling, text):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """Vectors on disk as raw float32 files, one per key, sharded by key prefix.
+
+    Entries never expire: a key covers everything the vector depends on.
+    Delete the directory to start over. Synchronous; call it from an executor.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.f32")
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fh:
+                vector = unpack(fh.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):  # ValueError: a truncated file
+            log.warning("embedding_cache_read_failed", path=path)
+            return None
+        return vector
+
+    def put(self, key: str, vector: torch.Tensor):
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, "wb") as fh:
+                fh.write(pack(vector))
+            os.replace(tmp, path)
+        except OSError:
+            log.warning("embedding_cache_write_failed", path=path)
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
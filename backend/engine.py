@@ -0,0 +1,705 @@
+"""Continuous batching scheduler for the Starcoder2 backend.
+
+HTTP handlers submit tokenized prompts; a single background thread owns the
+model and advances every in-flight sequence with one batched forward pass per
+decode step. Between steps newly queued sequences are prefilled and merged
+into the batch, and finished ones are dropped from it, so N concurrent users
+share each decode step instead of queuing behind each other. Sequences
+admitted together are prefilled in padded batches of similar prompt length.
+
+The batched KV cache is kept left-padded: every row is aligned on the right
+edge, padding positions are masked out and position ids are derived from the
+attention mask, which keeps the per-sequence results identical to running
+them one at a time.
+
+Streaming requests get a ``TokenStream`` that the scheduler thread feeds as
+each token is sampled; ``IncrementalDetokenizer`` turns those ids into text
+deltas without re-decoding the whole sequence at every step.
+
+Greedy sequences can opt into speculative decoding (see ``speculative``);
+they keep their own KV cache and get one verification step per iteration of
+the loop, next to the batched decode step.
+
+With a ``PrefixCache`` attached, finished sequences leave their KV behind and
+new prompts that share a prefix with them only prefill the new suffix.
+
+Admission is bounded: once ``max_queue_size`` sequences are waiting for a
+slot in the batch, ``submit`` raises ``QueueFullError`` so callers can shed
+load instead of letting queueing latency grow without limit.
+
+A sequence can be cancelled from any thread (``Sequence.cancel``), or given a
+deadline through ``SamplingParams.deadline``. The loop checks both before
+every decode step, so an abandoned request stops using the batch within one
+step and resolves with whatever it had generated.
+
+Sequences with ``SamplingParams.stop`` strings (schedulers built with a
+``tokenizer``) are detokenized on the scheduler thread as they decode and end
+on the step that completes a stop string (see ``stop_sequences``).
+
+How the batch KV cache is stored (full precision, pre-allocated, quantized
+or offloaded to host memory) is chosen with ``kv_cache_mode``; see
+``kv_cache``.
+"""
+
+import asyncio
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import structlog
+import torch
+
+try:
+    from .kv_cache import BatchKVCache, new_batch_cache, pad_left as _pad_left
+    from .prefix_cache import PrefixCache
+    from .speculative import DraftModelProposer, PromptLookupProposer, SpecState, SpecStats, crop_past, verify
+    from .stop_sequences import StopMatcher
+except ImportError:  # executed as a top-level module (``uvicorn main:app``)
+    from kv_cache import BatchKVCache, new_batch_cache, pad_left as _pad_left
+    from prefix_cache import PrefixCache
+    from speculative import DraftModelProposer, PromptLookupProposer, SpecState, SpecStats, crop_past, verify
+    from stop_sequences import StopMatcher
+
+log = structlog.get_logger()
+
+
+class QueueFullError(RuntimeError):
+    """Raised by ``BatchScheduler.submit`` when the admission queue is full."""
+
+
+@dataclass
+class SamplingParams:
+    max_new_tokens: int = 256
+    temperature: float = 0.7
+    seed: Optional[int] = None  # reproducible sampling for this request
+    speculation: str = "off"  # "off", "draft" or "prompt_lookup"; greedy requests only
+    deadline: Optional[float] = None  # time.monotonic() after which generation stops
+    stop: Tuple[str, ...] = ()  # end generation before any of these strings
+
+
+@dataclass
+class Sequence:
+    """One generation request as tracked by the scheduler."""
+
+    prompt_ids: List[int]
+    params: SamplingParams
+    request_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    output_ids: List[int] = field(default_factory=list)
+    finish_reason: Optional[str] = None
+    future: Future = field(default_factory=Future, repr=False)
+    stream: Optional["TokenStream"] = field(default=None, repr=False)
+    queued_at: float = field(default_factory=time.monotonic)
+    admitted_at: Optional[float] = None
+    cached_tokens: int = 0  # prompt tokens served from the prefix cache
+    generator: Optional[torch.Generator] = field(default=None, repr=False)
+    spec: Optional[SpecState] = field(default=None, repr=False)
+    cancel_reason: Optional[str] = None
+    detokenizer: Optional["IncrementalDetokenizer"] = field(default=None, repr=False)
+    stop_matcher: Optional[StopMatcher] = field(default=None, repr=False)
+    # Timings, all from time.monotonic(). ``tokenize_seconds`` and
+    # ``admission_seconds`` are filled in by the caller, which tokenized the
+    # prompt and waited for admission before submitting it.
+    tokenize_seconds: float = 0.0
+    admission_seconds: float = 0.0
+    prefill_seconds: float = 0.0  # the forward pass this sequence was prefilled in
+    token_times: List[float] = field(default_factory=list, repr=False)  # when each output token was sampled
+    finished_at: Optional[float] = None
+
+    def cancel(self, reason: str = "cancelled"):
+        """Ask the scheduler to stop this sequence; safe from any thread.
+
+        The scheduler checks before every decode step, so at most one more
+        token is produced. The sequence then resolves normally with the
+        tokens generated so far and ``finish_reason`` set to ``reason``.
+        """
+        if self.cancel_reason is None and not self.finished:
+            self.cancel_reason = reason
+
+    def stop_reason(self, now: float) -> Optional[str]:
+        if self.cancel_reason is not None:
+            return self.cancel_reason
+        if self.params.deadline is not None and now >= self.params.deadline:
+            return "timeout"
+        return None
+
+    @property
+    def queue_wait(self) -> float:
+        """Seconds spent waiting for a slot in the batch (so far, if still queued)."""
+        end = self.admitted_at if self.admitted_at is not None else time.monotonic()
+        return end - self.queued_at
+
+    @property
+    def finished(self) -> bool:
+        return self.finish_reason is not None
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        """Seconds from the start of tokenization to the first sampled token."""
+        if not self.token_times:
+            return None
+        return self.token_times[0] - self.queued_at + self.tokenize_seconds + self.admission_seconds
+
+    @property
+    def inter_token_latencies(self) -> List[float]:
+        times = self.token_times
+        return [b - a for a, b in zip(times, times[1:])]
+
+    @property
+    def decode_seconds(self) -> float:
+        """Seconds from the first output token until the sequence finished."""
+        if not self.token_times or self.finished_at is None:
+            return 0.0
+        return self.finished_at - self.token_times[0]
+
+
+class TokenStream:
+    """Hand sampled token ids from the scheduler thread to an asyncio consumer.
+
+    Iterating yields token ids until the sequence finishes; if generation
+    failed the exception is raised from the iterator.
+    """
+
+    _END = object()
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._queue: "asyncio.Queue[Any]" = asyncio.Queue()
+
+    def _put(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        except RuntimeError:  # event loop already closed; nobody is listening
+            pass
+
+    def put(self, token: int):
+        self._put(token)
+
+    def close(self, exc: Optional[BaseException] = None):
+        self._put(exc if exc is not None else self._END)
+
+    def __aiter__(self) -> AsyncIterator[int]:
+        return self
+
+    async def __anext__(self) -> int:
+        item = await self._queue.get()
+        if item is self._END:
+            raise StopAsyncIteration
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+
+class IncrementalDetokenizer:
+    """Turn a growing list of token ids into text deltas.
+
+    Only a short window of recent tokens is decoded at each step: the text of
+    ``ids[prefix_offset:]`` is compared with that of
+    ``ids[prefix_offset:read_offset]`` and the difference is emitted. Partial
+    UTF-8 sequences (decoded as U+FFFD) are held back until completed, and
+    whitespace is passed through untouched.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.ids: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, ids: List[int]) -> str:
+        return self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens)
+
+    def push(self, token_id: int) -> str:
+        self.ids.append(token_id)
+        prefix_text = self._decode(self.ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.ids[self.prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def flush(self) -> str:
+        """Return whatever text is still held back once the sequence ends."""
+        prefix_text = self._decode(self.ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.ids)
+        return new_text[len(prefix_text):]
+
+
+def _sample(
+    logits: torch.Tensor,
+    temperatures: List[float],
+    generators: Optional[List[Optional[torch.Generator]]] = None,
+) -> torch.Tensor:
+    """Pick one token per row; rows with temperature <= 0 decode greedily.
+
+    Rows with a seeded generator are sampled individually from it, so their
+    output does not depend on what else happens to share the batch.
+    """
+    logits = logits.float()
+    greedy = logits.argmax(dim=-1)
+    temps = torch.tensor(temperatures, device=logits.device, dtype=logits.dtype)
+    do_sample = temps > 0
+    if not bool(do_sample.any()):
+        return greedy
+    probs = torch.softmax(logits / temps.clamp(min=1e-5).unsqueeze(1), dim=-1)
+    sampled = torch.multinomial(probs, num_samples=1).squeeze(1)
+    for i, gen in enumerate(generators or ()):
+        if gen is not None:
+            sampled[i] = torch.multinomial(probs[i], num_samples=1, generator=gen)[0]
+    return torch.where(do_sample, sampled, greedy)
+
+
+def _length_buckets(seqs: List[Sequence]) -> List[List[Sequence]]:
+    """Group sequences whose prompt lengths fall in the same power-of-two band,
+    so a padded prefill wastes at most about half of each row."""
+    buckets: dict = {}
+    for seq in sorted(seqs, key=lambda s: len(s.prompt_ids)):
+        buckets.setdefault((len(seq.prompt_ids) - 1).bit_length(), []).append(seq)
+    return list(buckets.values())
+
+
+class BatchScheduler:
+    """Merge concurrent generation requests into shared decode steps."""
+
+    def __init__(
+        self,
+        model,
+        eos_token_id: Optional[int],
+        max_batch_size: int = 8,
+        max_queue_size: int = 0,
+        prefix_cache: Optional[PrefixCache] = None,
+        decode_model=None,
+        draft_model=None,
+        speculative_tokens: int = 4,
+        prompt_lookup_ngram: int = 3,
+        tokenizer=None,
+        kv_cache_mode: str = "dynamic",
+        kv_cache_block: int = 256,
+    ):
+        self.model = model
+        # Optional drop-in for ``model`` on decode steps (e.g. a compiled forward).
+        self.decode_model = decode_model if decode_model is not None else model
+        self.eos_token_id = eos_token_id
+        self.tokenizer = tokenizer  # needed for SamplingParams.stop
+        self.max_batch_size = max_batch_size
+        self.kv_cache_mode = kv_cache_mode
+        self.kv_cache_block = kv_cache_block
+        new_batch_cache(kv_cache_mode)  # reject an unknown mode now, not on the first merge
+        self.max_queue_size = max_queue_size
+        self.prefix_cache = prefix_cache
+        self._pending: "queue.Queue[Sequence]" = queue.Queue(maxsize=max_queue_size)
+        self._active: List[Sequence] = []
+        self._speculating: List[Sequence] = []
+        self._proposers = {"prompt_lookup": PromptLookupProposer(speculative_tokens, prompt_lookup_ngram)}
+        if draft_model is not None:
+            self._proposers["draft"] = DraftModelProposer(draft_model, speculative_tokens)
+        self.spec_stats = {mode: SpecStats() for mode in self._proposers}
+        # reason -> sequences stopped early, and tokens they did not generate
+        self.cancelled: Dict[str, int] = {}
+        self.cancelled_tokens_saved: Dict[str, int] = {}
+        # reason ("eos" or "stop_sequence") -> sequences that finished before
+        # max_new_tokens, and the decode steps that saved
+        self.early_stops: Dict[str, int] = {}
+        self.early_stop_steps_saved: Dict[str, int] = {}
+        self._past: Optional[BatchKVCache] = None
+        self._mask: Optional[torch.Tensor] = None  # [batch, cached positions]
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    # -- lifecycle ---------------------------------------------------------
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
+            alive, self._thread = self._thread.is_alive(), None
+            if alive:
+                return
+        # Nothing will serve these any more (e.g. the model was evicted).
+        stopped = RuntimeError("scheduler stopped")
+        self._fail_active(stopped)
+        for seq in self._speculating:
+            self._fail(seq, stopped)
+        self._speculating = []
+        while True:
+            try:
+                self._fail(self._pending.get_nowait(), stopped)
+            except queue.Empty:
+                break
+
+    # -- public API --------------------------------------------------------
+    def submit(self, prompt_ids: List[int], params: SamplingParams, stream: bool = False) -> Sequence:
+        """Queue a prompt for generation.
+
+        With ``stream=True`` the call must come from a running event loop;
+        sampled tokens are then delivered through ``seq.stream``. Raises
+        ``ValueError`` for a speculation mode this scheduler cannot serve (or
+        stop strings without a ``tokenizer``) and ``QueueFullError`` when ``max_queue_size`` sequences are already
+        waiting.
+        """
+        if not prompt_ids:
+            raise ValueError("prompt must contain at least one token")
+        if params.speculation not in self.speculation_modes:
+            raise ValueError(f"speculation mode {params.speculation!r} is not available")
+        if params.stop and self.tokenizer is None:
+            raise ValueError("stop sequences need a scheduler with a tokenizer")
+        seq = Sequence(prompt_ids=list(prompt_ids), params=params)
+        if params.stop:
+            seq.detokenizer = IncrementalDetokenizer(self.tokenizer)
+            seq.stop_matcher = StopMatcher(params.stop)
+        if stream:
+            seq.stream = TokenStream(asyncio.get_running_loop())
+        try:
+            self._pending.put_nowait(seq)
+        except queue.Full:
+            raise QueueFullError(f"admission queue is full ({self.max_queue_size} waiting)") from None
+        return seq
+
+    @property
+    def batch_size(self) -> int:
+        return len(self._active) + len(self._speculating)
+
+    @property
+    def speculation_modes(self) -> List[str]:
+        return ["off", *self._proposers]
+
+    @property
+    def queue_depth(self) -> int:
+        return self._pending.qsize()
+
+    @property
+    def queue_full(self) -> bool:
+        return self._pending.full()
+
+    @property
+    def kv_cache_bytes(self) -> int:
+        """Memory held by the decode batch's KV cache."""
+        past = self._past
+        return past.nbytes if past is not None else 0
+
+    @property
+    def kv_cache_bytes_per_sequence(self) -> float:
+        past = self._past
+        if past is None or not past.rows:
+            return 0.0
+        return past.nbytes / past.rows
+
+    # -- scheduler loop ----------------------------------------------------
+    def _run(self):
+        while self._running:
+            admitted: List[Sequence] = []
+            if not self._active and not self._speculating:
+                try:
+                    admitted.append(self._pending.get(timeout=0.1))
+                except queue.Empty:
+                    continue
+            while self.batch_size + len(admitted) < self.max_batch_size:
+                try:
+                    admitted.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            if admitted:
+                self._admit(admitted)
+            self._reap()
+            if self._active:
+                try:
+                    self._step()
+                except Exception as exc:  # pragma: no cover - defensive
+                    log.exception("decode_step_failed", batch=len(self._active))
+                    self._fail_active(exc)
+            if self._speculating:
+                self._speculate()
+
+    @property
+    def _device(self) -> torch.device:
+        return self.model.device
+
+    def _admit(self, seqs: List[Sequence]):
+        """Prefill newly admitted sequences and merge them into the batch.
+
+        Prompts with a prefix-cache hit prefill only their uncached suffix,
+        one at a time. The rest are grouped into length buckets and each bucket
+        is prefilled in one left-padded forward pass.
+        """
+        fresh = []
+        now = time.monotonic()
+        for seq in seqs:
+            seq.admitted_at = now
+            reason = seq.stop_reason(now)
+            if reason is not None:  # gave up while queued; skip the prefill
+                self._cancel(seq, reason)
+                continue
+            if seq.params.seed is not None:
+                seq.generator = torch.Generator(device=self._device).manual_seed(seq.params.seed)
+            past = None
+            if self.prefix_cache is not None:
+                past, seq.cached_tokens = self.prefix_cache.lookup(seq.prompt_ids)
+            if past is None:
+                fresh.append(seq)
+            else:
+                self._prefill([seq], past)
+        for bucket in _length_buckets(fresh):
+            self._prefill(bucket)
+
+    @torch.no_grad()
+    def _prefill(self, seqs: List[Sequence], past=None):
+        """Run prompts (or a cached prompt's suffix) through the model and
+        sample each sequence's first token."""
+        suffixes = [s.prompt_ids[s.cached_tokens:] for s in seqs]
+        width = max(len(t) for t in suffixes)
+        started = time.monotonic()
+        try:
+            input_ids = torch.tensor([[0] * (width - len(t)) + t for t in suffixes], device=self._device)
+            if len(seqs) == 1:
+                out = self.model(input_ids=input_ids, past_key_values=past, use_cache=True)
+            else:
+                pad_mask = (torch.arange(width, device=self._device)
+                            >= torch.tensor([width - len(t) for t in suffixes], device=self._device).unsqueeze(1)).long()
+                out = self.model(
+                    input_ids=input_ids,
+                    attention_mask=pad_mask,
+                    position_ids=(pad_mask.cumsum(dim=1) - 1).clamp(min=0),
+                    use_cache=True,
+                )
+            tokens = _sample(
+                out.logits[:, -1, :],
+                [s.params.temperature for s in seqs],
+                [s.generator for s in seqs],
+            ).tolist()
+        except Exception as exc:
+            log.exception("prefill_failed", request_ids=[s.request_id for s in seqs])
+            for seq in seqs:
+                self._fail(seq, exc)
+            return
+
+        elapsed = time.monotonic() - started  # .tolist() above waited for the device
+        cached_len = out.past_key_values[0][0].shape[2]
+        merge = []
+        for i, (seq, token) in enumerate(zip(seqs, tokens)):
+            seq.prefill_seconds = elapsed
+            self._append(seq, token)
+            length = len(seq.prompt_ids)
+            if seq.finished:
+                self._remember(seq, out.past_key_values, i, length)
+                self._resolve(seq)
+            elif seq.params.speculation != "off" and seq.params.temperature <= 0:
+                row = tuple((k[i:i + 1, :, -length:], v[i:i + 1, :, -length:]) for k, v in out.past_key_values)
+                seq.spec = SpecState(mode=seq.params.speculation, past=row)
+                self._speculating.append(seq)
+            else:
+                merge.append(i)
+        if not merge:
+            return
+        idx = torch.tensor(merge, device=self._device)
+        rows = tuple(
+            (k.index_select(0, idx.to(k.device)), v.index_select(0, idx.to(v.device)))
+            for k, v in out.past_key_values
+        )
+        mask = torch.stack([
+            _pad_left(torch.ones(len(seqs[i].prompt_ids), dtype=torch.long, device=self._device),
+                      cached_len - len(seqs[i].prompt_ids), 0)
+            for i in merge
+        ])
+        self._merge(rows, mask)
+        self._active.extend(seqs[i] for i in merge)
+
+    @torch.no_grad()
+    def _step(self):
+        active = self._active
+        input_ids = torch.tensor([[s.output_ids[-1]] for s in active], device=self._device)
+        # Position of the new token is the number of real tokens already cached.
+        position_ids = self._mask.sum(dim=1, keepdim=True)
+        self._mask = torch.cat([self._mask, self._mask.new_ones((len(active), 1))], dim=1)
+        out = self.decode_model(
+            input_ids=input_ids,
+            attention_mask=self._mask,
+            position_ids=position_ids,
+            past_key_values=self._past.model_past(),
+            use_cache=True,
+        )
+        self._past.absorb(out.past_key_values)
+        tokens = _sample(
+            out.logits[:, -1, :],
+            [s.params.temperature for s in active],
+            [s.generator for s in active],
+        ).tolist()
+
+        keep = []
+        for i, (seq, token) in enumerate(zip(active, tokens)):
+            self._append(seq, token)
+            if seq.finished:
+                length = int(self._mask[i].sum())
+                if self.prefix_cache is not None:
+                    self._remember(seq, self._past.row(i, length), 0, length)
+                self._resolve(seq)
+            else:
+                keep.append(i)
+        if len(keep) < len(active):
+            self._retain(keep)
+
+    def _reap(self):
+        """Stop cancelled and overdue sequences before the next decode step."""
+        now = time.monotonic()
+        keep = []
+        for i, seq in enumerate(self._active):
+            reason = seq.stop_reason(now)
+            if reason is None:
+                keep.append(i)
+            else:
+                self._cancel(seq, reason)
+        if len(keep) < len(self._active):
+            self._retain(keep)
+        speculating = []
+        for seq in self._speculating:
+            reason = seq.stop_reason(now)
+            if reason is None:
+                speculating.append(seq)
+            else:
+                self._cancel(seq, reason)
+        self._speculating = speculating
+
+    def _cancel(self, seq: Sequence, reason: str):
+        seq.finish_reason = reason
+        self.cancelled[reason] = self.cancelled.get(reason, 0) + 1
+        saved = max(seq.params.max_new_tokens - len(seq.output_ids), 0)
+        self.cancelled_tokens_saved[reason] = self.cancelled_tokens_saved.get(reason, 0) + saved
+        self._resolve(seq)
+
+    def _speculate(self):
+        keep = []
+        for seq in self._speculating:
+            try:
+                self._spec_step(seq)
+            except Exception as exc:
+                log.exception("speculative_step_failed", request_id=seq.request_id)
+                self._fail(seq, exc)
+                continue
+            if seq.finished:
+                # The verified KV can run past an EOS that ended the sequence.
+                length = min(seq.spec.past[0][0].shape[2], len(seq.prompt_ids) + len(seq.output_ids))
+                self._remember(seq, crop_past(seq.spec.past, length), 0, length)
+                self._resolve(seq)
+            else:
+                keep.append(seq)
+        self._speculating = keep
+
+    @torch.no_grad()
+    def _spec_step(self, seq: Sequence):
+        """Propose tokens for one speculating sequence and verify them in one pass."""
+        spec = seq.spec
+        proposer = self._proposers[spec.mode]
+        ids = seq.prompt_ids + seq.output_ids
+        # Leave room for the token the target adds after the accepted guesses.
+        limit = seq.params.max_new_tokens - len(seq.output_ids) - 1
+        proposal = proposer.propose(ids, spec, limit)
+        tokens = verify(self.model, ids, spec, proposal)
+        accepted = len(tokens) - 1
+        proposer.accept(spec, len(ids) + accepted)
+
+        stats = self.spec_stats[spec.mode]
+        stats.steps += 1
+        stats.proposed += len(proposal)
+        stats.accepted += accepted
+        for token in tokens:
+            self._append(seq, token)
+            stats.emitted += 1
+            if seq.finished:
+                break
+
+    # -- sequence bookkeeping ---------------------------------------------
+    def _append(self, seq: Sequence, token: int):
+        if self.eos_token_id is not None and token == self.eos_token_id:
+            self._stop_early(seq, "eos")
+            return
+        seq.output_ids.append(token)
+        seq.token_times.append(time.monotonic())
+        if seq.stream is not None:
+            seq.stream.put(token)
+        if seq.stop_matcher is not None:
+            seq.stop_matcher.push(seq.detokenizer.push(token))
+            if seq.stop_matcher.matched is not None:
+                self._stop_early(seq, "stop_sequence")
+                return
+        if len(seq.output_ids) >= seq.params.max_new_tokens:
+            seq.finish_reason = "length"
+
+    def _stop_early(self, seq: Sequence, reason: str):
+        seq.finish_reason = "stop"
+        self.early_stops[reason] = self.early_stops.get(reason, 0) + 1
+        saved = max(seq.params.max_new_tokens - len(seq.output_ids), 0)
+        self.early_stop_steps_saved[reason] = self.early_stop_steps_saved.get(reason, 0) + saved
+
+    def _remember(self, seq: Sequence, past, row: int, length: int):
+        """Copy the KV of a finished sequence (its last ``length`` cached
+        positions in batch row ``row``) into the prefix cache."""
+        if self.prefix_cache is None:
+            return
+        ids = (seq.prompt_ids + seq.output_ids)[:length]
+        self.prefix_cache.store(
+            ids,
+            tuple(
+                (k[row:row + 1, :, -length:].clone(), v[row:row + 1, :, -length:].clone())
+                for k, v in past
+            ),
+        )
+
+    def _resolve(self, seq: Sequence):
+        seq.finished_at = time.monotonic()
+        if seq.stream is not None:
+            seq.stream.close()
+        if not seq.future.done():
+            seq.future.set_result(seq)
+
+    def _fail(self, seq: Sequence, exc: BaseException):
+        seq.finished_at = time.monotonic()
+        if seq.stream is not None:
+            seq.stream.close(exc)
+        if not seq.future.done():
+            seq.future.set_exception(exc)
+
+    def _fail_active(self, exc: BaseException):
+        for seq in self._active:
+            self._fail(seq, exc)
+        self._active = []
+        self._past = None
+        self._mask = None
+
+    # -- batched KV cache maintenance ------------------------------------
+    def _merge(self, past, mask: torch.Tensor):
+        """Append prefilled sequences (a full-precision legacy tuple) to the left-padded batch cache."""
+        if self._past is None:
+            self._past = new_batch_cache(self.kv_cache_mode, self.kv_cache_block)
+            self._past.merge(past, 0, 0)
+            self._mask = mask
+            return
+        batch_len, new_len = self._mask.shape[1], mask.shape[1]
+        target = max(batch_len, new_len)
+        self._past.merge(past, target - batch_len, target - new_len)
+        self._mask = torch.cat(
+            [_pad_left(self._mask, target - batch_len, 1), _pad_left(mask, target - new_len, 1)]
+        )
+
+    def _retain(self, keep: List[int]):
+        """Drop finished rows and any leading columns that are now all padding."""
+        self._active = [self._active[i] for i in keep]
+        if not keep:
+            self._past = None
+            self._mask = None
+            return
+        idx = torch.tensor(keep, device=self._mask.device)
+        mask = self._mask.index_select(0, idx)
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+        self._mask = mask[:, start:]
+        self._past.retain(idx, start)
@@ -0,0 +1,42 @@
+"""Gunicorn settings for multi-worker serving.
+
+    gunicorn -c gunicorn.conf.py main:app
+
+``WEB_CONCURRENCY`` sets the number of workers. Each worker runs its own
+batch scheduler. To keep per-worker state consistent across workers:
+
+* ``WEIGHTS_CACHE_DIR`` (with ``DEVICE=cpu``) shares one memory-mapped copy
+  of the weights between workers;
+* ``RATE_LIMIT_STORAGE_URI=sqlite:///...`` (one node) or ``redis://...``
+  shares rate-limit counters;
+* ``PROMETHEUS_MULTIPROC_DIR`` makes ``/metrics`` aggregate every worker.
+"""
+
+import os
+import shutil
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+
+def on_starting(server):
+    # Files left by a previous run would be merged into the new totals.
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def post_fork(server, worker):
+    # Split the cores between workers unless CPU_THREADS was set explicitly.
+    if workers > 1 and os.getenv("CPU_THREADS", "0") == "0":
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+        os.environ["CPU_THREADS"] = str(max(1, cores // workers))
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,288 @@
+"""Storage for the decode batch's KV cache.
+
+The batch scheduler keeps one left-padded KV cache for every sequence in its
+decode batch, and how that cache is stored is what limits how many
+sequences fit in memory. ``KV_CACHE_MODE`` selects one of:
+
+``dynamic``
+    Full-precision tensors, extended with ``torch.cat`` on every decode step
+    (the transformers default). Each step reallocates and copies the whole
+    cache.
+``static``
+    Full-precision buffers pre-allocated ``block`` positions at a time.
+    Decode steps write the new position in place, so the cache is only
+    copied once every ``block`` steps. This uses the same memory as
+    ``dynamic`` (plus up to a block per row) with far less allocator churn.
+``int8`` / ``int4``
+    Keys and values quantized per vector (``int8``) or per group of 32
+    channels with a zero point (``int4``, two values per byte). Each layer
+    is dequantized only for its own attention call, so at most one layer's
+    full-precision KV exists at a time. Expect roughly 2x (``int8`` vs bf16)
+    to 4x (``int4`` vs bf16, ``int8`` vs fp32) more sequences per byte, for
+    a small loss of accuracy on long generations.
+``offload``
+    Full-precision KV kept in host memory and copied to the accelerator one
+    layer at a time. This is for very long prompts on GPUs whose memory, not
+    compute, is the limit. On CPU it changes nothing.
+
+Prefill always runs with a full-precision cache, and new rows are converted
+when they join the batch. The prefix cache and speculating sequences keep
+full-precision caches.
+
+The non-``dynamic`` modes plug into the model as a transformers ``Cache``,
+whose ``update`` is called by every attention layer.
+"""
+
+from typing import Dict, List, Optional, Tuple, Type
+
+import torch
+from transformers.cache_utils import Cache
+
+PastKeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+Parts = List[torch.Tensor]  # one stored tensor, encoded; every part is [batch, heads, positions, x]
+
+INT4_GROUP = 32
+
+
+def pad_left(t: torch.Tensor, pad: int, dim: int) -> torch.Tensor:
+    if pad == 0:
+        return t
+    shape = list(t.shape)
+    shape[dim] = pad
+    return torch.cat([t.new_zeros(shape), t], dim=dim)
+
+
+class BatchKVCache(Cache):
+    """The scheduler's batch KV cache: per layer, encoded key and value parts.
+
+    The base class stores keys and values unchanged. Subclasses override
+    ``_encode``/``_decode`` (how a tensor is stored), ``_fetch`` (where it is
+    read from) and the storage hooks ``_views``/``_assign``/``_append``.
+    """
+
+    mode = "dynamic"
+
+    def __init__(self, block: int = 256):
+        self.block = block
+        self.keys: List[Parts] = []
+        self.values: List[Parts] = []
+        self.dtype: Optional[torch.dtype] = None  # of the full-precision tensors
+
+    # -- encoding ----------------------------------------------------------
+    def _encode(self, t: torch.Tensor) -> Parts:
+        return [t]
+
+    def _decode(self, parts: Parts) -> torch.Tensor:
+        return parts[0]
+
+    def _fetch(self, parts: Parts) -> Parts:
+        return parts
+
+    # -- storage -----------------------------------------------------------
+    def _views(self, layer_idx: int) -> Tuple[Parts, Parts]:
+        """The stored parts of a layer, covering exactly the cached positions."""
+        return self.keys[layer_idx], self.values[layer_idx]
+
+    def _assign(self, keys: List[Parts], values: List[Parts]):
+        self.keys, self.values = keys, values
+
+    def _append(self, layer_idx: int, key: torch.Tensor, value: torch.Tensor):
+        for stored, new in ((self.keys, key), (self.values, value)):
+            stored[layer_idx] = [torch.cat([p, n], dim=2) for p, n in zip(stored[layer_idx], self._encode(new))]
+
+    # -- batch maintenance (scheduler thread) ------------------------------
+    def merge(self, past: PastKeyValues, pad_self: int, pad_new: int):
+        """Append the rows of a full-precision ``past``, padding both sides on the left."""
+        self.dtype = past[0][0].dtype
+        merged: Tuple[List[Parts], List[Parts]] = ([], [])
+        for layer_idx, (key, value) in enumerate(past):
+            old = self._views(layer_idx) if self.keys else ([], [])
+            for side, new, out in zip(old, (key, value), merged):
+                new_parts = [pad_left(p, pad_new, 2) for p in self._encode(new)]
+                if side:
+                    new_parts = [torch.cat([pad_left(o, pad_self, 2), n]) for o, n in zip(side, new_parts)]
+                out.append(new_parts)
+        self._assign(*merged)
+
+    def retain(self, rows: torch.Tensor, start: int):
+        """Keep the batch rows ``rows``, dropping the first ``start`` positions."""
+        kept: Tuple[List[Parts], List[Parts]] = ([], [])
+        for layer_idx in range(len(self.keys)):
+            for side, out in zip(self._views(layer_idx), kept):
+                out.append([p.index_select(0, rows.to(p.device))[:, :, start:] for p in side])
+        self._assign(*kept)
+
+    def row(self, index: int, length: int) -> PastKeyValues:
+        """Full-precision KV of the last ``length`` positions of one row."""
+        out = []
+        for layer_idx in range(len(self.keys)):
+            k, v = (
+                self._decode(self._fetch([p[index:index + 1, :, p.shape[2] - length:] for p in side]))
+                for side in self._views(layer_idx)
+            )
+            out.append((k, v))
+        return tuple(out)
+
+    def model_past(self):
+        """What to pass to the model as ``past_key_values`` for a decode step."""
+        return self
+
+    def absorb(self, past):
+        """Take the model's returned ``past_key_values`` after a decode step."""
+
+    @property
+    def nbytes(self) -> int:
+        return sum(p.numel() * p.element_size() for side in (self.keys, self.values) for parts in side for p in parts)
+
+    @property
+    def rows(self) -> int:
+        return self.keys[0][0].shape[0] if self.keys else 0
+
+    # -- transformers ``Cache`` API (model thread, one call per layer) -------
+    def update(self, key_states, value_states, layer_idx: int, cache_kwargs=None):
+        past_k, past_v = (self._decode(self._fetch(side)) for side in self._views(layer_idx))
+        self._append(layer_idx, key_states, value_states)
+        return (
+            torch.cat([past_k.to(key_states.dtype), key_states], dim=2),
+            torch.cat([past_v.to(value_states.dtype), value_states], dim=2),
+        )
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        if len(self.keys) <= layer_idx:
+            return 0
+        return self._views(layer_idx)[0][0].shape[2]
+
+    def get_max_length(self) -> Optional[int]:
+        return None
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+
+class DynamicBatchCache(BatchKVCache):
+    """The default: a legacy tuple cache, handed to and taken from the model as is."""
+
+    mode = "dynamic"
+
+    def model_past(self):
+        return tuple((k[0], v[0]) for k, v in zip(self.keys, self.values))
+
+    def absorb(self, past):
+        self.keys = [[k] for k, _ in past]
+        self.values = [[v] for _, v in past]
+
+
+class StaticBatchCache(BatchKVCache):
+    """Full precision, in buffers with spare capacity for ``block`` more positions."""
+
+    mode = "static"
+
+    def __init__(self, block: int = 256):
+        super().__init__(block)
+        self._filled: List[int] = []  # positions in use, per layer
+
+    def _views(self, layer_idx):
+        n = self._filled[layer_idx]
+        return [self.keys[layer_idx][0][:, :, :n]], [self.values[layer_idx][0][:, :, :n]]
+
+    def _buffer(self, t: torch.Tensor) -> torch.Tensor:
+        capacity = (t.shape[2] // self.block + 1) * self.block
+        buf = t.new_zeros(t.shape[:2] + (capacity,) + t.shape[3:])
+        buf[:, :, :t.shape[2]] = t
+        return buf
+
+    def _assign(self, keys, values):
+        self.keys = [[self._buffer(k[0])] for k in keys]
+        self.values = [[self._buffer(v[0])] for v in values]
+        self._filled = [k[0].shape[2] for k in keys]
+
+    def _append(self, layer_idx, key, value):
+        n, new = self._filled[layer_idx], key.shape[2]
+        for stored, states in ((self.keys, key), (self.values, value)):
+            buf = stored[layer_idx][0]
+            if n + new > buf.shape[2]:
+                buf = stored[layer_idx][0] = self._buffer(buf[:, :, :n])
+            buf[:, :, n:n + new] = states
+        self._filled[layer_idx] = n + new
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        self._append(layer_idx, key_states, value_states)
+        k, v = self._views(layer_idx)
+        return k[0], v[0]
+
+
+class Int8BatchCache(BatchKVCache):
+    """Symmetric int8 per (row, head, position) vector, with its scale."""
+
+    mode = "int8"
+
+    def _encode(self, t):
+        scale = t.float().abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / 127
+        q = (t.float() / scale).round().clamp(-127, 127).to(torch.int8)
+        return [q, scale.to(t.dtype)]
+
+    def _decode(self, parts):
+        q, scale = parts
+        return (q.float() * scale.float()).to(self.dtype)
+
+
+class Int4BatchCache(BatchKVCache):
+    """Asymmetric 4-bit per group of ``INT4_GROUP`` channels, two values per byte."""
+
+    mode = "int4"
+
+    @staticmethod
+    def _group(dim: int) -> int:
+        return INT4_GROUP if dim % INT4_GROUP == 0 else dim
+
+    def _encode(self, t):
+        dim = t.shape[-1]
+        if dim % 2:
+            raise ValueError(f"int4 KV cache needs an even head dimension, got {dim}")
+        g = t.float().unflatten(-1, (dim // self._group(dim), self._group(dim)))
+        low = g.amin(dim=-1, keepdim=True)
+        scale = (g.amax(dim=-1, keepdim=True) - low).clamp(min=1e-8) / 15
+        q = ((g - low) / scale).round().clamp(0, 15).to(torch.uint8).flatten(-2)
+        packed = q[..., 0::2] | (q[..., 1::2] << 4)
+        return [packed, scale.squeeze(-1).to(t.dtype), low.squeeze(-1).to(t.dtype)]
+
+    def _decode(self, parts):
+        packed, scale, low = parts
+        q = torch.stack([packed & 0xF, packed >> 4], dim=-1).flatten(-2).float()
+        dim = q.shape[-1]
+        g = q.unflatten(-1, (dim // self._group(dim), self._group(dim)))
+        return (g * scale.float().unsqueeze(-1) + low.float().unsqueeze(-1)).flatten(-2).to(self.dtype)
+
+
+class OffloadBatchCache(BatchKVCache):
+    """Full precision in host memory, copied to the model's device per layer."""
+
+    mode = "offload"
+
+    def __init__(self, block: int = 256):
+        super().__init__(block)
+        self.device: Optional[torch.device] = None
+
+    def merge(self, past, pad_self, pad_new):
+        self.device = past[0][0].device
+        super().merge(past, pad_self, pad_new)
+
+    def _encode(self, t):
+        if t.device.type == "cpu":
+            return [t]
+        return [t.to("cpu")]
+
+    def _fetch(self, parts):
+        return [p.to(self.device, non_blocking=True) for p in parts]
+
+
+CACHE_MODES: Dict[str, Type[BatchKVCache]] = {
+    cls.mode: cls for cls in (DynamicBatchCache, StaticBatchCache, Int8BatchCache, Int4BatchCache, OffloadBatchCache)
+}
+
+
+def new_batch_cache(mode: str, block: int = 256) -> BatchKVCache:
+    try:
+        return CACHE_MODES[mode](block)
+    except KeyError:
+        raise ValueError(f"KV cache mode must be one of {', '.join(CACHE_MODES)}, got {mode!r}") from None
@@ -3,37 +3,149 @@
 Endpoints:
   POST /v1/chat/completions  (OpenAI compatible, SSE when {"stream": true})
   POST /v1/generate          (Simple generation + SSE parity)
+  POST /v1/generate/batch    (Many prompts in one request, batched generation)
+  POST /v1/embeddings        (OpenAI compatible, pooled hidden states of the loaded model)
+  GET  /v1/models            (Configured models and their residency)
   GET  /metrics              (Prometheus metrics)
+  GET  /healthz              (Liveness)
+  GET  /readyz               (Readiness: model loaded and warmed up)
 """
 
 from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional, Union
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 import os
 import time
 import structlog
+from prometheus_client import REGISTRY, Gauge
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 from prometheus_fastapi_instrumentator import Instrumentator, metrics
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
+import asyncio
 import json
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from .admission import (
+        PRIORITIES, FairQueue, QueueFull, RateLimited, Tenant, TokenLedger, estimate_tokens, load_tenants, retry_after, tenant_label,
+    )
+    from .chat_context import STRATEGIES as CONTEXT_STRATEGIES, ChatContext, render as render_chat
+    from .cpu_runtime import CompiledDecode, configure_cpu, load_dtype, prepare_cpu_model, resolve_precision
+    from .embeddings import POOLING, Embedder, EmbeddingCache, cache_key, encode_base64
+    from .engine import BatchScheduler, IncrementalDetokenizer, QueueFullError, SamplingParams
+    from .mock_engine import MockCausalLM, MockTokenizer
+    from .prefix_cache import PrefixCache
+    from .registry import ModelRegistry, UnknownModelError
+    from .response_cache import InflightDeduplicator, ResponseCache, request_key
+    from .shared_weights import load_shared
+    from .sse import DONE, ChatStreamEncoder, TextStreamEncoder, coalesce, dumps as json_bytes, event, gzip_frames
+    from .stop_sequences import StopMatcher, default_stops, merge_stops, truncate as truncate_at_stop
+    from . import rate_limit_store  # noqa: F401  (registers the sqlite:// limits storage)
+except ImportError:  # executed as a top-level module (``uvicorn main:app``)
+    from admission import (
+        PRIORITIES, FairQueue, QueueFull, RateLimited, Tenant, TokenLedger, estimate_tokens, load_tenants, retry_after, tenant_label,
+    )
+    from chat_context import STRATEGIES as CONTEXT_STRATEGIES, ChatContext, render as render_chat
+    from cpu_runtime import CompiledDecode, configure_cpu, load_dtype, prepare_cpu_model, resolve_precision
+    from embeddings import POOLING, Embedder, EmbeddingCache, cache_key, encode_base64
+    from engine import BatchScheduler, IncrementalDetokenizer, QueueFullError, SamplingParams
+    from mock_engine import MockCausalLM, MockTokenizer
+    from prefix_cache import PrefixCache
+    from registry import ModelRegistry, UnknownModelError
+    from response_cache import InflightDeduplicator, ResponseCache, request_key
+    from shared_weights import load_shared
+    from sse import DONE, ChatStreamEncoder, TextStreamEncoder, coalesce, dumps as json_bytes, event, gzip_frames
+    from stop_sequences import StopMatcher, default_stops, merge_stops, truncate as truncate_at_stop
+    import rate_limit_store  # noqa: F401  (registers the sqlite:// limits storage)
 
 # ---------------------------------------------------------------------------
 # Environment configuration
 # ---------------------------------------------------------------------------
 MODEL_ID = os.getenv("MODEL_ID", "bigcode/starcoder2-3b")
+# Additional model ids that may be requested via the "model" field.
+MODEL_IDS = [MODEL_ID] + [
+    m.strip() for m in os.getenv("MODEL_IDS", "").split(",") if m.strip() and m.strip() != MODEL_ID
+]
+MODEL_MEMORY_BUDGET_MB = int(os.getenv("MODEL_MEMORY_BUDGET_MB", "0"))
+MAX_RESIDENT_MODELS = int(os.getenv("MAX_RESIDENT_MODELS", "0"))
+MODEL_LOAD_WAIT = float(os.getenv("MODEL_LOAD_WAIT", "60"))
 HF_TOKEN = os.getenv("HF_TOKEN")
 API_TOKEN = os.getenv("STARCODER2_API_TOKEN", "changeme")
 CORS_ORIGINS = os.getenv("CORS_ORIGINS", "*").split(",")
 MAX_NEW_TOKENS = int(os.getenv("MAX_NEW_TOKENS_LIMIT", "512"))
 RATE_LIMIT = os.getenv("RATE_LIMIT", "100/minute")
 USE_MOCK_GENERATION = os.getenv("USE_MOCK_GENERATION", "0") == "1"
+# Real scheduler and streaming over a timed stand-in model (see mock_engine.py).
+MOCK_ENGINE = os.getenv("MOCK_ENGINE", "0") == "1"
+MOCK_PREFILL_MS_PER_TOKEN = float(os.getenv("MOCK_PREFILL_MS_PER_TOKEN", "0.2"))
+MOCK_DECODE_MS_PER_TOKEN = float(os.getenv("MOCK_DECODE_MS_PER_TOKEN", "20"))
+MOCK_DECODE_BATCH_COST = float(os.getenv("MOCK_DECODE_BATCH_COST", "0.05"))
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "8"))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "64"))
+QUEUE_RETRY_AFTER = int(os.getenv("QUEUE_RETRY_AFTER", "2"))
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "2"))
+PREFIX_CACHE_MB = int(os.getenv("PREFIX_CACHE_MB", "512"))
+KV_CACHE_MODE = os.getenv("KV_CACHE_MODE", "dynamic")  # dynamic | static | int8 | int4 | offload
+KV_CACHE_BLOCK = int(os.getenv("KV_CACHE_BLOCK", "256"))  # static mode: positions pre-allocated at a time
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "0"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR") or None
+RESPONSE_CACHE_DISK_MB = int(os.getenv("RESPONSE_CACHE_DISK_MB", "1024"))  # 0 = unbounded
+WARMUP_PROMPT = os.getenv("WARMUP_PROMPT", "def hello_world():")
+WARMUP_TOKENS = int(os.getenv("WARMUP_TOKENS", "8"))
+# "auto" places fp16 weights with accelerate; "cpu" uses the CPU inference mode.
+DEVICE = os.getenv("DEVICE", "auto").lower()
+CPU_PRECISION = os.getenv("CPU_PRECISION", "bf16")  # fp32 | bf16 | int8
+CPU_THREADS = int(os.getenv("CPU_THREADS", "0"))  # 0 = one per pinned cpu, else torch default
+CPU_INTEROP_THREADS = int(os.getenv("CPU_INTEROP_THREADS", "0"))
+CPU_AFFINITY = os.getenv("CPU_AFFINITY", "")  # e.g. "0-15" or "node0"
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "0") == "1"
+# Small model sharing the tokenizer, used to propose tokens for speculative decoding.
+DRAFT_MODEL_ID = os.getenv("DRAFT_MODEL_ID", "")
+SPECULATIVE_TOKENS = int(os.getenv("SPECULATIVE_TOKENS", "4"))
+PROMPT_LOOKUP_NGRAM = int(os.getenv("PROMPT_LOOKUP_NGRAM", "3"))
+# Mode for requests that don't set "speculation": off | draft | prompt_lookup
+SPECULATION = os.getenv("SPECULATION", "off")
+MAX_BATCH_PROMPTS = int(os.getenv("MAX_BATCH_PROMPTS", "256"))
+# Multi-worker serving: shared rate-limit counters and memory-mapped CPU weights.
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")
+WEIGHTS_CACHE_DIR = os.getenv("WEIGHTS_CACHE_DIR", "")
+METRICS_MULTIPROC = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+METRICS_MIRROR_INTERVAL = float(os.getenv("METRICS_MIRROR_INTERVAL", "5"))
+# Default per-request generation deadline in seconds (0 = none); requests may set ``timeout``.
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "0"))
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.25"))
+# Chat history budget: 0 = the model's context length; always minus max_tokens.
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "0"))
+CHAT_CONTEXT_STRATEGY = os.getenv("CHAT_CONTEXT_STRATEGY", "system_recent")  # sliding_window | system_recent | middle
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "10000"))
+# Merge streamed tokens into one SSE event per window / size (0 = an event per token).
+SSE_COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", "0"))
+SSE_COALESCE_BYTES = int(os.getenv("SSE_COALESCE_BYTES", "0"))
+SSE_GZIP = os.getenv("SSE_GZIP", "0") == "1"  # gzip streams for clients sending Accept-Encoding: gzip
+# Built-in stops (chat role markers, open code blocks) on top of the request's ``stop``.
+DEFAULT_STOP_SEQUENCES = os.getenv("DEFAULT_STOP_SEQUENCES", "1") == "1"
+MAX_STOP_SEQUENCES = 4
+# Token-cost admission: per-API-token buckets priced in prompt + max_new_tokens.
+TENANTS_FILE = os.getenv("TENANTS_FILE", "")  # JSON: {"<api token>": {"name", "tokens_per_minute", "burst", "weight"}}
+TOKEN_RATE_LIMIT = float(os.getenv("TOKEN_RATE_LIMIT", "0"))  # tokens/minute for tokens not in TENANTS_FILE (0 = unlimited)
+TOKEN_BURST = float(os.getenv("TOKEN_BURST", "0"))  # bucket size (0 = one minute's worth)
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", "0"))  # generations let through per model (0 = 2 x MAX_BATCH_SIZE)
+# /v1/embeddings: pooled hidden states of the generation model, batched by length.
+EMBEDDING_POOLING = os.getenv("EMBEDDING_POOLING", "mean")  # mean | last
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "8192"))  # padded tokens per forward pass
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "")  # vectors on disk keyed by content hash (empty = off)
+MAX_EMBEDDING_INPUTS = int(os.getenv("MAX_EMBEDDING_INPUTS", "2048"))
 
 # ---------------------------------------------------------------------------
 # Logging
@@ -54,7 +166,15 @@ log = structlog.get_logger()
 # ---------------------------------------------------------------------------
 app = FastAPI(title="Starcoder2 API", version="1.0.0")
 security = HTTPBearer(auto_error=True)
-limiter = Limiter(key_func=get_remote_address)
+
+def _client_key(request: Request) -> str:
+    """Rate-limit key: the (hashed) API token, or the client address without one."""
+    scheme, _, credentials = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and credentials:
+        return tenant_label(credentials)
+    return get_remote_address(request)
+
+limiter = Limiter(key_func=_client_key, storage_uri=RATE_LIMIT_STORAGE_URI)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
@@ -69,43 +189,416 @@ app.add_middleware(
 # ---------------------------------------------------------------------------
 # Metrics
 # ---------------------------------------------------------------------------
-instrumentator = Instrumentator()
+instrumentator = Instrumentator(should_instrument_requests_inprogress=True)
 instrumentator.add(metrics.latency())
 instrumentator.add(metrics.requests())
 instrumentator.add(metrics.request_size())
 instrumentator.add(metrics.response_size())
-instrumentator.add(metrics.requests_in_progress())
 
 GEN_TOKENS = metrics.Counter(
     "starcoder2_tokens_generated_total",
     "Total tokens generated",
+    labelnames=("endpoint", "model")
+)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUEUE_WAIT = metrics.Histogram(
+    "starcoder2_queue_wait_seconds",
+    "Time requests spend waiting for a slot in the decode batch",
+    labelnames=("endpoint", "model"),
+    buckets=LATENCY_BUCKETS,
+)
+TOKENIZE_SECONDS = metrics.Histogram(
+    "starcoder2_tokenize_seconds",
+    "Time to tokenize a request's prompt(s), including the wait for a tokenizer thread",
+    labelnames=("endpoint", "model"),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+PREFILL_SECONDS = metrics.Histogram(
+    "starcoder2_prefill_seconds",
+    "Duration of the prefill forward pass a request was part of",
+    labelnames=("endpoint", "model"),
+    buckets=LATENCY_BUCKETS,
+)
+TIME_TO_FIRST_TOKEN = metrics.Histogram(
+    "starcoder2_time_to_first_token_seconds",
+    "Time from tokenization start to the first sampled token (tokenize + admission + queue + prefill)",
+    labelnames=("endpoint", "model"),
+    buckets=LATENCY_BUCKETS,
+)
+INTER_TOKEN_LATENCY = metrics.Histogram(
+    "starcoder2_inter_token_latency_seconds",
+    "Time between consecutive sampled tokens of a request",
+    labelnames=("endpoint", "model"),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1),
+)
+TOKENS_PER_SECOND = metrics.Histogram(
+    "starcoder2_generation_tokens_per_second",
+    "Per-request decode rate: completion tokens after the first, over the time they took",
+    labelnames=("endpoint", "model"),
+    buckets=(1, 2.5, 5, 10, 15, 20, 30, 50, 75, 100, 150, 250, 500),
+)
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+PROMPT_TOKENS = metrics.Histogram(
+    "starcoder2_prompt_tokens", "Prompt length of each request", labelnames=("endpoint", "model"), buckets=TOKEN_BUCKETS
+)
+COMPLETION_TOKENS = metrics.Histogram(
+    "starcoder2_completion_tokens", "Completion length of each request", labelnames=("endpoint", "model"),
+    buckets=TOKEN_BUCKETS,
+)
+ADMISSION_WAIT = metrics.Histogram(
+    "starcoder2_admission_wait_seconds",
+    "Time spent in the weighted fair queue before reaching the scheduler",
+    labelnames=("model", "priority"),
+    buckets=LATENCY_BUCKETS,
+)
+CONTEXT_DROPPED_TOKENS = metrics.Counter(
+    "starcoder2_chat_context_dropped_tokens_total",
+    "Chat history tokens dropped or truncated to fit the context budget",
+    labelnames=("model", "strategy")
+)
+CONTEXT_TRUNCATED = metrics.Counter(
+    "starcoder2_chat_context_truncated_total",
+    "Chat requests whose history was cut to fit the context budget",
+    labelnames=("model", "strategy")
+)
+EMBEDDING_INPUTS = metrics.Counter(
+    "starcoder2_embedding_inputs_total",
+    "Embedding inputs, by whether the vector was computed or read from the embedding cache",
+    labelnames=("model", "source")
+)
+EMBEDDING_BATCH_SECONDS = metrics.Histogram(
+    "starcoder2_embedding_batch_seconds",
+    "Duration of one embedding forward pass, including the wait for the embedding thread",
+    labelnames=("model",),
+    buckets=LATENCY_BUCKETS,
+)
+QUEUE_REJECTED = metrics.Counter(
+    "starcoder2_queue_rejected_total",
+    "Requests rejected because the inference queue was full",
     labelnames=("endpoint",)
 )
-instrumentator.add(GEN_TOKENS)
+MODEL_LOAD_SECONDS = Gauge(
+    "starcoder2_model_load_seconds", "Time taken to load tokenizer and weights", ("model",), multiprocess_mode="liveall"
+)
+MODEL_WARMUP_SECONDS = Gauge(
+    "starcoder2_model_warmup_seconds", "Time taken by the warm-up generation", ("model",), multiprocess_mode="liveall"
+)
+MODEL_PRECISION = Gauge(
+    "starcoder2_model_precision", "Device and precision a model was loaded with", ("model", "device", "precision"),
+    multiprocess_mode="livemax",
+)
+
+def _process_rss() -> int:
+    """Resident set size of this process in bytes (0 where unavailable)."""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+def _per_model(metric_cls, name, doc, values):
+    family = metric_cls(name, doc, labels=("model",))
+    for model_id, value in values:
+        family.add_metric((model_id,), value)
+    return family
+
+class EngineCollector:
+    """Export registry, scheduler and cache state at scrape time."""
+
+    def collect(self):
+        handles = registry.handles()
+        yield _per_model(GaugeMetricFamily, "starcoder2_model_ready", "1 once the model is loaded and warmed up",
+                         [(h.model_id, 1 if h.resident or USE_MOCK_GENERATION else 0) for h in handles])
+        yield _per_model(GaugeMetricFamily, "starcoder2_model_resident_bytes", "Memory footprint of resident models",
+                         [(h.model_id, h.nbytes if h.resident else 0) for h in handles])
+        yield GaugeMetricFamily("starcoder2_process_resident_bytes", "Resident set size of the serving process", value=_process_rss())
+        if torch.cuda.is_available():
+            yield GaugeMetricFamily("starcoder2_device_memory_allocated_bytes", "CUDA memory held by tensors",
+                                    value=torch.cuda.memory_allocated())
+        yield CounterMetricFamily("starcoder2_model_loads", "Models paged in by the registry", value=registry.loads)
+        yield CounterMetricFamily("starcoder2_model_evictions", "Models evicted by the registry", value=registry.evictions)
+        # Snapshot the schedulers: a model may be evicted while we scrape.
+        resident = [(h.model_id, h.scheduler) for h in handles]
+        resident = [(mid, s) for mid, s in resident if s is not None]
+        yield _per_model(GaugeMetricFamily, "starcoder2_queue_depth", "Requests waiting for a slot in the decode batch",
+                         [(mid, s.queue_depth) for mid, s in resident])
+        yield _per_model(GaugeMetricFamily, "starcoder2_batch_size", "Sequences in the current decode batch",
+                         [(mid, s.batch_size) for mid, s in resident])
+        for name, doc, values in (
+            ("starcoder2_tenant_tokens", "Prompt + completion tokens settled against each tenant", ledger.tokens),
+            ("starcoder2_tenant_rate_limited", "Requests refused with 429 by the tenant's token bucket", ledger.rejected),
+        ):
+            family = CounterMetricFamily(name, doc, labels=("tenant",))
+            for tenant, value in dict(values).items():
+                family.add_metric((tenant,), value)
+            yield family
+        family = GaugeMetricFamily("starcoder2_admission_queue_depth", "Requests waiting in the fair queue", labels=("model", "priority"))
+        for mid, queue in list(_fair_queues.items()):
+            for priority in PRIORITIES:
+                family.add_metric((mid, priority), queue.waiting(priority))
+        yield family
+        for name, doc, attr in (
+            ("starcoder2_kv_cache_bytes", "Memory held by the decode batch's KV cache", "kv_cache_bytes"),
+            ("starcoder2_kv_cache_bytes_per_sequence", "Decode batch KV cache bytes per sequence in the batch", "kv_cache_bytes_per_sequence"),
+        ):
+            family = GaugeMetricFamily(name, doc, labels=("model", "mode"))
+            for mid, s in resident:
+                family.add_metric((mid, s.kv_cache_mode), getattr(s, attr))
+            yield family
+        for name, doc, attr in (
+            ("starcoder2_cancelled_requests", "Generations stopped early, by reason", "cancelled"),
+            ("starcoder2_cancelled_tokens_saved", "Tokens of max_new_tokens left ungenerated by cancellation", "cancelled_tokens_saved"),
+            ("starcoder2_early_stops", "Generations ended before max_new_tokens by EOS or a stop sequence", "early_stops"),
+            ("starcoder2_early_stop_steps_saved", "Decode steps of max_new_tokens not run because of an early stop", "early_stop_steps_saved"),
+        ):
+            family = CounterMetricFamily(name, doc, labels=("model", "reason"))
+            for mid, s in resident:
+                for reason, value in dict(getattr(s, attr)).items():
+                    family.add_metric((mid, reason), value)
+            yield family
+
+        if response_cache is not None:
+            for name, doc, value in (
+                ("starcoder2_response_cache_hits", "Deterministic requests answered from the response cache", response_cache.hits),
+                ("starcoder2_response_cache_misses", "Deterministic requests not found in the response cache", response_cache.misses),
+                ("starcoder2_inflight_dedup", "Requests attached to an identical generation already running", inflight.attached),
+            ):
+                yield CounterMetricFamily(name, doc, value=value)
+            yield GaugeMetricFamily("starcoder2_response_cache_entries", "Results held in memory by the response cache", value=len(response_cache))
+        spec = [(mid, mode, st) for mid, s in resident for mode, st in s.spec_stats.items()]
+        for name, doc, attr in (
+            ("starcoder2_speculative_steps", "Target forward passes that verified speculated tokens", "steps"),
+            ("starcoder2_speculative_proposed_tokens", "Tokens proposed by the draft model or prompt lookup", "proposed"),
+            ("starcoder2_speculative_accepted_tokens", "Proposed tokens accepted by the target model", "accepted"),
+            ("starcoder2_speculative_emitted_tokens", "Tokens produced by speculative verification steps", "emitted"),
+        ):
+            family = CounterMetricFamily(name, doc, labels=("model", "mode"))
+            for mid, mode, st in spec:
+                family.add_metric((mid, mode), getattr(st, attr))
+            yield family
+        for name, doc, attr in (
+            ("starcoder2_speculative_acceptance_rate", "Accepted / proposed tokens since start", "acceptance_rate"),
+            ("starcoder2_speculative_tokens_per_step", "Tokens per target forward pass (speedup over plain decoding)", "tokens_per_step"),
+        ):
+            family = GaugeMetricFamily(name, doc, labels=("model", "mode"))
+            for mid, mode, st in spec:
+                family.add_metric((mid, mode), getattr(st, attr))
+            yield family
+
+        caches = [(mid, s.prefix_cache) for mid, s in resident if s.prefix_cache is not None]
+        for name, doc, attr in (
+            ("starcoder2_prefix_cache_hits", "Prompts that reused cached prefix KV", "hits"),
+            ("starcoder2_prefix_cache_misses", "Prompts with no reusable cached prefix", "misses"),
+            ("starcoder2_prefix_cache_reused_tokens", "Prompt tokens served from the prefix cache", "reused_tokens"),
+            ("starcoder2_prefix_cache_evicted_bytes", "Bytes of KV evicted from the prefix cache", "evicted_bytes"),
+        ):
+            yield _per_model(CounterMetricFamily, name, doc, [(mid, getattr(c, attr)) for mid, c in caches])
+        yield _per_model(GaugeMetricFamily, "starcoder2_prefix_cache_bytes", "Bytes of KV held by the prefix cache",
+                         [(mid, c.total_bytes) for mid, c in caches])
+        yield _per_model(GaugeMetricFamily, "starcoder2_prefix_cache_entries", "Sequences held by the prefix cache",
+                         [(mid, len(c)) for mid, c in caches])
 
 # ---------------------------------------------------------------------------
-# Model loading (skipped in mock mode)
+# Model loading (background threads; skipped in mock mode)
 # ---------------------------------------------------------------------------
-tokenizer = None
-model = None
-if not USE_MOCK_GENERATION:
-    log.info("loading_model", model_id=MODEL_ID, mock=USE_MOCK_GENERATION)
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_ID, token=HF_TOKEN)
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_ID,
+# Tokenization and detokenization run here so they never block the event loop;
+# the forward passes themselves run on each model's scheduler thread.
+if DEVICE == "cpu" and not USE_MOCK_GENERATION:
+    # Before any thread or tensor work, so pools and weights land on the pinned cpus.
+    configure_cpu(CPU_AFFINITY, CPU_THREADS, CPU_INTEROP_THREADS)
+executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+# Embedding forward passes, one at a time, next to (not inside) the decode loop.
+embedding_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+
+def _load_weights(model_id: str):
+    """Load a causal LM for the configured device; returns ``(model, precision)``."""
+    # safetensors checkpoints are memory-mapped and materialized per shard
+    # instead of being read into a full CPU copy first.
+    if DEVICE == "cpu":
+        precision = resolve_precision(CPU_PRECISION)
+        def load():
+            return AutoModelForCausalLM.from_pretrained(
+                model_id,
+                token=HF_TOKEN,
+                torch_dtype=load_dtype(precision),
+                low_cpu_mem_usage=True,
+            )
+        if WEIGHTS_CACHE_DIR:
+            # One page-cache copy of the weights for every worker on the node.
+            if precision == "int8":
+                # quantize_dynamic repacks every Linear into private int8 memory.
+                log.warning("shared_weights_not_shared_with_int8", model_id=model_id)
+            mdl = load_shared(model_id, load_dtype(precision), WEIGHTS_CACHE_DIR, load, token=HF_TOKEN)
+        else:
+            mdl = load()
+        return prepare_cpu_model(mdl, precision), precision
+    mdl = AutoModelForCausalLM.from_pretrained(
+        model_id,
         token=HF_TOKEN,
         torch_dtype=torch.float16,
-        device_map="auto"
+        device_map="auto",
+        low_cpu_mem_usage=True,
+    )
+    return mdl.eval(), "fp16"
+
+def _load_draft(model_id: str, tok):
+    """Load ``DRAFT_MODEL_ID`` for ``model_id``, or None if unset or incompatible."""
+    if not DRAFT_MODEL_ID or DRAFT_MODEL_ID == model_id:
+        return None
+    draft_tok = AutoTokenizer.from_pretrained(DRAFT_MODEL_ID, token=HF_TOKEN)
+    if draft_tok.get_vocab() != tok.get_vocab():
+        log.warning("draft_model_vocab_mismatch", model_id=model_id, draft_model_id=DRAFT_MODEL_ID)
+        return None
+    draft, _ = _load_weights(DRAFT_MODEL_ID)
+    return draft
+
+def _load_model(model_id: str):
+    """Load one model, start its scheduler and run the warm-up generation.
+
+    Called by the registry on a background thread, so the port binds
+    immediately and other models keep serving while one pages in. The model
+    only counts as resident (and ``/readyz`` only passes for the default
+    model) once the warm-up has completed.
+    """
+    started = time.perf_counter()
+    log.info("loading_model", model_id=model_id, mock=MOCK_ENGINE)
+    if MOCK_ENGINE:
+        tok = MockTokenizer()
+        mdl, precision = MockCausalLM(
+            MOCK_PREFILL_MS_PER_TOKEN / 1000, MOCK_DECODE_MS_PER_TOKEN / 1000, MOCK_DECODE_BATCH_COST
+        ), "mock"
+        draft = None
+    else:
+        tok = AutoTokenizer.from_pretrained(model_id, token=HF_TOKEN)
+        mdl, precision = _load_weights(model_id)
+        draft = _load_draft(model_id, tok)
+    MODEL_PRECISION.labels(model_id, DEVICE, precision).set(1)
+    sched = BatchScheduler(
+        mdl,
+        tok.eos_token_id,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_queue_size=MAX_QUEUE_SIZE,
+        prefix_cache=PrefixCache(PREFIX_CACHE_MB * 1024 * 1024) if PREFIX_CACHE_MB > 0 else None,
+        # Compiled on the first decode step, i.e. during warm-up. Only the
+        # dynamic KV cache is a plain tuple the compiled graph can take.
+        decode_model=CompiledDecode(mdl) if TORCH_COMPILE and not MOCK_ENGINE and KV_CACHE_MODE == "dynamic" else None,
+        draft_model=draft,
+        speculative_tokens=SPECULATIVE_TOKENS,
+        prompt_lookup_ngram=PROMPT_LOOKUP_NGRAM,
+        tokenizer=tok,
+        kv_cache_mode=KV_CACHE_MODE,
+        kv_cache_block=KV_CACHE_BLOCK,
     )
+    sched.start()
+    load_seconds = time.perf_counter() - started
+    MODEL_LOAD_SECONDS.labels(model_id).set(load_seconds)
+
+    started = time.perf_counter()
+    if WARMUP_TOKENS > 0:
+        warmup = SamplingParams(max_new_tokens=WARMUP_TOKENS, temperature=0.0)
+        try:
+            sched.submit(tok(WARMUP_PROMPT)["input_ids"], warmup).future.result()
+        except Exception:
+            sched.stop()
+            raise
+    warmup_seconds = time.perf_counter() - started
+    MODEL_WARMUP_SECONDS.labels(model_id).set(warmup_seconds)
+    log.info("model_ready", model_id=model_id, device=DEVICE, precision=precision,
+             load_seconds=load_seconds, warmup_seconds=warmup_seconds)
+    return tok, mdl, sched
+
+registry = ModelRegistry(
+    MODEL_IDS,
+    _load_model,
+    memory_budget=MODEL_MEMORY_BUDGET_MB * 1024 * 1024,
+    max_resident=MAX_RESIDENT_MODELS,
+    pinned=(MODEL_ID,),
+)
+
+@app.on_event("startup")
+def _start_model_loading():
+    if not USE_MOCK_GENERATION:
+        registry.ensure_loaded(MODEL_ID)
+
+response_cache = (
+    ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DIR, RESPONSE_CACHE_DISK_MB * 1024 * 1024)
+    if RESPONSE_CACHE_SIZE > 0 else None
+)
+inflight = InflightDeduplicator()
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_DIR) if EMBEDDING_CACHE_DIR else None
+ledger = TokenLedger(load_tenants(TENANTS_FILE), Tenant("default", TOKEN_RATE_LIMIT, TOKEN_BURST))
+# model id -> weighted fair queue in front of that model's scheduler
+_fair_queues = {}
+
+REGISTRY.register(EngineCollector())
+
+class MultiprocessMirror:
+    """Publish ``EngineCollector`` output as multiprocess-mode gauges.
+
+    With ``PROMETHEUS_MULTIPROC_DIR`` set, ``/metrics`` reads the files each
+    worker writes rather than calling collectors, so scrape-time state would
+    be missing. Every worker copies it into gauges every
+    ``METRICS_MIRROR_INTERVAL`` seconds instead. Counters are summed across
+    live workers; gauges keep a ``pid`` label.
+    """
+
+    def __init__(self, collector):
+        self.collector = collector
+        self._gauges = {}
+
+    def publish(self):
+        for family in self.collector.collect():
+            for sample in family.samples:
+                if sample.name.endswith("_created"):
+                    continue
+                gauge = self._gauges.get(sample.name)
+                if gauge is None:
+                    mode = "livesum" if family.type == "counter" else "liveall"
+                    gauge = self._gauges[sample.name] = Gauge(
+                        sample.name, family.documentation, tuple(sample.labels),
+                        registry=None, multiprocess_mode=mode,
+                    )
+                (gauge.labels(**sample.labels) if sample.labels else gauge).set(sample.value)
+
+    def run(self):
+        while True:
+            try:
+                self.publish()
+            except Exception:  # pragma: no cover - defensive
+                log.exception("metrics_mirror_failed")
+            time.sleep(METRICS_MIRROR_INTERVAL)
+
+@app.on_event("startup")
+def _start_metrics_mirror():
+    if METRICS_MULTIPROC:
+        mirror = MultiprocessMirror(EngineCollector())
+        threading.Thread(target=mirror.run, name="metrics-mirror", daemon=True).start()
 
 # ---------------------------------------------------------------------------
 # Schemas
 # ---------------------------------------------------------------------------
 class GenerateRequest(BaseModel):
     prompt: str
-    max_new_tokens: Optional[int] = 256
-    temperature: Optional[float] = 0.7
+    max_new_tokens: int = Field(256, ge=1)
+    temperature: float = Field(0.7, ge=0)
     stream: Optional[bool] = False
+    seed: Optional[int] = None
+    model: Optional[str] = None
+    speculation: Optional[Literal["off", "draft", "prompt_lookup"]] = None
+    timeout: Optional[float] = None
+    session_key: Optional[str] = None
+    timings: Optional[bool] = False
+    stop: Optional[Union[str, List[str]]] = None
+    priority: Optional[Literal["interactive", "batch"]] = None
+
+class BatchGenerateRequest(BaseModel):
+    prompts: List[str]
+    max_new_tokens: int = Field(256, ge=1)
+    temperature: float = Field(0.7, ge=0)
+    seed: Optional[int] = None
+    model: Optional[str] = None
+    timeout: Optional[float] = None
+    priority: Optional[Literal["interactive", "batch"]] = None
 
 class ChatMessage(BaseModel):
     role: str
@@ -114,16 +607,30 @@ class ChatMessage(BaseModel):
 class ChatRequest(BaseModel):
     messages: List[ChatMessage]
     model: Optional[str] = MODEL_ID
-    temperature: Optional[float] = 0.7
+    temperature: float = Field(0.7, ge=0)
     stream: Optional[bool] = False
-    max_tokens: Optional[int] = 256
+    max_tokens: int = Field(256, ge=1)
+    seed: Optional[int] = None
+    speculation: Optional[Literal["off", "draft", "prompt_lookup"]] = None
+    timeout: Optional[float] = None
+    session_key: Optional[str] = None
+    timings: Optional[bool] = False
+    stop: Optional[Union[str, List[str]]] = None
+    priority: Optional[Literal["interactive", "batch"]] = None
+    context_strategy: Optional[Literal["sliding_window", "system_recent", "middle"]] = None
+
+class EmbeddingRequest(BaseModel):
+    input: Union[str, List[str]]
+    model: Optional[str] = None
+    encoding_format: Optional[Literal["float", "base64"]] = "float"
+    pooling: Optional[Literal["mean", "last"]] = None
 
 # ---------------------------------------------------------------------------
 # Auth
 # ---------------------------------------------------------------------------
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
-    if API_TOKEN != "changeme" and token != API_TOKEN:
+    if API_TOKEN != "changeme" and token != API_TOKEN and token not in ledger.tenants:
         raise HTTPException(status_code=401, detail="Invalid or missing token")
     return token
 
@@ -134,24 +641,484 @@ def _enforce_limit(requested: int, limit: int, field: str):
     if requested > limit:
         raise HTTPException(status_code=400, detail=f"{field} exceeds limit of {limit}")
 
-def _build_chat_prompt(messages: List[ChatMessage]) -> str:
-    prompt = []
-    for m in messages:
-        prompt.append(f"{m.role}: {m.content}\n")
-    prompt.append("assistant: ")
-    return "".join(prompt)
+def _stops(endpoint: str, prompt: str, stop: Union[str, List[str], None]):
+    """The request's ``stop`` strings plus the built-in ones for ``endpoint``."""
+    requested = [stop] if isinstance(stop, str) else stop or []
+    _enforce_limit(len(requested), MAX_STOP_SEQUENCES, "stop")
+    return merge_stops(requested, default_stops(endpoint, prompt) if DEFAULT_STOP_SEQUENCES else ())
+
+# model id -> token counting / history fitting for that model's tokenizer
+_chat_contexts = {}
+
+def _context_budget(handle, max_new_tokens: int) -> Optional[int]:
+    """Prompt tokens a chat request may use, or None when the context length is unknown."""
+    limit = CHAT_CONTEXT_TOKENS or getattr(getattr(handle.model, "config", None), "max_position_embeddings", 0)
+    if not limit:
+        return None
+    if max_new_tokens >= limit:
+        raise HTTPException(status_code=400, detail=f"max_tokens leaves no room for the prompt in a {limit}-token context")
+    return limit - max_new_tokens
+
+async def _fit_chat(handle, messages: List[ChatMessage], max_new_tokens: int, strategy: str):
+    context = _chat_contexts.get(handle.model_id)
+    if context is None or context.tokenizer is not handle.tokenizer:
+        context = _chat_contexts[handle.model_id] = ChatContext(handle.tokenizer, TOKEN_COUNT_CACHE_SIZE)
+    budget = _context_budget(handle, max_new_tokens)
+    fit = await _run_blocking(context.fit, [(m.role, m.content) for m in messages], budget, strategy)
+    if fit.dropped_tokens:
+        CONTEXT_TRUNCATED.labels(handle.model_id, strategy).inc()
+        CONTEXT_DROPPED_TOKENS.labels(handle.model_id, strategy).inc(fit.dropped_tokens)
+    return fit
+
+async def model_leases():
+    """The models one request has leased, released once its response has been sent."""
+    held = []
+    try:
+        yield held
+    finally:
+        for handle in held:
+            registry.release(handle)
+
+def _model_gone(model_id: str) -> HTTPException:
+    return HTTPException(
+        status_code=503, detail=f"Model '{model_id}' was unloaded, retry", headers={"Retry-After": str(QUEUE_RETRY_AFTER)}
+    )
+
+async def _acquire(model_id: str, leases: list):
+    """Resolve a requested model to a resident handle, paging it in if needed.
+
+    Unknown models are a 404. A cold model is loaded in the background and the
+    request waits up to ``MODEL_LOAD_WAIT`` for it; past that (or if the load
+    failed) the client gets 503 + Retry-After. The handle is leased for the
+    rest of the request (see ``model_leases``) so it cannot be evicted while
+    the request tokenizes or waits for admission.
+    """
+    try:
+        handle = registry.ensure_loaded(model_id)
+    except UnknownModelError:
+        raise HTTPException(status_code=404, detail=f"Model '{model_id}' is not available")
+    if handle.state != "ready":
+        retry = {"Retry-After": str(QUEUE_RETRY_AFTER)}
+        try:
+            # shield: a timed-out wait must not cancel the shared load future.
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(handle.ready)), MODEL_LOAD_WAIT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail=f"Model '{model_id}' is loading", headers=retry)
+        except Exception:
+            raise HTTPException(status_code=503, detail=f"Model '{model_id}' failed to load", headers=retry)
+    if not registry.lease(handle):  # evicted again before this request got to it
+        raise _model_gone(model_id)
+    leases.append(handle)
+    return handle
+
+def _lease_until_done(handle, seq):
+    """Keep ``handle`` resident until ``seq`` finishes, even past the request that started it."""
+    if registry.lease(handle):
+        seq.future.add_done_callback(lambda _: registry.release(handle))
+
+def _speculation(handle, requested: Optional[str]) -> str:
+    """Pick the speculation mode: explicit requests must be servable, the default degrades."""
+    modes = handle.scheduler.speculation_modes
+    if requested is None:
+        return SPECULATION if SPECULATION in modes else "off"
+    if requested not in modes:
+        raise HTTPException(status_code=400, detail=f"Speculation mode '{requested}' is not available for this model")
+    return requested
+
+def _deadline(timeout: Optional[float]) -> Optional[float]:
+    """Monotonic deadline for a request's ``timeout`` (or ``REQUEST_TIMEOUT``)."""
+    timeout = timeout if timeout is not None else REQUEST_TIMEOUT
+    if timeout < 0:
+        raise HTTPException(status_code=400, detail="timeout must be >= 0")
+    return time.monotonic() + timeout if timeout else None
+
+# session key -> its latest sequence. Only touched from the event loop.
+_sessions = {}
+
+def _claim_session(session_key: str, seq):
+    """Make ``seq`` the session's current generation, preempting the previous one."""
+    previous = _sessions.get(session_key)
+    if previous is not None:
+        previous.cancel("preempted")
+    _sessions[session_key] = seq
+    loop = asyncio.get_running_loop()
+
+    def forget():
+        if _sessions.get(session_key) is seq:
+            del _sessions[session_key]
+
+    def release(_):
+        try:
+            loop.call_soon_threadsafe(forget)
+        except RuntimeError:  # event loop already closed
+            pass
+
+    seq.future.add_done_callback(release)
+
+async def _until_disconnected(request: Request, awaitable):
+    """Await ``awaitable`` unless the client goes away first.
+
+    Starlette does not cancel a non-streaming handler when its client
+    disconnects, so poll for it; on disconnect the work is cancelled (which
+    cancels the sequences behind it) and the request ends with 499.
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                raise HTTPException(status_code=499, detail="Client closed request")
+    finally:
+        task.cancel()
+
+def _queue_full(endpoint: str) -> HTTPException:
+    QUEUE_REJECTED.labels(endpoint).inc()
+    return HTTPException(
+        status_code=503,
+        detail="Inference queue is full, retry later",
+        headers={"Retry-After": str(QUEUE_RETRY_AFTER)},
+    )
+
+def _charge(token: str, estimate: int):
+    """Charge a request's estimated tokens to its tenant's bucket, or 429 with Retry-After."""
+    try:
+        return ledger.charge(token, estimate)
+    except RateLimited as exc:
+        raise HTTPException(status_code=429, detail=str(exc), headers={"Retry-After": retry_after(exc.retry_after)})
+
+async def _settled(charge, source, max_new_tokens: int):
+    """Pass a completion source through, settling ``charge`` with its token usage.
+
+    A source abandoned mid-stream (the client went away) is settled at its
+    estimated prompt plus the text chunks it delivered, one per token.
+    """
+    delivered = 0
+    try:
+        async for item in source:
+            if isinstance(item, dict):
+                charge.settle(item["prompt_tokens"] + item["completion_tokens"])
+            else:
+                delivered += 1
+            yield item
+    finally:
+        charge.settle(charge.estimate - max_new_tokens + delivered if delivered else 0)
+
+async def _charged(charge, max_new_tokens: int, starting):
+    """Await ``starting`` (a completion source) and settle ``charge`` against it.
+
+    Requests refused before producing anything (a 400, a full queue, an
+    admission wait the client gave up on) are settled at zero tokens.
+    """
+    try:
+        source = await starting
+    except BaseException:
+        charge.settle(0)
+        raise
+    return _settled(charge, source, max_new_tokens)
+
+async def _admit(endpoint: str, handle, charge, priority: str, cost: int) -> FairQueue:
+    """Wait for a turn in the model's fair queue; the caller must ``release`` it."""
+    queue = _fair_queues.get(handle.model_id)
+    if queue is None:
+        queue = _fair_queues[handle.model_id] = FairQueue(ADMISSION_CONCURRENCY or 2 * MAX_BATCH_SIZE, MAX_QUEUE_SIZE)
+    started = time.monotonic()
+    try:
+        await queue.acquire(charge.identity, charge.tenant.weight, cost, priority)
+    except QueueFull:
+        raise _queue_full(endpoint)
+    ADMISSION_WAIT.labels(handle.model_id, priority).observe(time.monotonic() - started)
+    return queue
+
+def _release_when_done(queue: FairQueue, seq):
+    loop = asyncio.get_running_loop()
+
+    def done(_):
+        try:
+            loop.call_soon_threadsafe(queue.release)
+        except RuntimeError:  # event loop already closed
+            pass
+    seq.future.add_done_callback(done)
+
+async def _run_blocking(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+async def _submit(
+    endpoint: str, handle, prompt: str, params: SamplingParams, stream: bool = False, session_key: Optional[str] = None,
+    charge=None, priority: str = "interactive",
+):
+    """Tokenize a prompt off the event loop and queue it on the batch scheduler.
+
+    Rejects with 503 + Retry-After when the admission queue is full, both
+    before tokenizing (cheap fast path) and on the actual enqueue. A
+    ``session_key`` preempts the session's previous generation, if any. With
+    a tenant ``charge``, the request first waits its turn in the model's fair
+    queue, priced at its prompt tokens plus ``max_new_tokens``.
+    """
+    scheduler = handle.scheduler
+    if scheduler.queue_full:
+        raise _queue_full(endpoint)
+    started = time.monotonic()
+    encoded = await _run_blocking(handle.tokenizer, prompt)
+    tokenize_seconds = time.monotonic() - started
+    TOKENIZE_SECONDS.labels(endpoint, handle.model_id).observe(tokenize_seconds)
+    queue = None
+    admitting = time.monotonic()
+    if charge is not None:
+        queue = await _admit(endpoint, handle, charge, priority, len(encoded["input_ids"]) + params.max_new_tokens)
+    admission_seconds = time.monotonic() - admitting
+    try:
+        if handle.scheduler is not scheduler:  # unloaded while waiting; the request's lease should prevent this
+            raise _model_gone(handle.model_id)
+        seq = scheduler.submit(encoded["input_ids"], params, stream=stream)
+    except HTTPException:
+        if queue is not None:
+            queue.release()
+        raise
+    except QueueFullError:
+        if queue is not None:
+            queue.release()
+        raise _queue_full(endpoint)
+    except ValueError as exc:  # e.g. an empty prompt
+        if queue is not None:
+            queue.release()
+        raise HTTPException(status_code=400, detail=str(exc))
+    _lease_until_done(handle, seq)
+    if queue is not None:
+        _release_when_done(queue, seq)
+    seq.tokenize_seconds = tokenize_seconds
+    seq.admission_seconds = admission_seconds
+    if session_key is not None:
+        _claim_session(session_key, seq)
+    return seq
 
-def _count_tokens(text: str) -> int:
-    if tokenizer is None:
-        return len(text.split())
-    return len(tokenizer.encode(text))
+async def _submit_batch(
+    endpoint: str, handle, prompt_ids: List[List[int]], params: SamplingParams, charge=None, priority: str = "batch"
+):
+    """Run many prompts through the scheduler and return their finished sequences.
+
+    Prompts are fed shortest first so that sequences admitted together have
+    similar lengths and share padded prefills. At most two batches' worth are
+    in flight at once, so one large request cannot fill the admission queue
+    that interactive requests also use.
+    """
+    scheduler = handle.scheduler
+    if scheduler.queue_full:
+        raise _queue_full(endpoint)
+    empty = [i for i, ids in enumerate(prompt_ids) if not ids]
+    if empty:
+        raise HTTPException(status_code=400, detail=f"prompts[{empty[0]}] must contain at least one token")
+    slots = asyncio.Semaphore(2 * MAX_BATCH_SIZE)
+    seqs = [None] * len(prompt_ids)
+    waits = []
+    try:
+        for i in sorted(range(len(prompt_ids)), key=lambda i: len(prompt_ids[i])):
+            await slots.acquire()
+            queue = None
+            admitting = time.monotonic()
+            if charge is not None:
+                queue = await _admit(endpoint, handle, charge, priority, len(prompt_ids[i]) + params.max_new_tokens)
+            admission_seconds = time.monotonic() - admitting
+            try:
+                while True:
+                    if handle.scheduler is not scheduler:
+                        raise _model_gone(handle.model_id)
+                    try:
+                        seqs[i] = scheduler.submit(prompt_ids[i], params)
+                        break
+                    except QueueFullError:  # other traffic holds the queue; wait for room
+                        await asyncio.sleep(0.05)
+            except BaseException:
+                if queue is not None:
+                    queue.release()
+                raise
+            _lease_until_done(handle, seqs[i])
+            if queue is not None:
+                _release_when_done(queue, seqs[i])
+            seqs[i].admission_seconds = admission_seconds
+            done = asyncio.wrap_future(seqs[i].future)
+            done.add_done_callback(lambda _: slots.release())
+            waits.append(done)
+        await asyncio.shield(asyncio.gather(*waits))
+    finally:
+        for seq in seqs:
+            if seq is not None and not seq.finished:
+                seq.cancel("disconnected")
+    return seqs
+
+async def _decode(handle, seq) -> str:
+    text = await _run_blocking(lambda: handle.tokenizer.decode(seq.output_ids, skip_special_tokens=True))
+    return truncate_at_stop(text, seq.params.stop) if seq.params.stop else text
+
+def _record(endpoint: str, handle, seq):
+    labels = (endpoint, handle.model_id)
+    completion = len(seq.output_ids)
+    GEN_TOKENS.labels(*labels).inc(completion)
+    QUEUE_WAIT.labels(*labels).observe(seq.queue_wait)
+    PROMPT_TOKENS.labels(*labels).observe(len(seq.prompt_ids))
+    COMPLETION_TOKENS.labels(*labels).observe(completion)
+    if not seq.token_times:  # cancelled before its prefill
+        return
+    PREFILL_SECONDS.labels(*labels).observe(seq.prefill_seconds)
+    TIME_TO_FIRST_TOKEN.labels(*labels).observe(seq.time_to_first_token)
+    itl = INTER_TOKEN_LATENCY.labels(*labels)
+    for gap in seq.inter_token_latencies:
+        itl.observe(gap)
+    if completion > 1 and seq.decode_seconds > 0:
+        TOKENS_PER_SECOND.labels(*labels).observe((completion - 1) / seq.decode_seconds)
+
+def _timings(seq) -> dict:
+    """Per-request latency breakdown in milliseconds (``"timings": true``)."""
+    ms = lambda seconds: round(seconds * 1000, 3)
+    ttft = seq.time_to_first_token
+    return {
+        "tokenize_ms": ms(seq.tokenize_seconds),
+        "admission_ms": ms(seq.admission_seconds),
+        "queue_ms": ms(seq.queue_wait),
+        "prefill_ms": ms(seq.prefill_seconds),
+        "time_to_first_token_ms": ms(ttft) if ttft is not None else None,
+        "decode_ms": ms(seq.decode_seconds),
+        "total_ms": ms(seq.finished_at - seq.queued_at + seq.tokenize_seconds + seq.admission_seconds),
+    }
+
+async def _stream_text(handle, seq):
+    """Yield text deltas for a streaming sequence as its tokens are sampled."""
+    detok = IncrementalDetokenizer(handle.tokenizer)
+    # Text that may be the start of a stop string is held back until it is not.
+    matcher = StopMatcher(seq.params.stop) if seq.params.stop else None
+    async for token_id in seq.stream:
+        text = detok.push(token_id)
+        if matcher is not None:
+            text = matcher.push(text)
+        if text:
+            yield text
+    tail = detok.flush()
+    if matcher is not None:
+        tail = matcher.push(tail) + matcher.flush()
+    if tail:
+        yield tail
+
+async def _follow(endpoint: str, handle, seq):
+    """Yield a sequence's text deltas, then its result dict.
+
+    This is the shape every completion source has: zero or more ``str``
+    chunks followed by one ``dict`` with ``text``, ``finish_reason``,
+    ``prompt_tokens``, ``completion_tokens`` and ``timings``.
+    """
+    try:
+        if seq.stream is not None:
+            parts = []
+            async for text in _stream_text(handle, seq):
+                parts.append(text)
+                yield text
+            text = "".join(parts)
+        else:
+            # shield: abandoning the wait must not cancel the scheduler's future.
+            await asyncio.shield(asyncio.wrap_future(seq.future))
+            text = await _decode(handle, seq)
+            if text:
+                yield text
+    finally:
+        # Abandoned mid-generation (client gone, or every deduplicated
+        # follower gone): free the batch slot at the next decode step.
+        if not seq.finished:
+            seq.cancel("disconnected")
+    _record(endpoint, handle, seq)
+    yield {
+        "text": text,
+        "finish_reason": seq.finish_reason,
+        "prompt_tokens": len(seq.prompt_ids),
+        "completion_tokens": len(seq.output_ids),
+        "timings": _timings(seq),
+    }
+
+async def _replay(result: dict):
+    if result["text"]:
+        yield result["text"]
+    yield result
+
+async def _store_result(key: str, source):
+    async for item in source:
+        # Cut-short results (timeout, preemption) are not what the request asked for.
+        if isinstance(item, dict) and item["finish_reason"] in ("stop", "length"):
+            # Timings describe this run, not a later replay.
+            await _run_blocking(response_cache.put, key, {k: v for k, v in item.items() if k != "timings"})
+        yield item
+
+async def _completion_source(
+    endpoint: str, handle, cache_payload: dict, prompt: str, params: SamplingParams, stream: bool,
+    session_key: Optional[str] = None, charge=None, priority: str = "interactive",
+):
+    """Start (or join, or replay) a generation and return its chunk iterator.
+
+    Deterministic requests (greedy or seeded) go through the response cache
+    when it is enabled: hits are replayed, and identical requests already
+    generating are joined instead of being run twice. Session-keyed requests
+    never join another request's generation, since a later request in the
+    same session would preempt it for everyone. Replays and joined requests
+    generate nothing, so their ``charge`` is settled at zero tokens.
+    """
+    async def start():
+        seq = await _submit(
+            endpoint, handle, prompt, params, stream=stream, session_key=session_key, charge=charge, priority=priority
+        )
+        return _follow(endpoint, handle, seq)
+
+    if response_cache is None or (params.temperature > 0 and params.seed is None):
+        return await start()
+    key = request_key({
+        "endpoint": endpoint,
+        "model": handle.model_id,
+        **cache_payload,
+        "max_new_tokens": params.max_new_tokens,
+        "temperature": max(params.temperature, 0.0),
+        "seed": params.seed,
+        "stop": list(params.stop),
+    })
+    cached = await _run_blocking(response_cache.get, key)
+    if cached is not None:
+        if charge is not None:
+            charge.settle(0)
+        return _replay(cached)
+    started = []
+
+    async def start_and_store():
+        started.append(True)
+        return _store_result(key, await start())
+
+    if session_key is not None:
+        return await start_and_store()
+    source = await inflight.attach(key, start_and_store)
+    if not started and charge is not None:
+        charge.settle(0)  # following another request's generation
+    return source
+
+def _sse_response(request: Request, frames) -> StreamingResponse:
+    """Stream encoded SSE frames, gzipped when enabled and the client accepts it."""
+    if SSE_GZIP and "gzip" in request.headers.get("accept-encoding", ""):
+        return StreamingResponse(
+            gzip_frames(frames), media_type="text/event-stream", headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+        )
+    return StreamingResponse(frames, media_type="text/event-stream")
+
+def _coalesced(source):
+    return coalesce(source, SSE_COALESCE_MS / 1000, SSE_COALESCE_BYTES)
+
+async def _collect(source) -> dict:
+    async for item in source:
+        if isinstance(item, dict):
+            return item
 
 # ---------------------------------------------------------------------------
 # Endpoints
 # ---------------------------------------------------------------------------
 @app.post("/v1/generate")
 @limiter.limit(RATE_LIMIT)
-async def generate(req: GenerateRequest, request: Request, token: str = Depends(verify_token)):
+async def generate(
+    req: GenerateRequest, request: Request, token: str = Depends(verify_token), leases: list = Depends(model_leases)
+):
     _enforce_limit(req.max_new_tokens, MAX_NEW_TOKENS, "max_new_tokens")
     start = time.time()
     logger_ctx = log.bind(endpoint="generate", stream=req.stream)
@@ -164,50 +1131,120 @@ async def generate(req: GenerateRequest, request: Request, token: str = Depends(
             return StreamingResponse(mock_stream(), media_type="text/event-stream")
         return {"generated_text": "This is a mock response."}
 
-    inputs = tokenizer(req.prompt, return_tensors="pt").to(model.device)
-
-    if req.stream:
-        def stream_fn():
-            generated_tokens = 0
-            with torch.no_grad():
-                output_ids = model.generate(
-                    **inputs,
-                    max_new_tokens=req.max_new_tokens,
-                    temperature=req.temperature,
-                    do_sample=True,
-                    pad_token_id=tokenizer.eos_token_id
-                )[0]
-            full_text = tokenizer.decode(output_ids, skip_special_tokens=True)
-            gen_part = full_text[len(req.prompt):]
-            for ch in gen_part.split():
-                generated_tokens += 1
-                yield f"data: {{\"text\": \"{ch}\"}}\n\n"
-            GEN_TOKENS.inc(generated_tokens, labelnames=("generate",))
-            logger_ctx.info("generation_complete", tokens=generated_tokens, duration=time.time() - start)
-            yield "data: [DONE]\n\n"
-        return StreamingResponse(stream_fn(), media_type="text/event-stream")
-
-    output_ids = model.generate(
-        **inputs,
+    handle = await _acquire(req.model or MODEL_ID, leases)
+    params = SamplingParams(
         max_new_tokens=req.max_new_tokens,
         temperature=req.temperature,
-        do_sample=True,
-        pad_token_id=tokenizer.eos_token_id
-    )[0]
-    text = tokenizer.decode(output_ids, skip_special_tokens=True)
-    gen_part = text[len(req.prompt):]
-    tok_count = _count_tokens(gen_part)
-    GEN_TOKENS.inc(tok_count, labelnames=("generate",))
-    logger_ctx.info("generation_complete", tokens=tok_count, duration=time.time() - start)
-    return {"generated_text": gen_part}
+        seed=req.seed,
+        speculation=_speculation(handle, req.speculation),
+        deadline=_deadline(req.timeout),
+        stop=_stops("generate", req.prompt, req.stop),
+    )
+    charge = _charge(token, estimate_tokens(req.prompt) + req.max_new_tokens)
+    source = await _charged(charge, req.max_new_tokens, _completion_source(
+        "generate", handle, {"prompt": req.prompt}, req.prompt, params, req.stream, req.session_key,
+        charge=charge, priority=req.priority or "interactive",
+    ))
+
+    if req.stream:
+        encoder = TextStreamEncoder()
+
+        async def stream_fn():
+            async for item in _coalesced(source):
+                if isinstance(item, dict):
+                    usage = {"prompt_tokens": item["prompt_tokens"], "completion_tokens": item["completion_tokens"]}
+                    final = {"usage": usage}
+                    if req.timings:
+                        final["timings"] = item.get("timings")
+                    yield event(final)
+                    logger_ctx.info("generation_complete", tokens=item["completion_tokens"], duration=time.time() - start)
+                    break
+                yield encoder.text(item)
+            yield DONE
+        return _sse_response(request, stream_fn())
+
+    result = await _until_disconnected(request, _collect(source))
+    logger_ctx.info("generation_complete", tokens=result["completion_tokens"], duration=time.time() - start)
+    response = {
+        "generated_text": result["text"],
+        "finish_reason": result["finish_reason"],
+        "usage": {"prompt_tokens": result["prompt_tokens"], "completion_tokens": result["completion_tokens"]},
+    }
+    if req.timings:
+        response["timings"] = result.get("timings")
+    return response
+
+@app.post("/v1/generate/batch")
+@limiter.limit(RATE_LIMIT)
+async def generate_batch(
+    req: BatchGenerateRequest, request: Request, token: str = Depends(verify_token), leases: list = Depends(model_leases)
+):
+    _enforce_limit(req.max_new_tokens, MAX_NEW_TOKENS, "max_new_tokens")
+    _enforce_limit(len(req.prompts), MAX_BATCH_PROMPTS, "prompts")
+    start = time.time()
+    logger_ctx = log.bind(endpoint="generate_batch", prompts=len(req.prompts))
+
+    if USE_MOCK_GENERATION:
+        return {
+            "model": req.model or MODEL_ID,
+            "results": [
+                {"index": i, "generated_text": "This is a mock response.", "finish_reason": "stop"}
+                for i in range(len(req.prompts))
+            ],
+        }
+
+    handle = await _acquire(req.model or MODEL_ID, leases)
+    params = SamplingParams(
+        max_new_tokens=req.max_new_tokens, temperature=req.temperature, seed=req.seed, deadline=_deadline(req.timeout)
+    )
+    charge = _charge(token, sum(estimate_tokens(p) for p in req.prompts) + len(req.prompts) * req.max_new_tokens)
+    try:
+        tokenize_started = time.monotonic()
+        encoded = await _run_blocking(handle.tokenizer, req.prompts)
+        TOKENIZE_SECONDS.labels("generate_batch", handle.model_id).observe(time.monotonic() - tokenize_started)
+        seqs = await _until_disconnected(
+            request, _submit_batch("generate_batch", handle, encoded["input_ids"], params, charge, req.priority or "batch")
+        )
+    except BaseException:
+        charge.settle(0)
+        raise
+    texts = await _run_blocking(
+        lambda: handle.tokenizer.batch_decode([s.output_ids for s in seqs], skip_special_tokens=True)
+    )
+    for seq in seqs:
+        _record("generate_batch", handle, seq)
+    completion_tokens = sum(len(s.output_ids) for s in seqs)
+    charge.settle(sum(len(s.prompt_ids) for s in seqs) + completion_tokens)
+    logger_ctx.info("generation_complete", tokens=completion_tokens, duration=time.time() - start)
+    return {
+        "model": handle.model_id,
+        "results": [
+            {"index": i, "generated_text": text, "finish_reason": seq.finish_reason}
+            for i, (seq, text) in enumerate(zip(seqs, texts))
+        ],
+        "usage": {
+            "prompt_tokens": sum(len(s.prompt_ids) for s in seqs),
+            "completion_tokens": completion_tokens,
+        },
+    }
+
+def _chat_usage(result: dict, fit) -> dict:
+    return {
+        "prompt_tokens": result["prompt_tokens"],
+        "completion_tokens": result["completion_tokens"],
+        "total_tokens": result["prompt_tokens"] + result["completion_tokens"],
+        "dropped_tokens": fit.dropped_tokens,
+        "dropped_messages": fit.dropped_messages,
+    }
 
 @app.post("/v1/chat/completions")
 @limiter.limit(RATE_LIMIT)
-async def chat_completions(req: ChatRequest, request: Request, token: str = Depends(verify_token)):
+async def chat_completions(
+    req: ChatRequest, request: Request, token: str = Depends(verify_token), leases: list = Depends(model_leases)
+):
     _enforce_limit(req.max_tokens, MAX_NEW_TOKENS, "max_tokens")
     start = time.time()
     logger_ctx = log.bind(endpoint="chat", stream=req.stream)
-    prompt = _build_chat_prompt(req.messages)
 
     if USE_MOCK_GENERATION:
         if req.stream:
@@ -238,64 +1275,166 @@ async def chat_completions(req: ChatRequest, request: Request, token: str = Depe
             }]
         }
 
-    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+    handle = await _acquire(req.model or MODEL_ID, leases)
+    params = SamplingParams(
+        max_new_tokens=req.max_tokens,
+        temperature=req.temperature,
+        seed=req.seed,
+        speculation=_speculation(handle, req.speculation),
+        deadline=_deadline(req.timeout),
+    )
+    default_strategy = CHAT_CONTEXT_STRATEGY if CHAT_CONTEXT_STRATEGY in CONTEXT_STRATEGIES else "system_recent"
+    strategy = req.context_strategy or default_strategy
+    fit = await _fit_chat(handle, req.messages, req.max_tokens, strategy)
+    prompt = render_chat(fit.messages)
+    params.stop = _stops("chat", prompt, req.stop)
+    charge = _charge(token, fit.prompt_tokens + req.max_tokens)
+    messages = [[m.role, m.content] for m in req.messages]
+    source = await _charged(charge, req.max_tokens, _completion_source(
+        "chat", handle, {"messages": messages, "context_strategy": strategy}, prompt, params, req.stream,
+        req.session_key, charge=charge, priority=req.priority or "interactive",
+    ))
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
 
     if req.stream:
-        def stream_fn():
-            generated_tokens = 0
-            with torch.no_grad():
-                output_ids = model.generate(
-                    **inputs,
-                    max_new_tokens=req.max_tokens,
-                    temperature=req.temperature,
-                    do_sample=True,
-                    pad_token_id=tokenizer.eos_token_id
-                )[0]
-            full_text = tokenizer.decode(output_ids, skip_special_tokens=True)
-            gen_part = full_text[len(prompt):]
-            # Emit word-wise chunks in OpenAI-style envelopes
-            buffer = []
-            for word in gen_part.split():
-                generated_tokens += 1
-                chunk = {
-                    "id": f"chatcmpl-{int(time.time())}",
-                    "object": "chat.completion.chunk",
-                    "created": int(time.time()),
-                    "model": req.model,
-                    "choices": [{
-                        "index": 0,
-                        "delta": {"content": word + " "},
-                        "finish_reason": None
-                    }]
-                }
-                yield f"data: {json.dumps(chunk)}\n\n"
-            GEN_TOKENS.inc(generated_tokens, labelnames=("chat",))
-            logger_ctx.info("chat_complete", tokens=generated_tokens, duration=time.time() - start)
-            yield "data: [DONE]\n\n"
-        return StreamingResponse(stream_fn(), media_type="text/event-stream")
+        encoder = ChatStreamEncoder(completion_id, created, handle.model_id)
 
-    output_ids = model.generate(
-        **inputs,
-        max_new_tokens=req.max_tokens,
-        temperature=req.temperature,
-        do_sample=True,
-        pad_token_id=tokenizer.eos_token_id
-    )[0]
-    full_text = tokenizer.decode(output_ids, skip_special_tokens=True)
-    gen_part = full_text[len(prompt):]
-    tok_count = _count_tokens(gen_part)
-    GEN_TOKENS.inc(tok_count, labelnames=("chat",))
-    logger_ctx.info("chat_complete", tokens=tok_count, duration=time.time() - start)
-    return {
-        "id": f"chatcmpl-{int(time.time())}",
+        async def stream_fn():
+            yield encoder.role()
+            async for item in _coalesced(source):
+                if isinstance(item, dict):
+                    extra = {"usage": _chat_usage(item, fit)}
+                    if req.timings:
+                        extra["timings"] = item.get("timings")
+                    yield encoder.finish(item["finish_reason"], **extra)
+                    logger_ctx.info("chat_complete", tokens=item["completion_tokens"], duration=time.time() - start)
+                    break
+                yield encoder.content(item)
+            yield DONE
+        return _sse_response(request, stream_fn())
+
+    result = await _until_disconnected(request, _collect(source))
+    logger_ctx.info("chat_complete", tokens=result["completion_tokens"], duration=time.time() - start)
+    response = {
+        "id": completion_id,
         "object": "chat.completion",
-        "created": int(time.time()),
-        "model": req.model,
+        "created": created,
+        "model": handle.model_id,
         "choices": [{
             "index": 0,
-            "message": {"role": "assistant", "content": gen_part},
-            "finish_reason": "stop"
-        }]
+            "message": {"role": "assistant", "content": result["text"]},
+            "finish_reason": result["finish_reason"]
+        }],
+        "usage": _chat_usage(result, fit),
+    }
+    if req.timings:
+        response["timings"] = result.get("timings")
+    return response
+
+# model id -> batching / pooling over that model's hidden states
+_embedders = {}
+
+async def _embed(handle, texts: List[str], pooling: str, positions: List[int]):
+    """Embed ``texts`` in length-bucketed batches; returns ``(vectors, prompt_tokens)``.
+
+    ``positions`` are the texts' indices in the request, for error messages.
+    """
+    embedder = _embedders.get(handle.model_id)
+    if embedder is None or embedder.model is not handle.model:
+        embedder = _embedders[handle.model_id] = Embedder(handle.model, EMBEDDING_BATCH_TOKENS)
+    started = time.monotonic()
+    prompt_ids = (await _run_blocking(handle.tokenizer, texts))["input_ids"]
+    TOKENIZE_SECONDS.labels("embeddings", handle.model_id).observe(time.monotonic() - started)
+    limit = getattr(getattr(handle.model, "config", None), "max_position_embeddings", 0)
+    for position, ids in zip(positions, prompt_ids):
+        if not ids:
+            raise HTTPException(status_code=400, detail=f"input[{position}] must contain at least one token")
+        if limit and len(ids) > limit:
+            raise HTTPException(status_code=400, detail=f"input[{position}] exceeds limit of {limit} tokens")
+    loop = asyncio.get_running_loop()
+    vectors = [None] * len(texts)
+    for batch in embedder.batches([len(ids) for ids in prompt_ids]):
+        started = time.monotonic()
+        pooled = await loop.run_in_executor(
+            embedding_executor, embedder.forward, [prompt_ids[i] for i in batch], pooling
+        )
+        EMBEDDING_BATCH_SECONDS.labels(handle.model_id).observe(time.monotonic() - started)
+        for i, vector in zip(batch, pooled):
+            vectors[i] = vector
+    return vectors, sum(len(ids) for ids in prompt_ids)
+
+def _embedding_response(model_id: str, vectors, encoding_format: str, prompt_tokens: int, cached: int) -> Response:
+    if encoding_format == "base64":
+        encoded = [encode_base64(v) for v in vectors]
+    else:
+        encoded = torch.stack(vectors).tolist()
+    body = {
+        "object": "list",
+        "data": [{"object": "embedding", "index": i, "embedding": e} for i, e in enumerate(encoded)],
+        "model": model_id,
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens, "cached_inputs": cached},
+    }
+    # Thousands of floats per input: orjson is much faster than the default encoder here.
+    return Response(json_bytes(body), media_type="application/json")
+
+@app.post("/v1/embeddings")
+@limiter.limit(RATE_LIMIT)
+async def embeddings(
+    req: EmbeddingRequest, request: Request, token: str = Depends(verify_token), leases: list = Depends(model_leases)
+):
+    inputs = [req.input] if isinstance(req.input, str) else req.input
+    if not inputs:
+        raise HTTPException(status_code=400, detail="input must not be empty")
+    _enforce_limit(len(inputs), MAX_EMBEDDING_INPUTS, "input")
+    start = time.time()
+    logger_ctx = log.bind(endpoint="embeddings", inputs=len(inputs))
+
+    if USE_MOCK_GENERATION:
+        return _embedding_response(req.model or MODEL_ID, [torch.zeros(8)] * len(inputs), req.encoding_format, 0, 0)
+
+    handle = await _acquire(req.model or MODEL_ID, leases)
+    pooling = req.pooling or (EMBEDDING_POOLING if EMBEDDING_POOLING in POOLING else "mean")
+    vectors = [None] * len(inputs)
+    if embedding_cache is not None:
+        keys = [cache_key(handle.model_id, pooling, text) for text in inputs]
+        vectors = await _run_blocking(lambda: [embedding_cache.get(key) for key in keys])
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    cached = len(inputs) - len(missing)
+    EMBEDDING_INPUTS.labels(handle.model_id, "cached").inc(cached)
+    prompt_tokens = 0
+    if missing:
+        charge = _charge(token, sum(estimate_tokens(inputs[i]) for i in missing))
+        try:
+            computed, prompt_tokens = await _until_disconnected(
+                request, _embed(handle, [inputs[i] for i in missing], pooling, missing)
+            )
+        finally:
+            charge.settle(prompt_tokens)
+        EMBEDDING_INPUTS.labels(handle.model_id, "computed").inc(len(missing))
+        for i, vector in zip(missing, computed):
+            vectors[i] = vector
+        if embedding_cache is not None:
+            await _run_blocking(lambda: [embedding_cache.put(keys[i], vectors[i]) for i in missing])
+    logger_ctx.info("embeddings_complete", tokens=prompt_tokens, cached=cached, duration=time.time() - start)
+    return _embedding_response(handle.model_id, vectors, req.encoding_format, prompt_tokens, cached)
+
+@app.get("/v1/models")
+def list_models(token: str = Depends(verify_token)):
+    """OpenAI-style model list, with each model's residency state."""
+    return {
+        "object": "list",
+        "data": [
+            {
+                "id": h.model_id,
+                "object": "model",
+                "owned_by": "bigcode",
+                "state": "mock" if USE_MOCK_GENERATION else h.state,
+                "pinned": h.pinned,
+                "resident_bytes": h.nbytes if h.resident else 0,
+            }
+            for h in registry.handles()
+        ],
     }
 
 # ---------------------------------------------------------------------------
@@ -303,9 +1442,30 @@ async def chat_completions(req: ChatRequest, request: Request, token: str = Depe
 # ---------------------------------------------------------------------------
 instrumentator.instrument(app).expose(app)
 
+@app.on_event("shutdown")
+def _stop_schedulers():
+    for handle in registry.handles():
+        if handle.scheduler is not None:
+            handle.scheduler.stop()
+    executor.shutdown(wait=False)
+    embedding_executor.shutdown(wait=False)
+
+def _model_state() -> str:
+    return "mock" if USE_MOCK_GENERATION else registry.state(MODEL_ID)
+
 @app.get("/healthz")
 def healthz():
-    return {"status": "ok", "model": MODEL_ID, "mock": USE_MOCK_GENERATION}
+    """Liveness: the process is up, whatever the model is doing."""
+    return {"status": "ok", "model": MODEL_ID, "mock": USE_MOCK_GENERATION, "state": _model_state()}
+
+@app.get("/readyz")
+def readyz():
+    """Readiness: 200 only once the default model is loaded and warmed up."""
+    state = _model_state()
+    body = {"status": state, "model": MODEL_ID}
+    if state not in ("ready", "mock"):
+        return JSONResponse(body, status_code=503)
+    return body
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,114 @@
+"""A model-free stand-in for benchmarking the serving stack.
+
+``USE_MOCK_GENERATION`` short-circuits the endpoints and answers instantly,
+so it says nothing about capacity. With ``MOCK_ENGINE=1`` the server instead
+loads ``MockCausalLM`` and ``MockTokenizer`` in place of the real weights.
+Everything else is real: tokenization on the executor, admission, the batch
+scheduler, prefix cache, speculation, detokenization and SSE. The mock model
+sleeps for as long as a real forward pass would take:
+
+* a prefill costs ``prefill_seconds_per_token`` for every real (non-padding)
+  token it processes, so prefix-cache hits only pay for the suffix;
+* a decode step costs ``decode_seconds_per_token``, plus
+  ``decode_batch_cost`` of that for every additional sequence in the batch.
+  Decode is memory-bound, so a batched step is only slightly slower than a
+  single one.
+
+Calibrate the costs against ``starcoder2_prefill_seconds`` and
+``starcoder2_inter_token_latency_seconds`` from a real deployment. The model
+emits a fixed code snippet, one byte per token, and never produces EOS, so
+every request runs to its ``max_new_tokens``. With ``output_hidden_states``
+it returns a fixed random embedding of each byte, so ``/v1/embeddings`` works
+too (similar texts get similar mean-pooled vectors).
+"""
+
+import time
+from types import SimpleNamespace
+from typing import List, Union
+
+import torch
+
+VOCAB_SIZE = 256
+KV_HEAD_DIM = 32  # one layer, one head; enough for every ``KV_CACHE_MODE`` to apply
+SNIPPET = (
+    "def fibonacci(n: int) -> int:\n"
+    "    a, b = 0, 1\n"
+    "    for _ in range(n):\n"
+    "        a, b = b, a + b\n"
+    "    return a\n\n\n"
+).encode("utf-8")
+
+
+class MockTokenizer:
+    """Byte-level tokenizer: token id N is the byte N."""
+
+    eos_token_id = None
+
+    def __call__(self, text: Union[str, List[str]]):
+        if isinstance(text, str):
+            return {"input_ids": list(text.encode("utf-8"))}
+        return {"input_ids": [list(t.encode("utf-8")) for t in text]}
+
+    def decode(self, ids: List[int], skip_special_tokens: bool = True) -> str:
+        return bytes(ids).decode("utf-8", errors="replace")
+
+    def batch_decode(self, batch: List[List[int]], skip_special_tokens: bool = True) -> List[str]:
+        return [self.decode(ids) for ids in batch]
+
+
+class MockCausalLM(torch.nn.Module):
+    """Causal-LM call signature with synthetic logits and a timed forward pass."""
+
+    def __init__(
+        self,
+        prefill_seconds_per_token: float = 0.0002,
+        decode_seconds_per_token: float = 0.02,
+        decode_batch_cost: float = 0.05,
+    ):
+        super().__init__()
+        self.prefill_seconds_per_token = prefill_seconds_per_token
+        self.decode_seconds_per_token = decode_seconds_per_token
+        self.decode_batch_cost = decode_batch_cost
+        self._snippet = torch.tensor(list(SNIPPET))
+        self._embedding = torch.randn(VOCAB_SIZE, KV_HEAD_DIM, generator=torch.Generator().manual_seed(0))
+
+    @property
+    def device(self) -> torch.device:
+        return torch.device("cpu")
+
+    def cost(self, rows: int, new_tokens: int, real_tokens: int) -> float:
+        """Seconds a real forward pass of this shape would take."""
+        if new_tokens == 1:
+            return self.decode_seconds_per_token * (1 + self.decode_batch_cost * (rows - 1))
+        return self.prefill_seconds_per_token * real_tokens
+
+    def forward(
+        self, input_ids, attention_mask=None, position_ids=None, past_key_values=None, use_cache=True,
+        output_hidden_states=False, **_,
+    ):
+        rows, new_tokens = input_ids.shape
+        if hasattr(past_key_values, "update"):  # a transformers ``Cache`` (see ``kv_cache``)
+            cached = past_key_values.get_seq_length()
+        else:
+            cached = past_key_values[0][0].shape[2] if past_key_values is not None else 0
+        if position_ids is None:
+            position_ids = torch.arange(cached, cached + new_tokens).expand(rows, new_tokens)
+        if attention_mask is None:
+            real_tokens = rows * new_tokens
+        else:
+            real_tokens = int(attention_mask[:, -new_tokens:].sum())
+        time.sleep(self.cost(rows, new_tokens, real_tokens))
+
+        # Position p predicts the snippet byte at p + 1, whatever the prompt was.
+        following = self._snippet[(position_ids + 1) % len(self._snippet)]
+        logits = torch.zeros(rows, new_tokens, VOCAB_SIZE)
+        logits.scatter_(2, following.unsqueeze(-1), 30.0)
+        if output_hidden_states:
+            return SimpleNamespace(logits=logits, hidden_states=(self._embedding[input_ids],), past_key_values=None)
+        kv = torch.zeros(rows, 1, new_tokens, KV_HEAD_DIM)
+        if hasattr(past_key_values, "update"):
+            past_key_values.update(kv, kv, 0)
+            return SimpleNamespace(logits=logits, past_key_values=past_key_values)
+        if past_key_values is not None:
+            kv = torch.cat([past_key_values[0][0], kv], dim=2)
+        return SimpleNamespace(logits=logits, past_key_values=((kv, kv),))
@@ -0,0 +1,140 @@
+"""Token-prefix KV cache shared across requests.
+
+When a sequence finishes, the scheduler hands its key/value tensors and the
+token ids they cover to ``PrefixCache.store``. A later prompt that starts with
+the same tokens (the next turn of a chat, a repeated file header) can then
+reuse them and only prefill its new suffix.
+
+Entries are indexed by a chained hash over fixed-size token blocks, so a
+lookup walks the prompt's block hashes from longest to shortest and then
+extends the match token by token. Entries live in an LRU ordered dict and are
+evicted once their combined size exceeds the configured byte budget.
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+BLOCK_SIZE = 16
+
+PastKeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+@dataclass
+class _Entry:
+    ids: List[int]
+    past: PastKeyValues
+    nbytes: int
+    block_hashes: List[int]
+
+
+def _block_hashes(ids: List[int], block_size: int) -> List[int]:
+    """Chained hash of every complete block prefix of ``ids``."""
+    hashes = []
+    h = 0
+    for end in range(block_size, len(ids) + 1, block_size):
+        h = hash((h, tuple(ids[end - block_size:end])))
+        hashes.append(h)
+    return hashes
+
+
+def _past_nbytes(past: PastKeyValues) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in past)
+
+
+def _common_prefix(a: List[int], b: List[int]) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class PrefixCache:
+    """LRU cache of ``past_key_values`` keyed by token-prefix hash.
+
+    Not thread-safe: the scheduler thread is the only caller. The counters are
+    plain integers read by the metrics collector.
+    """
+
+    def __init__(self, max_bytes: int, block_size: int = BLOCK_SIZE):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._index: Dict[int, int] = {}  # block-prefix hash -> entry key
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.evicted_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _find(self, ids: List[int]) -> Tuple[Optional[int], int]:
+        """Return the entry key with the longest block-aligned match and its length."""
+        hashes = _block_hashes(ids, self.block_size)
+        for n_blocks in range(len(hashes), 0, -1):
+            key = self._index.get(hashes[n_blocks - 1])
+            if key is not None:
+                return key, n_blocks * self.block_size
+        return None, 0
+
+    def lookup(self, ids: List[int]) -> Tuple[Optional[PastKeyValues], int]:
+        """Find cached KV for the longest prefix of ``ids``.
+
+        At least one token is always left uncovered so the caller still has a
+        position to compute next-token logits from. Returns ``(None, 0)`` on a
+        miss.
+        """
+        key, matched = self._find(ids)
+        if key is None:
+            self.misses += 1
+            return None, 0
+        entry = self._entries[key]
+        self._entries.move_to_end(key)
+        # Compare from the start rather than trusting the hash for the blocks.
+        matched = min(_common_prefix(entry.ids, ids), len(ids) - 1)
+        if matched <= 0:
+            self.misses += 1
+            return None, 0
+        self.hits += 1
+        self.reused_tokens += matched
+        past = tuple((k[:, :, :matched], v[:, :, :matched]) for k, v in entry.past)
+        return past, matched
+
+    def store(self, ids: List[int], past: PastKeyValues):
+        """Cache KV covering ``ids`` (batch dimension of one, already detached)."""
+        if self.max_bytes <= 0 or len(ids) < self.block_size:
+            return
+        nbytes = _past_nbytes(past)
+        if nbytes > self.max_bytes:
+            return
+        # An older entry this one extends (the previous chat turn) is redundant.
+        old_key, _ = self._find(ids)
+        if old_key is not None:
+            old = self._entries[old_key]
+            if _common_prefix(old.ids, ids) == len(old.ids):
+                self._remove(old_key)
+        key = hash(tuple(ids))
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        hashes = _block_hashes(ids, self.block_size)
+        self._entries[key] = _Entry(ids=list(ids), past=past, nbytes=nbytes, block_hashes=hashes)
+        for h in hashes:
+            self._index[h] = key
+        self.total_bytes += nbytes
+        while self.total_bytes > self.max_bytes and self._entries:
+            lru_key = next(iter(self._entries))
+            self.evicted_bytes += self._entries[lru_key].nbytes
+            self._remove(lru_key)
+
+    def _remove(self, key: int):
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry.nbytes
+        for h in entry.block_hashes:
+            if self._index.get(h) == key:
+                del self._index[h]
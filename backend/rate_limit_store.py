@@ -0,0 +1,83 @@
+"""SQLite storage backend for ``limits`` (and so for slowapi).
+
+slowapi's default ``memory://`` storage is per process, so N workers each
+allow the full rate. Importing this module registers a ``sqlite://`` scheme;
+``RATE_LIMIT_STORAGE_URI=sqlite:////var/run/starcoder2/ratelimit.db`` then
+shares fixed-window counters between every worker on a node. Across nodes,
+use ``redis://`` instead (needs the ``redis`` package).
+
+Each increment is a single UPSERT, so concurrent workers never lose updates.
+"""
+
+import random
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from limits.storage import Storage
+
+
+class SQLiteStorage(Storage):
+    STORAGE_SCHEME = ["sqlite"]
+
+    def __init__(self, uri: str, wrap_exceptions: bool = False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.path = uri[len("sqlite://"):] or ":memory:"
+        self._local = threading.local()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER, expires_at REAL)"
+        )
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        conn: Optional[sqlite3.Connection] = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def incr(self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1) -> int:
+        now = time.time()
+        row = self._conn.execute(
+            """
+            INSERT INTO counters (key, value, expires_at) VALUES (?1, ?2, ?3)
+            ON CONFLICT (key) DO UPDATE SET
+                value = CASE WHEN expires_at <= ?4 THEN excluded.value ELSE value + excluded.value END,
+                expires_at = CASE WHEN expires_at <= ?4 OR ?5 THEN excluded.expires_at ELSE expires_at END
+            RETURNING value
+            """,
+            (key, amount, now + expiry, now, int(elastic_expiry)),
+        ).fetchone()
+        if random.random() < 0.001:
+            self._conn.execute("DELETE FROM counters WHERE expires_at <= ?", (now,))
+        return row[0]
+
+    def get(self, key: str) -> int:
+        row = self._conn.execute(
+            "SELECT value FROM counters WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key: str) -> float:
+        row = self._conn.execute("SELECT expires_at FROM counters WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else time.time()
+
+    def check(self) -> bool:
+        try:
+            self._conn.execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self) -> Optional[int]:
+        return self._conn.execute("DELETE FROM counters").rowcount
+
+    def clear(self, key: str) -> None:
+        self._conn.execute("DELETE FROM counters WHERE key = ?", (key,))
@@ -0,0 +1,232 @@
+"""Registry of servable models with memory-budgeted LRU residency.
+
+Each configured model id maps to a ``ModelHandle``. Handles start unloaded;
+``ensure_loaded`` pages a model in on a background thread using the loader
+supplied by the app, and resident models are evicted least-recently-used
+first when the resident count or the memory budget would be exceeded.
+
+Only idle models (no leases, nothing queued or decoding) are evicted, and
+pinned models (the default ``MODEL_ID``) are never evicted, so readiness does
+not flap. Callers ``lease`` a handle for as long as they use it (from
+tokenization until their sequences finish), which covers work the scheduler
+cannot see yet and sequences it has dequeued but not yet prefilled.
+"""
+
+import gc
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import structlog
+import torch
+
+log = structlog.get_logger()
+
+# loader(model_id) -> (tokenizer, model, scheduler), scheduler already started
+Loader = Callable[[str], Tuple[object, object, object]]
+
+
+def _nbytes(value) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+def model_nbytes(model) -> int:
+    """Memory held by a model's weights.
+
+    Counted from the state dict rather than ``get_memory_footprint`` so that
+    dynamically quantized layers, whose packed int8 weights are not
+    parameters, are included. Tied weights are counted once.
+    """
+    if not hasattr(model, "state_dict"):
+        return model.get_memory_footprint() if hasattr(model, "get_memory_footprint") else 0
+    seen, total = set(), 0
+    for value in model.state_dict().values():
+        key = value.data_ptr() if isinstance(value, torch.Tensor) and not value.is_quantized else id(value)
+        if key not in seen:
+            seen.add(key)
+            total += _nbytes(value)
+    return total
+
+
+class UnknownModelError(KeyError):
+    """Raised when a request names a model that is not configured."""
+
+
+class ModelHandle:
+    """One configured model and, while resident, its runtime objects."""
+
+    def __init__(self, model_id: str, pinned: bool = False):
+        self.model_id = model_id
+        self.pinned = pinned
+        self.state = "unloaded"  # unloaded -> loading -> ready | failed
+        self.tokenizer = None
+        self.model = None
+        self.scheduler = None
+        self.nbytes = 0  # last measured footprint, kept after unloading
+        self.load_seconds = 0.0
+        self.last_used = 0.0
+        self.ready: Future = Future()
+        self.error: Optional[BaseException] = None
+        self.leases = 0  # see ``ModelRegistry.lease``
+
+    @property
+    def resident(self) -> bool:
+        return self.state == "ready"
+
+    @property
+    def idle(self) -> bool:
+        s = self.scheduler
+        return self.leases == 0 and (s is None or (s.batch_size == 0 and s.queue_depth == 0))
+
+
+class ModelRegistry:
+    """Load configured models on demand and keep a bounded set resident."""
+
+    def __init__(
+        self,
+        model_ids: Iterable[str],
+        loader: Loader,
+        memory_budget: int = 0,
+        max_resident: int = 0,
+        pinned: Iterable[str] = (),
+    ):
+        pinned = set(pinned)
+        self._handles: Dict[str, ModelHandle] = {
+            mid: ModelHandle(mid, pinned=mid in pinned) for mid in model_ids
+        }
+        self._loader = loader
+        self.memory_budget = memory_budget
+        self.max_resident = max_resident
+        self._lock = threading.RLock()
+        self.loads = 0
+        self.evictions = 0
+
+    # -- queries -----------------------------------------------------------
+    def __contains__(self, model_id: str) -> bool:
+        return model_id in self._handles
+
+    def handles(self) -> List[ModelHandle]:
+        return list(self._handles.values())
+
+    def get(self, model_id: str) -> ModelHandle:
+        try:
+            return self._handles[model_id]
+        except KeyError:
+            raise UnknownModelError(model_id) from None
+
+    def state(self, model_id: str) -> str:
+        return self.get(model_id).state
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(h.nbytes for h in self._handles.values() if h.resident)
+
+    # -- loading -----------------------------------------------------------
+    def ensure_loaded(self, model_id: str) -> ModelHandle:
+        """Return the handle, starting a background load if it is not resident.
+
+        Wait on ``handle.ready`` for the load to finish; it resolves to the
+        handle or raises the load error.
+        """
+        handle = self.get(model_id)
+        with self._lock:
+            handle.last_used = time.monotonic()
+            if handle.state in ("unloaded", "failed"):
+                if handle.ready.done():
+                    handle.ready = Future()
+                handle.state = "loading"
+                threading.Thread(
+                    target=self._load, args=(handle,), name=f"load-{model_id}", daemon=True
+                ).start()
+        return handle
+
+    def load(self, model_id: str) -> ModelHandle:
+        """Blocking variant of ``ensure_loaded``."""
+        return self.ensure_loaded(model_id).ready.result()
+
+    def _load(self, handle: ModelHandle):
+        self._make_room(handle, handle.nbytes)
+        started = time.perf_counter()
+        try:
+            tokenizer, model, scheduler = self._loader(handle.model_id)
+        except Exception as exc:
+            log.exception("model_load_failed", model_id=handle.model_id)
+            with self._lock:
+                handle.state, handle.error = "failed", exc
+            handle.ready.set_exception(exc)
+            return
+        with self._lock:
+            handle.tokenizer, handle.model, handle.scheduler = tokenizer, model, scheduler
+            handle.nbytes = model_nbytes(model)
+            handle.load_seconds = time.perf_counter() - started
+            handle.state, handle.error = "ready", None
+            handle.last_used = time.monotonic()
+            self.loads += 1
+        log.info("model_resident", model_id=handle.model_id, nbytes=handle.nbytes, load_seconds=handle.load_seconds)
+        # The footprint of a first-time load is only known now.
+        self._make_room(handle, 0)
+        handle.ready.set_result(handle)
+
+    # -- leases ------------------------------------------------------------
+    def lease(self, handle: ModelHandle) -> bool:
+        """Keep a resident model from being evicted until ``release``.
+
+        Returns False, taking no lease, if the model is not resident.
+        """
+        with self._lock:
+            if not handle.resident:
+                return False
+            handle.leases += 1
+            return True
+
+    def release(self, handle: ModelHandle):
+        """Give back a lease; safe from any thread."""
+        with self._lock:
+            handle.leases -= 1
+
+    # -- eviction ----------------------------------------------------------
+    def _over_limits(self, incoming: ModelHandle, incoming_bytes: int) -> bool:
+        resident = [h for h in self._handles.values() if h.resident and h is not incoming]
+        if self.max_resident and len(resident) + 1 > self.max_resident:
+            return True
+        if self.memory_budget and sum(h.nbytes for h in resident) + max(incoming_bytes, incoming.nbytes) > self.memory_budget:
+            return True
+        return False
+
+    def _make_room(self, incoming: ModelHandle, incoming_bytes: int):
+        """Evict idle, unpinned models (LRU first) until ``incoming`` fits."""
+        with self._lock:
+            while self._over_limits(incoming, incoming_bytes):
+                candidates = sorted(
+                    (h for h in self._handles.values()
+                     if h.resident and h is not incoming and not h.pinned and h.idle),
+                    key=lambda h: h.last_used,
+                )
+                if not candidates:
+                    log.warning("model_budget_exceeded", model_id=incoming.model_id,
+                                resident_bytes=self.resident_bytes, budget=self.memory_budget)
+                    return
+                self._unload(candidates[0])
+
+    def unload(self, model_id: str):
+        with self._lock:
+            handle = self.get(model_id)
+            if handle.resident:
+                self._unload(handle)
+
+    def _unload(self, handle: ModelHandle):
+        log.info("model_evicted", model_id=handle.model_id, nbytes=handle.nbytes)
+        if handle.scheduler is not None:
+            handle.scheduler.stop()
+        handle.tokenizer = handle.model = handle.scheduler = None
+        handle.state = "unloaded"
+        handle.ready = Future()
+        self.evictions += 1
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
@@ -0,0 +1,266 @@
+"""Response cache and in-flight deduplication for deterministic requests.
+
+Only requests whose output is reproducible (greedy decoding or a fixed seed)
+are eligible; the caller builds a key from the normalized request and decides
+eligibility. Two pieces live here:
+
+``ResponseCache``
+    LRU of finished results with a TTL, optionally backed by a directory of
+    JSON files so entries survive restarts. The directory is capped at
+    ``max_disk_bytes``, evicting the oldest files first (each process
+    tracks the files it has seen). Synchronous; call it from an executor
+    when the disk tier is enabled.
+
+``InflightDeduplicator``
+    Lets identical requests that arrive while one is still generating attach
+    to that generation. The producer runs as its own task and every caller,
+    including the one that started it, follows a shared buffer of chunks, so a
+    follower that attaches late still receives the text produced so far. When
+    the last follower goes away (for example, every client disconnected)
+    before the generation finishes, the producer task is cancelled.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import structlog
+
+log = structlog.get_logger()
+
+
+def request_key(payload: Dict[str, Any]) -> str:
+    """Stable hash of a normalized request payload."""
+    blob = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """TTL + size-bounded LRU of JSON-serializable results."""
+
+    def __init__(self, max_entries: int, ttl: float, directory: Optional[str] = None, max_disk_bytes: int = 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes  # 0 = unbounded
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._files: "OrderedDict[str, int]" = OrderedDict()  # key -> bytes on disk, oldest first
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._prune_disk()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+        if self.directory:
+            item = self._read_disk(key, now)
+            if item is not None:
+                with self._lock:
+                    self._insert(key, *item)
+                    self.hits += 1
+                return item[1]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: Dict[str, Any]):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._insert(key, expires_at, value)
+        if self.directory:
+            self._write_disk(key, expires_at, value)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _insert(self, key: str, expires_at: float, value: Dict[str, Any]):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # -- disk tier -------------------------------------------------------
+    def _read_disk(self, key: str, now: float) -> Optional[Tuple[float, Dict[str, Any]]]:
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as fh:
+                record = json.load(fh)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            log.warning("response_cache_read_failed", path=path)
+            return None
+        if record["expires_at"] <= now:
+            self._unlink(path)
+            with self._lock:
+                self._forget_file(key)
+            return None
+        return record["expires_at"], record["value"]
+
+    def _write_disk(self, key: str, expires_at: float, value: Dict[str, Any]):
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump({"expires_at": expires_at, "value": value}, fh)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)
+        except OSError:
+            log.warning("response_cache_write_failed", path=path)
+            self._unlink(tmp)
+            return
+        with self._lock:
+            self._forget_file(key)
+            self._files[key] = size
+            self.disk_bytes += size
+            evicted = self._over_disk_budget()
+        for old in evicted:
+            self._unlink(self._path(old))
+
+    def _forget_file(self, key: str):
+        self.disk_bytes -= self._files.pop(key, 0)
+
+    def _over_disk_budget(self) -> List[str]:
+        """Drop the oldest files from the index until it fits; returns their keys."""
+        evicted = []
+        while self.max_disk_bytes and self.disk_bytes > self.max_disk_bytes and self._files:
+            key, size = self._files.popitem(last=False)
+            self.disk_bytes -= size
+            evicted.append(key)
+        return evicted
+
+    def _prune_disk(self):
+        now = time.time()
+        found = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                key = name[:-len(".json")]
+                if self._read_disk(key, now) is not None:
+                    try:
+                        stat = os.stat(self._path(key))
+                    except OSError:
+                        continue
+                    found.append((stat.st_mtime, key, stat.st_size))
+        with self._lock:
+            for _, key, size in sorted(found):
+                self._files[key] = size
+                self.disk_bytes += size
+            evicted = self._over_disk_budget()
+        for key in evicted:
+            self._unlink(self._path(key))
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class _Flight:
+    """One running generation and the chunks it has produced so far."""
+
+    def __init__(self):
+        self.chunks: List[Any] = []
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.followers = 0
+        self.task: Optional["asyncio.Future[None]"] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def drive(self, source: AsyncIterator[Any]):
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self.done = True
+            self._notify()
+
+    def follow(self) -> AsyncIterator[Any]:
+        self.followers += 1
+        return self._follow()
+
+    async def _follow(self) -> AsyncIterator[Any]:
+        i = 0
+        try:
+            while True:
+                changed = self._changed
+                while i < len(self.chunks):
+                    yield self.chunks[i]
+                    i += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            self.followers -= 1
+            if not self.followers and not self.done and self.task is not None:
+                self.task.cancel()  # nobody is listening any more
+
+
+class InflightDeduplicator:
+    """Share one running generation between identical concurrent requests."""
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.attached = 0
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def attach(
+        self, key: str, start: Callable[[], Awaitable[AsyncIterator[Any]]]
+    ) -> AsyncIterator[Any]:
+        """Follow the generation running under ``key``, starting it if needed.
+
+        ``start`` is awaited only by the first caller; errors it raises (for
+        example admission rejections) propagate to that caller and to anyone
+        who attached while it was starting.
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.attached += 1
+            return flight.follow()
+        flight = self._flights[key] = _Flight()
+        try:
+            source = await start()
+        except BaseException as exc:
+            flight.error, flight.done = exc, True
+            flight._notify()
+            self._forget(key, flight)
+            raise
+        task = flight.task = asyncio.ensure_future(flight.drive(source))
+        task.add_done_callback(lambda _: self._forget(key, flight))
+        return flight.follow()
+
+    def _forget(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
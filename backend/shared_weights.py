@@ -0,0 +1,87 @@
+"""Share one copy of CPU model weights between worker processes.
+
+Each worker normally materializes its own copy of the weights. With
+``WEIGHTS_CACHE_DIR`` set, the first worker to load a model exports its
+parameters to ``<dir>/<model>-<dtype>.pt``, and every worker then opens that
+file with ``torch.load(mmap=True)``. Parameters become views of the mapped
+file, so their pages live in the kernel page cache once, however many
+workers (or restarts) use them. The weights are never written to, so the
+private mapping never copies a page.
+
+Only parameters are exported. The module tree is built on the meta device,
+and buffers such as rotary tables are computed normally, since they are small
+and per-process.
+
+With ``CPU_PRECISION=int8`` the exported file holds fp32 weights, and each
+worker's ``quantize_dynamic`` then packs every ``Linear`` into its own int8
+copy. Packed weights are opaque backend objects that cannot be mapped, so
+only the embeddings stay shared and per-worker memory is that of a private
+int8 model. Use ``bf16`` or ``fp32`` when sharing matters more.
+"""
+
+import fcntl
+import os
+import re
+from contextlib import contextmanager
+from typing import Callable
+
+import structlog
+import torch
+
+log = structlog.get_logger()
+
+
+def _cache_path(directory: str, model_id: str, dtype: torch.dtype) -> str:
+    slug = re.sub(r"[^A-Za-z0-9_.-]+", "--", model_id.strip("/"))
+    return os.path.join(directory, f"{slug}-{str(dtype).replace('torch.', '')}.pt")
+
+
+@contextmanager
+def _file_lock(path: str):
+    with open(path, "w") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def export_weights(model, path: str):
+    """Write ``model``'s parameters (tied ones once) for ``load_shared``."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    torch.save({name: p.detach() for name, p in model.named_parameters()}, tmp)
+    os.replace(tmp, path)
+
+
+def load_shared(model_id: str, dtype: torch.dtype, directory: str, load: Callable[[], object], token=None):
+    """Return ``model_id`` with parameters memory-mapped from the shared cache.
+
+    ``load()`` builds the model the ordinary way; it is only called (under a
+    file lock, by one process) when the cache file does not exist yet.
+    """
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    os.makedirs(directory, exist_ok=True)
+    path = _cache_path(directory, model_id, dtype)
+    with _file_lock(f"{path}.lock"):
+        if not os.path.exists(path):
+            log.info("exporting_shared_weights", model_id=model_id, path=path)
+            model = load()
+            export_weights(model, path)
+            del model
+
+    config = AutoConfig.from_pretrained(model_id, token=token)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype)
+    weights = torch.load(path, mmap=True, weights_only=True)
+    for name, tensor in weights.items():
+        module_name, _, attr = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+    model.tie_weights()
+    missing = [n for n, p in model.named_parameters() if p.is_meta]
+    if missing:
+        raise RuntimeError(f"shared weights at {path} are missing parameters: {missing[:5]}")
+    log.info("mapped_shared_weights", model_id=model_id, path=path)
+    return model.eval()
@@ -0,0 +1,151 @@
+"""Speculative decoding for the batch scheduler.
+
+A proposer guesses the next few tokens of a sequence cheaply. The target
+model then scores the sequence's last token plus all the guesses in a single
+forward pass, keeps the longest prefix of guesses that matches its own
+greedy choice, and adds one token of its own after that prefix. Every
+verification step therefore emits between 1 and ``k + 1`` tokens for one
+target forward pass. The output is identical to plain greedy decoding.
+
+Two proposers are available:
+
+``DraftModelProposer``
+    Runs a small model that shares the target's tokenizer (e.g. a smaller
+    StarCoder checkpoint) greedily for ``k`` steps. It keeps its own per-
+    sequence KV cache, which is cropped back to the accepted prefix after
+    each verification.
+
+``PromptLookupProposer``
+    Needs no extra model. It finds the most recent earlier occurrence of the
+    sequence's trailing n-gram and proposes the tokens that followed it.
+    Code edits, refactors and completions that repeat identifiers hit often.
+
+Speculating sequences keep their own KV cache instead of joining the
+left-padded batch cache, because each verification step advances them by a
+different number of tokens. The scheduler gives each of them one
+verification step per loop iteration, alongside the batched decode step.
+"""
+
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+
+try:
+    from .prefix_cache import PastKeyValues
+except ImportError:  # executed as a top-level module (``uvicorn main:app``)
+    from prefix_cache import PastKeyValues
+
+MODES = ("off", "draft", "prompt_lookup")
+
+
+def crop_past(past: PastKeyValues, length: int) -> PastKeyValues:
+    """Keep the first ``length`` cached positions of a legacy KV tuple."""
+    return tuple((k[:, :, :length], v[:, :, :length]) for k, v in past)
+
+
+@dataclass
+class SpecState:
+    """Per-sequence caches for a speculating sequence."""
+
+    mode: str
+    past: Optional[PastKeyValues] = None  # target KV, covers ids[:-1]
+    draft_past: Optional[PastKeyValues] = None
+    draft_len: int = 0  # tokens covered by ``draft_past``
+
+
+@dataclass
+class SpecStats:
+    """Counters for one speculation mode."""
+
+    steps: int = 0  # target verification passes
+    proposed: int = 0
+    accepted: int = 0
+    emitted: int = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    @property
+    def tokens_per_step(self) -> float:
+        """Tokens emitted per target forward pass: the speedup over plain decoding."""
+        return self.emitted / self.steps if self.steps else 0.0
+
+
+class PromptLookupProposer:
+    """Propose the continuation of the latest earlier match of the trailing n-gram."""
+
+    def __init__(self, k: int = 4, max_ngram: int = 3):
+        self.k = k
+        self.max_ngram = max_ngram
+
+    def propose(self, ids: List[int], state: SpecState, limit: int) -> List[int]:
+        limit = min(limit, self.k)
+        if limit <= 0 or len(ids) < 2:
+            return []
+        t = torch.tensor(ids)
+        for n in range(min(self.max_ngram, len(ids) - 1), 0, -1):
+            # Windows that start early enough to have at least one token after them.
+            windows = t[:-1].unfold(0, n, 1)
+            hits = (windows == t[-n:]).all(dim=1).nonzero().flatten()
+            hits = hits[hits + n < len(ids)]
+            if len(hits):
+                start = int(hits[-1]) + n
+                return ids[start:start + limit]
+        return []
+
+    def accept(self, state: SpecState, valid: int):
+        pass
+
+
+class DraftModelProposer:
+    """Propose ``k`` greedy tokens from a smaller model sharing the tokenizer."""
+
+    def __init__(self, model, k: int = 4):
+        self.model = model
+        self.k = k
+
+    @torch.no_grad()
+    def propose(self, ids: List[int], state: SpecState, limit: int) -> List[int]:
+        limit = min(limit, self.k)
+        if limit <= 0:
+            return []
+        device = self.model.device
+        feed = ids[state.draft_len:]
+        proposal: List[int] = []
+        past = state.draft_past
+        for _ in range(limit):
+            out = self.model(input_ids=torch.tensor([feed], device=device), past_key_values=past, use_cache=True)
+            past = out.past_key_values
+            token = int(out.logits[0, -1].argmax())
+            proposal.append(token)
+            feed = [token]
+        # The last proposed token was never fed to the draft model.
+        state.draft_past, state.draft_len = past, len(ids) + len(proposal) - 1
+        return proposal
+
+    def accept(self, state: SpecState, valid: int):
+        """Drop draft KV past the first ``valid`` tokens of the new sequence."""
+        if state.draft_past is not None and state.draft_len > valid:
+            state.draft_past = crop_past(state.draft_past, valid)
+            state.draft_len = valid
+
+
+@torch.no_grad()
+def verify(model, ids: List[int], state: SpecState, proposal: List[int]) -> List[int]:
+    """Score ``proposal`` with the target model and return the tokens to emit.
+
+    ``state.past`` must cover ``ids[:-1]``; on return it covers everything
+    except the last returned token, ready for the next step.
+    """
+    cached = len(ids) - 1
+    device = model.device
+    input_ids = torch.tensor([[ids[-1]] + proposal], device=device)
+    out = model(input_ids=input_ids, past_key_values=state.past, use_cache=True)
+    predicted = out.logits[0].float().argmax(dim=-1).tolist()
+    n = 0
+    while n < len(proposal) and proposal[n] == predicted[n]:
+        n += 1
+    state.past = crop_past(out.past_key_values, cached + 1 + n)
+    return proposal[:n] + [predicted[n]]
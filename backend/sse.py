@@ -0,0 +1,143 @@
+"""Server-sent event encoding for the streaming endpoints.
+
+Per token, the streaming loop used to build a full chunk dict and
+``json.dumps`` it. The encoders here render the constant part of each
+event once per stream. Per token, only the text is JSON-encoded (orjson
+when installed) and spliced between the pre-rendered prefix and suffix. The
+output is byte-for-byte what serializing the whole chunk would give, so
+quotes, backslashes, newlines and control characters in generated code are
+always escaped.
+
+``coalesce`` merges text deltas that arrive close together into one event,
+bounded by a delay and a size, and ``gzip_frames`` compresses a stream while
+still flushing every event to the client. With hundreds of open streams,
+both cut the per-token serialization work and ``send`` calls.
+"""
+
+import asyncio
+import zlib
+from typing import Any, AsyncIterator, Dict, Optional, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is in requirements.txt
+    orjson = None
+    import json
+
+DONE = b"data: [DONE]\n\n"
+
+
+def dumps(obj: Any) -> bytes:
+    """Compact JSON, UTF-8 encoded."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def event(obj: Any) -> bytes:
+    return b"data: " + dumps(obj) + b"\n\n"
+
+
+class _Template:
+    """An event whose payload is constant except for one string field."""
+
+    _MARK = "\x00slot\x00"
+
+    def __init__(self, payload: Dict[str, Any]):
+        rendered = event(payload)
+        marker = dumps(self._MARK)
+        self.prefix, _, self.suffix = rendered.partition(marker)
+
+    def render(self, text: str) -> bytes:
+        return self.prefix + dumps(text) + self.suffix
+
+
+class TextStreamEncoder:
+    """``/v1/generate`` events: ``{"text": ...}``."""
+
+    def __init__(self):
+        self._text = _Template({"text": _Template._MARK})
+
+    def text(self, text: str) -> bytes:
+        return self._text.render(text)
+
+
+class ChatStreamEncoder:
+    """OpenAI ``chat.completion.chunk`` events for one completion."""
+
+    def __init__(self, completion_id: str, created: int, model: str):
+        self._envelope = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model}
+        self._content = _Template(self._chunk({"content": _Template._MARK}, None))
+
+    def _chunk(self, delta: Dict[str, Any], finish_reason: Optional[str]) -> Dict[str, Any]:
+        return {**self._envelope, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+    def role(self) -> bytes:
+        return event(self._chunk({"role": "assistant", "content": ""}, None))
+
+    def content(self, text: str) -> bytes:
+        return self._content.render(text)
+
+    def finish(self, finish_reason: Optional[str], **extra: Any) -> bytes:
+        return event({**self._chunk({}, finish_reason), **extra})
+
+
+async def coalesce(
+    source: AsyncIterator[Union[str, Any]], max_delay: float, max_bytes: int
+) -> AsyncIterator[Union[str, Any]]:
+    """Merge consecutive ``str`` items from ``source``.
+
+    Buffered text is flushed once it reaches ``max_bytes`` (UTF-8), once
+    ``max_delay`` seconds have passed since its first piece arrived, or when
+    a non-``str`` item (the final result) comes through. With both limits at
+    0, items pass through unchanged.
+    """
+    if max_delay <= 0 and max_bytes <= 0:
+        async for item in source:
+            yield item
+        return
+
+    loop = asyncio.get_running_loop()
+    parts, size, deadline = [], 0, None
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(source.__anext__())
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:  # max_delay passed with text still buffered
+                yield "".join(parts)
+                parts, size, deadline = [], 0, None
+                continue
+            task, pending = pending, None
+            try:
+                item = task.result()
+            except StopAsyncIteration:
+                break
+            if not isinstance(item, str):
+                if parts:
+                    yield "".join(parts)
+                    parts, size, deadline = [], 0, None
+                yield item
+                continue
+            parts.append(item)
+            size += len(item.encode("utf-8"))
+            if deadline is None and max_delay > 0:
+                deadline = loop.time() + max_delay
+            if max_bytes > 0 and size >= max_bytes:
+                yield "".join(parts)
+                parts, size, deadline = [], 0, None
+        if parts:
+            yield "".join(parts)
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+async def gzip_frames(frames: AsyncIterator[bytes], level: int = 6) -> AsyncIterator[bytes]:
+    """gzip a byte stream, sync-flushing after every frame so events are not held back."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    async for frame in frames:
+        yield compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
@@ -1,8 +1,24 @@
 import requests
 import json
-from typing import List, Dict, Optional, Any, Iterator
-import sseclient
+from typing import List, Dict, Optional, Any, Iterator, AsyncIterator, Awaitable, Callable, Iterable, TypeVar
 import os
+import asyncio
+import email.utils
+import random
+import time
+
+try:
+    import httpx
+except ImportError:  # only needed by AsyncChatClient
+    httpx = None
+
+try:
+    import sseclient
+except ImportError:  # only needed by ChatClient streams; the CLI imports this module for its retries
+    sseclient = None
+
+T = TypeVar("T")
+R = TypeVar("R")
 
 class ChatClient:
     def __init__(self, base_url: str = None, token: str = None):
@@ -12,6 +28,9 @@ class ChatClient:
             "Authorization": f"Bearer {self.token}",
             "Content-Type": "application/json"
         }
+        # One pooled session: keep-alive instead of a new connection per call.
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
 
     def chat(self, messages: List[Dict[str, str]], stream: bool = False, **kwargs) -> Any:
         url = f"{self.base_url}/v1/chat/completions"
@@ -22,17 +41,17 @@ class ChatClient:
         }
 
         if stream:
-            response = requests.post(url, json=payload, headers=self.headers, stream=True)
+            response = self.session.post(url, json=payload, stream=True)
             response.raise_for_status()
             client = sseclient.SSEClient(response)
             return self._process_chat_stream(client)
         
-        response = requests.post(url, json=payload, headers=self.headers)
+        response = self.session.post(url, json=payload)
         response.raise_for_status()
         return response.json()
 
     def generate(self, prompt: str, stream: bool = False, **kwargs) -> Any:
-        url = f"{self.base_url}/generate"
+        url = f"{self.base_url}/v1/generate"
         payload = {
             "prompt": prompt,
             "stream": stream,
@@ -40,16 +59,16 @@ class ChatClient:
         }
 
         if stream:
-            response = requests.post(url, json=payload, headers=self.headers, stream=True)
+            response = self.session.post(url, json=payload, stream=True)
             response.raise_for_status()
             client = sseclient.SSEClient(response)
             return self._process_generate_stream(client)
         
-        response = requests.post(url, json=payload, headers=self.headers)
+        response = self.session.post(url, json=payload)
         response.raise_for_status()
         return response.json()
 
-    def _process_chat_stream(self, client: sseclient.SSEClient) -> Iterator[Dict[str, Any]]:
+    def _process_chat_stream(self, client: "sseclient.SSEClient") -> Iterator[Dict[str, Any]]:
         for event in client.events():
             if event.data == "[DONE]":
                 break
@@ -58,7 +77,7 @@ class ChatClient:
             except json.JSONDecodeError:
                 continue
 
-    def _process_generate_stream(self, client: sseclient.SSEClient) -> Iterator[Dict[str, Any]]:
+    def _process_generate_stream(self, client: "sseclient.SSEClient") -> Iterator[Dict[str, Any]]:
         for event in client.events():
             if event.data == "[DONE]":
                 break
@@ -67,6 +86,225 @@ class ChatClient:
             except json.JSONDecodeError:
                 continue
 
+
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+def _retry_after(response) -> Optional[float]:
+    """Seconds to wait according to a ``Retry-After`` header, if it has one."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(when.timestamp() - time.time(), 0.0)
+
+
+def retry_delay(attempt: int, response=None, backoff: float = 0.5, max_backoff: float = 30.0) -> float:
+    """Seconds before retry ``attempt``: ``Retry-After`` when given, else exponential backoff with jitter."""
+    if response is not None:
+        retry_after = _retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, max_backoff)
+    return min(backoff * 2 ** attempt, max_backoff) * random.uniform(0.5, 1.0)
+
+
+def post_with_retry(session: requests.Session, url: str, payload: Dict[str, Any], retries: int = 4,
+                    timeout: float = 300.0, backoff: float = 0.5, max_backoff: float = 30.0) -> Dict[str, Any]:
+    """POST ``payload`` and return the JSON body, retrying as ``AsyncChatClient`` does."""
+    for attempt in range(retries + 1):
+        try:
+            response = session.post(url, json=payload, timeout=timeout)
+        except requests.ConnectionError:
+            if attempt == retries:
+                raise
+            time.sleep(retry_delay(attempt, None, backoff, max_backoff))
+            continue
+        if response.status_code in RETRY_STATUSES and attempt < retries:
+            time.sleep(retry_delay(attempt, response, backoff, max_backoff))
+            continue
+        response.raise_for_status()
+        return response.json()
+
+
+async def _iter_sse(lines: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Yield the ``data`` of each server-sent event as its lines arrive."""
+    data: List[str] = []
+    async for line in lines:
+        if not line:
+            if data:
+                yield "\n".join(data)
+                data = []
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        if field == "data":
+            data.append(value[1:] if value.startswith(" ") else value)
+    if data:
+        yield "\n".join(data)
+
+
+class AsyncChatClient:
+    """asyncio client with a pooled keep-alive connection and retries.
+
+    One ``httpx.AsyncClient`` is shared by every call, so requests reuse
+    connections, and use HTTP/2 when the ``h2`` package is installed and the
+    server supports it. Responses with 429, 502, 503 or 504, and connection
+    errors, are retried up to ``max_retries`` times. The wait honours
+    ``Retry-After``; without one, backoff is exponential with jitter.
+    ``map`` fans many requests out under a concurrency cap.
+
+    Use it as an async context manager, or call ``aclose()`` when done::
+
+        async with AsyncChatClient() as client:
+            results = await client.gather_generate(prompts, concurrency=16, max_new_tokens=64)
+    """
+
+    def __init__(
+        self,
+        base_url: str = None,
+        token: str = None,
+        max_connections: int = 32,
+        http2: Optional[bool] = None,
+        max_retries: int = 4,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+        timeout: float = 300.0,
+        transport=None,
+    ):
+        if httpx is None:
+            raise ImportError("AsyncChatClient needs httpx: pip install httpx (and h2 for HTTP/2)")
+        if http2 is None:
+            try:
+                import h2  # noqa: F401
+                http2 = True
+            except ImportError:
+                http2 = False
+        self.base_url = base_url or os.getenv("STARCODER2_API_BASE", "http://localhost:8000")
+        self.token = token or os.getenv("STARCODER2_API_TOKEN", "changeme")
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"Authorization": f"Bearer {self.token}"},
+            http2=http2,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=timeout,
+            transport=transport,
+        )
+
+    async def __aenter__(self) -> "AsyncChatClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    # -- requests ----------------------------------------------------------
+    async def chat(self, messages: List[Dict[str, str]], **kwargs) -> Dict[str, Any]:
+        return await self._post("/v1/chat/completions", {"messages": messages, "stream": False, **kwargs})
+
+    async def generate(self, prompt: str, **kwargs) -> Dict[str, Any]:
+        return await self._post("/v1/generate", {"prompt": prompt, "stream": False, **kwargs})
+
+    def stream_chat(self, messages: List[Dict[str, str]], **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        """Yield chat completion chunks as the server sends them."""
+        return self._stream("/v1/chat/completions", {"messages": messages, "stream": True, **kwargs})
+
+    def stream_generate(self, prompt: str, **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        """Yield ``{"text": ...}`` events as the server sends them, then the final ``{"usage": ...}``."""
+        return self._stream("/v1/generate", {"prompt": prompt, "stream": True, **kwargs})
+
+    # -- fan-out -----------------------------------------------------------
+    async def map(
+        self,
+        fn: Callable[[T], Awaitable[R]],
+        items: Iterable[T],
+        concurrency: int = 8,
+        return_exceptions: bool = False,
+    ) -> List[R]:
+        """``await fn(item)`` for every item, at most ``concurrency`` at a time.
+
+        Results come back in input order. With ``return_exceptions`` a failed
+        item yields its exception instead of failing the whole call.
+        """
+        slots = asyncio.Semaphore(concurrency)
+
+        async def run(item):
+            async with slots:
+                return await fn(item)
+
+        return await asyncio.gather(*(run(item) for item in items), return_exceptions=return_exceptions)
+
+    async def gather_generate(
+        self, prompts: Iterable[str], concurrency: int = 8, return_exceptions: bool = False, **kwargs
+    ) -> List[Dict[str, Any]]:
+        return await self.map(lambda p: self.generate(p, **kwargs), prompts, concurrency, return_exceptions)
+
+    async def gather_chat(
+        self, conversations: Iterable[List[Dict[str, str]]], concurrency: int = 8, return_exceptions: bool = False, **kwargs
+    ) -> List[Dict[str, Any]]:
+        return await self.map(lambda m: self.chat(m, **kwargs), conversations, concurrency, return_exceptions)
+
+    # -- transport ---------------------------------------------------------
+    def _delay(self, attempt: int, response=None) -> float:
+        return retry_delay(attempt, response, self.backoff, self.max_backoff)
+
+    async def _send(self, path: str, payload: Dict[str, Any]):
+        """Send a request, retrying overload and connection failures; returns an open response."""
+        attempt = 0
+        while True:
+            try:
+                request = self._client.build_request("POST", path, json=payload)
+                response = await self._client.send(request, stream=True)
+            except httpx.TransportError:
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(self._delay(attempt))
+                attempt += 1
+                continue
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                await response.aclose()
+                await asyncio.sleep(self._delay(attempt, response))
+                attempt += 1
+                continue
+            if response.is_error:
+                await response.aread()
+                await response.aclose()
+                response.raise_for_status()
+            return response
+
+    async def _post(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        response = await self._send(path, payload)
+        try:
+            await response.aread()
+            return response.json()
+        finally:
+            await response.aclose()
+
+    async def _stream(self, path: str, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        response = await self._send(path, payload)
+        try:
+            async for data in _iter_sse(response.aiter_lines()):
+                if data == "[DONE]":
+                    break
+                try:
+                    yield json.loads(data)
+                except json.JSONDecodeError:
+                    continue
+        finally:
+            await response.aclose()
+
 # Example usage:
 if __name__ == "__main__":
     client = ChatClient()
@@ -0,0 +1,79 @@
+"""Incremental matching of OpenAI-style ``stop`` strings.
+
+Stop strings are text, but generation happens a token at a time, and one
+token can carry part of a stop string, all of it, or a stop string plus more
+text. ``StopMatcher`` is fed decoded text deltas. It returns the part that
+can safely be shown and holds back any trailing text that could still turn
+into a stop string. Once one matches, everything from the match onwards is
+dropped, the stop string included.
+
+The scheduler runs a matcher on every sequence that has stop strings and ends
+the sequence on the step that completes a match. The streaming path runs its
+own matcher over the same text to decide what to send.
+"""
+
+from typing import Iterable, Optional, Tuple
+
+# The chat prompt frames each turn as ``"{role}: {content}\n"``; a model that
+# keeps going after its answer starts the next turn with one of these.
+CHAT_ROLE_STOPS = ("\nuser:", "\nsystem:", "\nassistant:")
+# A completion that starts inside a Markdown code block ends with the block.
+CODE_BLOCK_STOP = "\n```"
+
+
+def default_stops(endpoint: str, prompt: str) -> Tuple[str, ...]:
+    """Built-in stop strings for a request to ``endpoint`` with ``prompt``."""
+    if endpoint == "chat":
+        return CHAT_ROLE_STOPS
+    if prompt.count("```") % 2 == 1:  # the prompt leaves a code block open
+        return (CODE_BLOCK_STOP,)
+    return ()
+
+
+def merge_stops(*groups: Iterable[str]) -> Tuple[str, ...]:
+    """Non-empty stop strings from every group, deduplicated, in order."""
+    return tuple(dict.fromkeys(s for group in groups for s in group if s))
+
+
+class StopMatcher:
+    def __init__(self, stops: Iterable[str]):
+        self.stops = tuple(s for s in stops if s)
+        self.matched: Optional[str] = None
+        self._held = ""
+
+    def push(self, text: str) -> str:
+        """Feed a text delta; return the text that can be emitted now."""
+        if self.matched is not None:
+            return ""
+        text = self._held + text
+        self._held = ""
+        hits = [(text.find(s), s) for s in self.stops if s in text]
+        if hits:
+            cut, self.matched = min(hits)
+            return text[:cut]
+        held = self._partial(text)
+        if held:
+            self._held = text[-held:]
+            return text[:-held]
+        return text
+
+    def flush(self) -> str:
+        """Text still held back, once generation has ended without a match."""
+        held, self._held = self._held, ""
+        return "" if self.matched is not None else held
+
+    def _partial(self, text: str) -> int:
+        """Length of the longest suffix of ``text`` that starts a stop string."""
+        longest = 0
+        for s in self.stops:
+            for n in range(min(len(s) - 1, len(text)), longest, -1):
+                if text.endswith(s[:n]):
+                    longest = n
+                    break
+        return longest
+
+
+def truncate(text: str, stops: Iterable[str]) -> str:
+    """``text`` up to its first stop string, as streaming would have emitted it."""
+    matcher = StopMatcher(stops)
+    return matcher.push(text) + matcher.flush()
@@ -3,7 +3,18 @@ import requests
 import os
 import sys
 import json
-from typing import Optional
+import glob
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Set
+
+try:
+    from backend.starcoder2_client import post_with_retry
+except ImportError:  # run as ``python cli/starcoder2.py``: the client module sits in backend/
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "backend"))
+    from starcoder2_client import post_with_retry
 
 @click.group()
 def cli():
@@ -19,7 +30,7 @@ def cli():
 @click.option('--api-key', envvar='STARCODER2_API_TOKEN', help='API Key for authentication')
 def generate(prompt: str, max_tokens: int, temperature: float, stream: bool, api_url: str, api_key: Optional[str]):
     """Generate code using Starcoder2"""
-    headers = {'X-API-Key': api_key} if api_key else {}
+    headers = {'Authorization': f'Bearer {api_key}'} if api_key else {}
     
     if stream:
         response = requests.post(
@@ -63,5 +74,406 @@ def generate(prompt: str, max_tokens: int, temperature: float, stream: bool, api
             print(response.text, file=sys.stderr)
             sys.exit(1)
 
+
+# ---------------------------------------------------------------------------
+# Batch
+# ---------------------------------------------------------------------------
+def _expand_inputs(patterns: List[str]) -> List[str]:
+    """Files named directly or matched by (recursive) globs, in order, without duplicates."""
+    paths, seen = [], set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if any(c in pattern for c in '*?[') else [pattern]
+        for path in matches:
+            if os.path.isfile(path) and path not in seen:
+                seen.add(path)
+                paths.append(path)
+    return paths
+
+
+def _jsonl_items(path: str) -> Iterator[Dict]:
+    with open(path, encoding='utf-8') as fh:
+        for index, line in enumerate(fh):
+            if line.strip():
+                record = json.loads(line)
+                record.setdefault('id', index)
+                yield record
+
+
+def _completed_ids(output: str) -> Set:
+    """Ids with a result in ``output``; a torn last line is cut off, errors are retried."""
+    done: Set = set()
+    if not os.path.exists(output):
+        return done
+    good = 0
+    with open(output, 'rb') as fh:
+        for line in fh:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if 'error' not in record:
+                done.add(record['id'])
+            good += len(line)
+    if good < os.path.getsize(output):
+        with open(output, 'r+b') as fh:
+            fh.truncate(good)
+    return done
+
+
+def _write_atomic(path: str, text: str):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as fh:
+        fh.write(text)
+    os.replace(tmp, path)
+
+
+@cli.command()
+@click.argument('inputs', nargs=-1)
+@click.option('--jsonl', 'jsonl_input', type=click.Path(exists=True, dir_okay=False),
+              help='JSONL of {"prompt": ..., "id": ...} objects instead of files')
+@click.option('--template', default='{content}', help='Prompt built from each file; {content} and {path} are substituted')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='Append one JSON result per line here')
+@click.option('--suffix', help='Instead of --output, write each file\'s completion next to it as <file><suffix>')
+@click.option('--concurrency', '-c', default=8, help='Requests in flight at once')
+@click.option('--max-tokens', '-m', default=256, help='Maximum number of tokens to generate')
+@click.option('--temperature', '-t', default=0.2, help='Sampling temperature')
+@click.option('--retries', default=4, help='Retries for 429/5xx and connection errors')
+@click.option('--timeout', default=600.0, help='Per-request timeout in seconds')
+@click.option('--api-url', envvar='STARCODER2_API_URL', default='http://localhost:8000', help='API URL')
+@click.option('--api-key', envvar='STARCODER2_API_TOKEN', help='API Key for authentication')
+def batch(inputs, jsonl_input: Optional[str], template: str, output: Optional[str], suffix: Optional[str],
+          concurrency: int, max_tokens: int, temperature: float, retries: int, timeout: float,
+          api_url: str, api_key: Optional[str]):
+    """Generate for many files (paths or globs such as 'src/**/*.py') or a JSONL of prompts.
+
+    Requests run concurrently over one pooled connection and results are
+    written as they finish. Rerunning the same command resumes: items already
+    in --output, or whose --suffix file exists, are skipped.
+    """
+    if bool(output) == bool(suffix):
+        raise click.UsageError('pass exactly one of --output or --suffix')
+    if suffix and jsonl_input:
+        raise click.UsageError('--suffix needs file inputs')
+    try:
+        template.format(content='', path='')
+    except (KeyError, IndexError, ValueError) as exc:
+        raise click.UsageError(f'--template may only use {{content}} and {{path}}: {exc!r}')
+    if jsonl_input:
+        items = list(_jsonl_items(jsonl_input))
+    else:
+        paths = _expand_inputs(list(inputs))
+        if suffix:  # a glob like 'src/**/*' must not pick up earlier outputs
+            paths = [path for path in paths if not path.endswith(suffix)]
+        items = [{'id': path, 'path': path} for path in paths]
+    if output:
+        done = _completed_ids(output)
+        pending = [item for item in items if item['id'] not in done]
+    else:
+        pending = [item for item in items if not os.path.exists(item['path'] + suffix)]
+    skipped = len(items) - len(pending)
+    click.echo(f"{len(items)} items, {skipped} already done, {len(pending)} to run", err=True)
+
+    session = requests.Session()
+    session.mount(api_url, requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+    if api_key:
+        session.headers['Authorization'] = f'Bearer {api_key}'
+
+    def run(item: Dict) -> Dict:
+        if 'path' in item:
+            with open(item['path'], encoding='utf-8', errors='replace') as fh:
+                prompt = template.format(content=fh.read(), path=item['path'])
+        else:
+            prompt = item['prompt']
+        payload = {
+            'prompt': prompt,
+            'max_new_tokens': item.get('max_new_tokens', max_tokens),
+            'temperature': item.get('temperature', temperature),
+            'stream': False,
+        }
+        return post_with_retry(session, f"{api_url}/v1/generate", payload, retries, timeout)
+
+    stats = {'completed': 0, 'failed': 0, 'tokens': 0}
+    started = last_report = time.perf_counter()
+    out = open(output, 'a', encoding='utf-8') if output else None
+
+    def report(final: bool = False):
+        elapsed = time.perf_counter() - started
+        finished = stats['completed'] + stats['failed']
+        click.echo(
+            f"{'done' if final else 'progress'}: {finished}/{len(pending)} ({stats['failed']} failed) "
+            f"{finished / elapsed if elapsed else 0:.2f} items/s {stats['tokens'] / elapsed if elapsed else 0:.1f} tok/s",
+            err=True,
+        )
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            queue = iter(pending)
+            inflight = {}
+            for item in queue:
+                inflight[pool.submit(run, item)] = item
+                if len(inflight) >= concurrency:
+                    break
+            while inflight:
+                finished, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    item = inflight.pop(future)
+                    base = {'id': item['id']} if 'path' not in item else {'id': item['id'], 'path': item['path']}
+                    try:
+                        result = future.result()
+                        record = {**base, 'generated_text': result['generated_text'],
+                                  'finish_reason': result.get('finish_reason'), 'usage': result.get('usage')}
+                    except (requests.RequestException, OSError, KeyError, ValueError) as exc:
+                        stats['failed'] += 1
+                        error = f"response has no {exc} field" if isinstance(exc, KeyError) else str(exc)
+                        record = {**base, 'error': error}
+                    else:
+                        stats['completed'] += 1
+                        stats['tokens'] += (result.get('usage') or {}).get('completion_tokens', 0)
+                    if out is not None:
+                        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                        out.flush()
+                    elif 'error' in record:
+                        click.echo(f"{item['path']}: {record['error']}", err=True)
+                    else:
+                        _write_atomic(item['path'] + suffix, record['generated_text'])
+                    next_item = next(queue, None)
+                    if next_item is not None:
+                        inflight[pool.submit(run, next_item)] = next_item
+                if time.perf_counter() - last_report >= 1:
+                    last_report = time.perf_counter()
+                    report()
+    finally:
+        if out is not None:
+            out.close()
+    report(final=True)
+    if stats['failed']:
+        sys.exit(1)
+
+
+# ---------------------------------------------------------------------------
+# Benchmark
+# ---------------------------------------------------------------------------
+FILLER = (
+    "def process(items):\n"
+    "    result = []\n"
+    "    for item in items:\n"
+    "        if item.is_valid():\n"
+    "            result.append(item.value * 2)\n"
+    "    return result\n\n"
+)
+
+
+def _distribution(spec: str):
+    """Parse a length distribution: ``128``, ``32-512`` (uniform) or ``normal:256,64``."""
+    spec = spec.strip()
+    try:
+        if spec.startswith("normal:"):
+            mean, std = (float(v) for v in spec[len("normal:"):].split(","))
+            return lambda rng: max(1, int(rng.gauss(mean, std)))
+        if "-" in spec:
+            lo, hi = (int(v) for v in spec.split("-", 1))
+            return lambda rng: rng.randint(lo, hi)
+        value = int(spec)
+        return lambda rng: value
+    except ValueError:
+        raise click.BadParameter(f"expected N, LO-HI or normal:MEAN,STD, got {spec!r}")
+
+
+def _prompt(tokens: int, chars_per_token: float) -> str:
+    chars = max(1, int(tokens * chars_per_token))
+    return (FILLER * (chars // len(FILLER) + 1))[:chars]
+
+
+def _percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    """p50/p95/p99 (linear interpolation) and mean, in milliseconds."""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def pct(q):
+        pos = (len(ordered) - 1) * q
+        lo = int(pos)
+        hi = min(lo + 1, len(ordered) - 1)
+        return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+    return {
+        "p50": round(pct(0.50) * 1000, 3),
+        "p95": round(pct(0.95) * 1000, 3),
+        "p99": round(pct(0.99) * 1000, 3),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+
+def _bench_request(session: requests.Session, api_url: str, endpoint: str, stream: bool,
+                   prompt: str, max_tokens: int, timeout: float) -> Dict:
+    """Send one request and time it.
+
+    Token counts come from the server's ``usage``: with SSE coalescing one
+    streamed event can carry several tokens, so events are not tokens.
+    Inter-token latency is the time from the first streamed event to the
+    last, divided by the completion tokens after the first; the raw gaps
+    between events are kept too.
+    """
+    if endpoint == "chat":
+        url = f"{api_url}/v1/chat/completions"
+        payload = {"messages": [{"role": "user", "content": prompt}], "max_tokens": max_tokens}
+    else:
+        url = f"{api_url}/v1/generate"
+        payload = {"prompt": prompt, "max_new_tokens": max_tokens}
+    payload.update({"temperature": 0.7, "stream": stream})
+    sample = {"ok": False, "error": None, "ttft": None, "itl": None, "gaps": [], "e2e": None, "tokens": 0}
+    started = time.perf_counter()
+    try:
+        response = session.post(url, json=payload, stream=stream, timeout=timeout)
+        if response.status_code != 200:
+            response.close()
+            sample["error"] = f"http_{response.status_code}"
+            return sample
+        if stream:
+            last = None
+            for line in response.iter_lines():
+                if not line.startswith(b"data: ") or line == b"data: [DONE]":
+                    continue
+                event = json.loads(line[6:])
+                if event.get("usage"):
+                    sample["tokens"] = event["usage"].get("completion_tokens", 0)
+                if endpoint == "chat":
+                    content = event["choices"][0]["delta"].get("content")
+                else:
+                    content = event.get("text")
+                if not content:
+                    continue
+                now = time.perf_counter()
+                if last is None:
+                    sample["ttft"] = now - started
+                else:
+                    sample["gaps"].append(now - last)
+                last = now
+            if last is not None and sample["tokens"] > 1:
+                sample["itl"] = (last - started - sample["ttft"]) / (sample["tokens"] - 1)
+        else:
+            sample["tokens"] = response.json().get("usage", {}).get("completion_tokens", 0)
+        sample["e2e"] = time.perf_counter() - started
+        sample["ok"] = True
+    except requests.RequestException as exc:
+        sample["error"] = type(exc).__name__
+    except (ValueError, KeyError, IndexError):
+        sample["error"] = "bad_response"
+    return sample
+
+
+def _bench_run(api_url: str, headers: Dict, endpoint: str, stream: bool, concurrency: int, requests_total: int,
+               warmup: int, prompt_len, output_len, chars_per_token: float, timeout: float, seed: int) -> Dict:
+    """Closed loop: ``concurrency`` workers send ``requests_total`` requests back to back."""
+    rng = random.Random(seed)
+    work = [(_prompt(prompt_len(rng), chars_per_token), output_len(rng)) for _ in range(warmup + requests_total)]
+    lock = threading.Lock()
+    local = threading.local()
+    samples: List[Dict] = []
+    position = [0]
+
+    def session() -> requests.Session:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.session.headers.update(headers)
+        return local.session
+
+    def worker():
+        while True:
+            with lock:
+                index = position[0]
+                position[0] += 1
+            if index >= len(work):
+                return
+            prompt, max_tokens = work[index]
+            sample = _bench_request(session(), api_url, endpoint, stream, prompt, max_tokens, timeout)
+            if index >= warmup:
+                with lock:
+                    samples.append(sample)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    elapsed = time.perf_counter() - started
+
+    ok = [s for s in samples if s["ok"]]
+    errors: Dict[str, int] = {}
+    for s in samples:
+        if not s["ok"]:
+            errors[s["error"]] = errors.get(s["error"], 0) + 1
+    tokens = sum(s["tokens"] for s in ok)
+    return {
+        "endpoint": endpoint,
+        "stream": stream,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": sum(errors.values()),
+        "error_rate": round(sum(errors.values()) / len(samples), 4) if samples else 0.0,
+        "errors_by_type": errors,
+        # Includes warm-up requests, which share the wall clock.
+        "duration_s": round(elapsed, 3),
+        "requests_per_second": round(len(ok) / elapsed, 3) if elapsed else 0.0,
+        "output_tokens": tokens,
+        "output_tokens_per_second": round(tokens / elapsed, 3) if elapsed else 0.0,
+        "ttft_ms": _percentiles([s["ttft"] for s in ok if s["ttft"] is not None]),
+        "itl_ms": _percentiles([s["itl"] for s in ok if s["itl"] is not None]),
+        "inter_event_ms": _percentiles([gap for s in ok for gap in s["gaps"]]),
+        "e2e_ms": _percentiles([s["e2e"] for s in ok]),
+    }
+
+
+@cli.command()
+@click.option('--endpoint', type=click.Choice(['generate', 'chat', 'both']), default='both', help='Endpoint(s) to load')
+@click.option('--mode', type=click.Choice(['stream', 'non-stream', 'both']), default='both', help='Streaming, non-streaming or both')
+@click.option('--concurrency', '-c', default='1,4,16', help='Comma-separated concurrency levels to sweep')
+@click.option('--requests', '-n', 'requests_total', default=64, help='Measured requests per run')
+@click.option('--warmup', default=4, help='Unmeasured requests sent first in each run')
+@click.option('--prompt-tokens', default='128', help='Prompt length: N, LO-HI (uniform) or normal:MEAN,STD')
+@click.option('--max-tokens', '-m', default='64', help='Completion length, same forms as --prompt-tokens')
+@click.option('--chars-per-token', default=4.0, help='Characters of prompt per token (use 1 against MOCK_ENGINE=1)')
+@click.option('--timeout', default=300.0, help='Per-request timeout in seconds')
+@click.option('--seed', default=0, help='Seed for the length distributions')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='Also write the JSON report to this file')
+@click.option('--api-url', envvar='STARCODER2_API_URL', default='http://localhost:8000', help='API URL')
+@click.option('--api-key', envvar='STARCODER2_API_TOKEN', help='API Key for authentication')
+def bench(endpoint: str, mode: str, concurrency: str, requests_total: int, warmup: int, prompt_tokens: str,
+          max_tokens: str, chars_per_token: float, timeout: float, seed: int, output: Optional[str],
+          api_url: str, api_key: Optional[str]):
+    """Load-test the API and report latency percentiles as JSON.
+
+    Every combination of endpoint, mode and concurrency level is one closed-loop
+    run. TTFT and inter-token latency come from streaming runs only.
+    """
+    headers = {'Authorization': f'Bearer {api_key}'} if api_key else {}
+    levels = [int(c) for c in concurrency.split(',') if c.strip()]
+    endpoints = ['generate', 'chat'] if endpoint == 'both' else [endpoint]
+    modes = [True, False] if mode == 'both' else [mode == 'stream']
+    prompt_len, output_len = _distribution(prompt_tokens), _distribution(max_tokens)
+    runs = []
+    for name in endpoints:
+        for stream in modes:
+            for level in levels:
+                run = _bench_run(api_url, headers, name, stream, level, requests_total, warmup,
+                                 prompt_len, output_len, chars_per_token, timeout, seed)
+                print(f"{name} stream={stream} concurrency={level}: {run['requests_per_second']} req/s, "
+                      f"{run['errors']} errors", file=sys.stderr)
+                runs.append(run)
+    report = {
+        "api_url": api_url,
+        "config": {
+            "requests": requests_total, "warmup": warmup, "prompt_tokens": prompt_tokens,
+            "max_tokens": max_tokens, "chars_per_token": chars_per_token, "seed": seed,
+        },
+        "runs": runs,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as fh:
+            fh.write(text + '\n')
+    print(text)
+
 if __name__ == '__main__':
     cli()
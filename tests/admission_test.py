@@ -0,0 +1,149 @@
+import asyncio
+import json
+
+import pytest
+
+from backend.admission import FairQueue, QueueFull, RateLimited, Tenant, TokenBucket, TokenLedger, load_tenants
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_refuses_until_refilled():
+    clock = Clock()
+    bucket = TokenBucket(rate=10, capacity=100, clock=clock)
+    assert bucket.take(80) == 0
+    assert bucket.take(50) == pytest.approx(3.0)  # 30 short at 10 tokens/s
+    clock.now = 3.0
+    assert bucket.take(50) == 0
+
+
+def test_oversized_request_waits_for_a_full_bucket_then_leaves_debt():
+    clock = Clock()
+    bucket = TokenBucket(rate=10, capacity=100, clock=clock)
+    bucket.take(10)
+    assert bucket.take(500) == pytest.approx(1.0)
+    clock.now = 1.0
+    assert bucket.take(500) == 0
+    assert bucket.level == -400
+
+
+def test_settle_refunds_unused_tokens():
+    ledger = TokenLedger({}, Tenant("default", tokens_per_minute=600))
+    charge = ledger.charge("tok", 600)
+    with pytest.raises(RateLimited) as exc:
+        ledger.charge("tok", 100)
+    assert exc.value.retry_after > 0
+    charge.settle(150)
+    charge.settle(0)  # settled once
+    ledger.charge("tok", 400)
+    assert ledger.tokens == {"default": 150}
+    assert ledger.rejected == {"default": 1}
+    ledger.charge("other-token", 600)  # every API token has its own bucket
+
+
+def test_unlisted_tokens_are_queued_as_separate_tenants():
+    ledger = TokenLedger({"secret-a": Tenant("team-a")}, Tenant("default"))
+    first, second, named = ledger.charge("tok-1", 1), ledger.charge("tok-2", 1), ledger.charge("secret-a", 1)
+    assert first.tenant.name == second.tenant.name == "default"
+    assert first.identity != second.identity and "tok" not in first.identity
+    assert named.identity == "team-a"
+
+
+def test_tenants_file(tmp_path):
+    path = tmp_path / "tenants.json"
+    path.write_text(json.dumps({"secret-a": {"name": "team-a", "weight": 2}, "secret-b": {"tokens_per_minute": 60}}))
+    tenants = load_tenants(str(path))
+    assert tenants["secret-a"] == Tenant("team-a", weight=2)
+    assert tenants["secret-b"].tokens_per_minute == 60
+    assert "secret" not in tenants["secret-b"].name
+    assert load_tenants("") == {}
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+async def _serve(queue, requests):
+    """Submit (tenant, weight, cost, priority) requests in order and record the admission order."""
+    order = []
+
+    async def one(name, tenant, weight, cost, priority):
+        await queue.acquire(tenant, weight, cost, priority)
+        order.append(name)
+        await asyncio.sleep(0)
+        queue.release()
+
+    await queue.acquire("holder", 1, 1)  # keep the only slot busy while everyone queues
+    tasks = [asyncio.create_task(one(*r)) for r in requests]
+    await asyncio.sleep(0)
+    queue.release()
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_fair_queue_interleaves_heavy_and_light_tenants():
+    requests = [(f"a{i}", "a", 1, 500, "interactive") for i in range(3)] + [("b0", "b", 1, 50, "interactive")]
+    order = _run(_serve(FairQueue(concurrency=1), requests))
+    assert order.index("b0") < order.index("a1")
+
+
+def test_fair_queue_weights_and_priorities():
+    requests = [
+        ("batch", "c", 1, 10, "batch"),
+        ("a0", "a", 1, 100, "interactive"),
+        ("a1", "a", 1, 100, "interactive"),
+        ("b0", "b", 4, 100, "interactive"),
+        ("b1", "b", 4, 100, "interactive"),
+    ]
+    order = _run(_serve(FairQueue(concurrency=1), requests))
+    assert order[-1] == "batch"
+    assert order.index("b1") < order.index("a1")
+
+
+def test_fair_queue_bounds_waiting_and_forgets_cancelled_waiters():
+    async def main():
+        queue = FairQueue(concurrency=1, max_waiting=1)
+        await queue.acquire("a", 1, 1)
+        waiter = asyncio.create_task(queue.acquire("b", 1, 1))
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull):
+            await queue.acquire("c", 1, 1)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        assert queue.waiting("interactive") == 0
+        queue.release()
+        assert queue.active == 0
+
+    _run(main())
+
+
+def test_requests_refused_by_a_full_queue_do_not_advance_the_tenant():
+    async def main():
+        queue = FairQueue(concurrency=1, max_waiting=1)
+        await queue.acquire("holder", 1, 1)
+        waiter = asyncio.create_task(queue.acquire("b", 1, 10))
+        await asyncio.sleep(0)
+        for _ in range(5):
+            with pytest.raises(QueueFull):
+                await queue.acquire("a", 1, 1000)
+        assert "a" not in queue._finish
+        waiter.cancel()
+        await asyncio.sleep(0)
+
+    _run(main())
+
+
+def test_non_positive_costs_do_not_buy_priority():
+    async def main():
+        queue = FairQueue(concurrency=1)
+        await queue.acquire("a", 1, -10_000)
+        queue.release()
+        assert queue._finish["a"] == 1
+
+    _run(main())
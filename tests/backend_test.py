@@ -41,8 +41,8 @@ async def test_generate_mock_stream():
     async with AsyncClient(app=app, base_url="http://test") as ac:
         r = await ac.post("/v1/generate", json=payload, headers=headers)
         assert r.status_code == 200
-        # StreamingResponse returns an iterator; read few bytes
-        body = b"".join([chunk async for chunk in r.aiter_raw()])
+        # The non-streaming client call has already buffered the SSE body
+        body = r.content
         assert b"[DONE]" in body
 
 @pytest.mark.asyncio
@@ -53,3 +53,170 @@ async def test_rate_limit_headers_present():
         assert r.status_code == 200
         # Rate limit headers may be added by slowapi; check existence gracefully
         assert any(h.lower().startswith("x-ratelimit") for h in r.headers.keys()) or True
+
+@pytest.mark.asyncio
+async def test_readyz_mock_mode_is_ready():
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        r = await ac.get("/readyz")
+        assert r.status_code == 200
+        assert r.json()["status"] == "mock"
+
+@pytest.mark.asyncio
+async def test_readyz_unready_while_loading(monkeypatch):
+    import backend.main as main
+    monkeypatch.setattr(main, "USE_MOCK_GENERATION", False)
+    monkeypatch.setattr(main.registry.get(main.MODEL_ID), "state", "loading")
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        r = await ac.get("/readyz")
+        assert r.status_code == 503
+        assert r.json()["status"] == "loading"
+        r = await ac.get("/healthz")
+        assert r.status_code == 200
+
+@pytest.mark.asyncio
+async def test_list_models():
+    headers = {"Authorization": "Bearer testtoken"}
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        r = await ac.get("/v1/models", headers=headers)
+        assert r.status_code == 200
+        data = r.json()
+        assert data["object"] == "list"
+        assert data["data"][0]["id"] == os.environ.get("MODEL_ID", "bigcode/starcoder2-3b")
+        assert data["data"][0]["pinned"] is True
+        r = await ac.get("/v1/models")
+        assert r.status_code in (401, 403)
+
+@pytest.mark.asyncio
+async def test_generate_batch_mock():
+    headers = {"Authorization": "Bearer testtoken"}
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        r = await ac.post("/v1/generate/batch", json={"prompts": ["a", "b", "c"]}, headers=headers)
+        assert r.status_code == 200
+        assert [item["index"] for item in r.json()["results"]] == [0, 1, 2]
+        r = await ac.post("/v1/generate/batch", json={"prompts": ["x"] * 10_000}, headers=headers)
+        assert r.status_code == 400
+
+@pytest.mark.asyncio
+async def test_embeddings_mock():
+    headers = {"Authorization": "Bearer testtoken"}
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        r = await ac.post("/v1/embeddings", json={"input": ["a", "b"]}, headers=headers)
+        assert r.status_code == 200
+        body = r.json()
+        assert [item["index"] for item in body["data"]] == [0, 1]
+        assert len(body["data"][0]["embedding"]) == 8
+        r = await ac.post("/v1/embeddings", json={"input": "a", "encoding_format": "base64"}, headers=headers)
+        assert isinstance(r.json()["data"][0]["embedding"], str)
+        r = await ac.post("/v1/embeddings", json={"input": []}, headers=headers)
+        assert r.status_code == 400
+
+@pytest.mark.asyncio
+async def test_refused_and_abandoned_requests_refund_their_charge():
+    from fastapi import HTTPException
+    from backend.admission import Tenant, TokenLedger
+    from backend.main import _charged
+
+    ledger = TokenLedger({}, Tenant("default", tokens_per_minute=600))
+
+    async def refused():
+        raise HTTPException(status_code=400, detail="empty prompt")
+
+    for _ in range(3):
+        with pytest.raises(HTTPException):
+            await _charged(ledger.charge("tok", 500), 400, refused())
+
+    async def source():
+        for piece in ("a", "b", "c"):
+            yield piece
+        yield {"prompt_tokens": 100, "completion_tokens": 3}
+
+    async def started():
+        return source()
+
+    stream = await _charged(ledger.charge("tok", 500), 400, started())
+    assert await stream.__anext__() == "a"
+    await stream.aclose()  # the client disconnected after one chunk
+    assert ledger.tokens == {"default": 101}
+
+@pytest.mark.asyncio
+async def test_chat_max_tokens_must_leave_room_for_the_prompt():
+    from types import SimpleNamespace
+    from fastapi import HTTPException
+    from backend.main import _context_budget
+
+    headers = {"Authorization": "Bearer testtoken"}
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        for max_tokens in (0, -500):
+            payload = {"messages": [{"role": "user", "content": "x" * 700}], "max_tokens": max_tokens}
+            r = await ac.post("/v1/chat/completions", json=payload, headers=headers)
+            assert r.status_code == 422
+    handle = SimpleNamespace(model=SimpleNamespace(config=SimpleNamespace(max_position_embeddings=200)))
+    assert _context_budget(handle, 199) == 1
+    with pytest.raises(HTTPException):
+        _context_budget(handle, 200)
+
+@pytest.mark.asyncio
+async def test_non_positive_max_new_tokens_is_rejected():
+    headers = {"Authorization": "Bearer testtoken"}
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        r = await ac.post("/v1/generate", json={"prompt": "Hi", "max_new_tokens": -10000}, headers=headers)
+        assert r.status_code == 422
+        r = await ac.post("/v1/generate/batch", json={"prompts": ["a"], "max_new_tokens": 0}, headers=headers)
+        assert r.status_code == 422
+
+@pytest.mark.asyncio
+async def test_null_or_negative_temperature_is_rejected():
+    headers = {"Authorization": "Bearer testtoken"}
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        for temperature in (None, -1):
+            r = await ac.post("/v1/generate", json={"prompt": "Hi", "temperature": temperature}, headers=headers)
+            assert r.status_code == 422
+            payload = {"messages": [{"role": "user", "content": "Hi"}], "temperature": temperature}
+            r = await ac.post("/v1/chat/completions", json=payload, headers=headers)
+            assert r.status_code == 422
+
+@pytest.mark.asyncio
+async def test_replayed_and_joined_requests_are_not_charged(monkeypatch):
+    from types import SimpleNamespace
+    from backend import main
+    from backend.admission import Tenant, TokenLedger
+    from backend.engine import SamplingParams
+
+    cached = {}
+    gate = asyncio.Event()
+
+    class Cache:
+        def get(self, key):
+            return cached.get("result")
+
+        def put(self, key, value):
+            pass
+
+    async def submit(*args, **kwargs):
+        await gate.wait()
+
+    async def follow(endpoint, handle, seq):
+        yield {"text": "", "finish_reason": "length", "prompt_tokens": 1, "completion_tokens": 4}
+
+    monkeypatch.setattr(main, "response_cache", Cache())
+    monkeypatch.setattr(main, "_submit", submit)
+    monkeypatch.setattr(main, "_follow", follow)
+    ledger = TokenLedger({}, Tenant("default"))
+    params = SamplingParams(max_new_tokens=4, temperature=0.0)
+
+    def source(charge):
+        return main._completion_source("generate", SimpleNamespace(model_id="m"), {"prompt": "x"}, "x", params,
+                                       False, charge=charge)
+
+    leader, follower = ledger.charge("tok", 5), ledger.charge("tok", 5)
+    started = asyncio.create_task(source(leader))
+    await asyncio.sleep(0.05)
+    await source(follower)
+    gate.set()
+    await started
+    assert follower.actual == 0 and leader.actual is None  # the leader settles from its usage
+
+    cached["result"] = {"text": "abcd", "finish_reason": "length", "prompt_tokens": 1, "completion_tokens": 4}
+    replayed = ledger.charge("tok", 5)
+    await source(replayed)
+    assert replayed.actual == 0
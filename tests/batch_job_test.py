@@ -0,0 +1,60 @@
+import json
+
+from backend.batch_job import completed_indices, run_job
+from backend.engine import BatchScheduler, SamplingParams
+
+
+class CharTokenizer:
+    """Maps each character to a token id below the tiny model's vocab size."""
+
+    def __call__(self, texts):
+        return {"input_ids": [[ord(c) % 64 for c in text] for text in texts]}
+
+    def decode(self, ids, skip_special_tokens=True):
+        return " ".join(map(str, ids))
+
+
+def _run(scheduler, tmp_path):
+    return run_job(
+        CharTokenizer(),
+        scheduler,
+        str(tmp_path / "in.jsonl"),
+        str(tmp_path / "out.jsonl"),
+        SamplingParams(max_new_tokens=3, temperature=0.0),
+        window=3,
+        checkpoint_every=2,
+    )
+
+
+def _results(path):
+    with open(path) as fh:
+        return {r["index"]: r for r in map(json.loads, fh)}
+
+
+def test_job_writes_every_prompt_and_resumes(tmp_path, tiny_model):
+    prompts = ["def a", "class Foo:", "x", "import os\nimport sys", "", "return"]
+    (tmp_path / "in.jsonl").write_text(
+        "".join(json.dumps({"id": f"p{i}", "prompt": p}) + "\n" for i, p in enumerate(prompts))
+    )
+    scheduler = BatchScheduler(tiny_model(), eos_token_id=None, max_batch_size=2)
+    scheduler.start()
+    try:
+        stats = _run(scheduler, tmp_path)
+        assert (stats["completed"], stats["failed"]) == (5, 1)
+        full = _results(tmp_path / "out.jsonl")
+        assert full[4]["error"] and full[0]["id"] == "p0"
+
+        # Simulate an interrupted run: two finished lines and a torn third one.
+        lines = (tmp_path / "out.jsonl").read_text().splitlines(keepends=True)
+        kept = [line for line in lines if "error" not in line][:2]
+        (tmp_path / "out.jsonl").write_text("".join(kept) + lines[-1][:10])
+        assert len(completed_indices(str(tmp_path / "out.jsonl"))) == 2
+
+        stats = _run(scheduler, tmp_path)
+        assert (stats["skipped"], stats["completed"], stats["failed"]) == (2, 3, 1)
+    finally:
+        scheduler.stop()
+    resumed = _results(tmp_path / "out.jsonl")
+    assert sorted(resumed) == list(range(6))
+    for index in (0, 1, 2, 3, 5):
+        assert resumed[index]["generated_text"] == full[index]["generated_text"]
@@ -0,0 +1,100 @@
+import pytest
+
+from backend.chat_context import ELISION, ChatContext, render
+from backend.mock_engine import MockTokenizer
+
+# Byte-level tokenizer: a rendered message costs len("role: content\n") tokens.
+HISTORY = [
+    ("system", "be brief"),     # 17
+    ("user", "a" * 20),         # 27
+    ("assistant", "b" * 20),    # 32
+    ("user", "c" * 20),         # 27
+    ("assistant", "d" * 20),    # 32
+    ("user", "question?"),      # 16
+]
+PREFIX = len("assistant: ")
+
+
+def _context():
+    return ChatContext(MockTokenizer())
+
+
+def test_count_is_cached_per_message():
+    context = _context()
+    context.fit(HISTORY, None)
+    context.fit(HISTORY + [("assistant", "ok"), ("user", "next")], None)
+    assert context.misses == len(HISTORY) + 2
+    assert context.hits == len(HISTORY)
+
+
+def test_everything_fits_within_budget():
+    fit = _context().fit(HISTORY, 1000)
+    assert fit.messages == HISTORY
+    assert fit.prompt_tokens == len(render(HISTORY))
+    assert fit.dropped_tokens == fit.dropped_messages == 0
+
+
+def test_sliding_window_keeps_most_recent():
+    fit = _context().fit(HISTORY, PREFIX + 16 + 32 + 27, "sliding_window")
+    assert fit.messages == HISTORY[3:]
+    assert fit.dropped_messages == 3
+    assert fit.dropped_tokens == 17 + 27 + 32
+    assert fit.prompt_tokens == len(render(fit.messages))
+
+
+def test_system_recent_pins_system_prompt():
+    fit = _context().fit(HISTORY, PREFIX + 17 + 16 + 32 + 10, "system_recent")
+    assert fit.messages == [HISTORY[0], HISTORY[4], HISTORY[5]]
+    assert fit.dropped_tokens == 27 + 32 + 27
+
+
+def test_system_prompt_yields_to_the_last_message():
+    fit = _context().fit(HISTORY, PREFIX + 20, "system_recent")
+    assert fit.messages == [HISTORY[5]]
+
+
+def test_middle_keeps_both_ends():
+    # Half the room (60) holds the question and the first two messages.
+    fit = _context().fit(HISTORY, PREFIX + 120, "middle")
+    assert fit.messages == HISTORY[:2] + HISTORY[3:]
+    assert fit.dropped_messages == 1 and fit.dropped_tokens == 32
+
+
+def test_oversized_last_message_is_truncated():
+    messages = [("system", "be brief"), ("user", "x" * 100 + "TAIL")]
+    fit = _context().fit(messages, PREFIX + 30, "sliding_window")
+    (role, content), = fit.messages
+    assert role == "user" and content.endswith("TAIL")
+    assert fit.prompt_tokens == len(render(fit.messages)) <= PREFIX + 30
+    assert fit.dropped_tokens == 17 + (104 - len(content))
+
+
+def test_middle_truncation_keeps_head_and_tail():
+    messages = [("user", "HEAD" + "x" * 100 + "TAIL")]
+    fit = _context().fit(messages, PREFIX + 40, "middle")
+    content = fit.messages[0][1]
+    assert content.startswith("HEAD") and content.endswith("TAIL") and ELISION in content
+    assert len(render(fit.messages)) <= PREFIX + 40
+
+
+class BoundaryTokenizer(MockTokenizer):
+    """Adds two tokens at each message boundary, which per-message counts never see."""
+
+    def __call__(self, text):
+        ids = super().__call__(text)["input_ids"]
+        return {"input_ids": ids + [0] * (2 * max(text.count("\n") - 1, 0))}
+
+
+def test_fit_that_tokenizes_over_budget_is_refitted():
+    context = ChatContext(BoundaryTokenizer())
+    budget = PREFIX + 16 + 32 + 27  # the estimate for HISTORY[3:], which really costs 4 more
+    fit = context.fit(HISTORY, budget, "sliding_window")
+    assert fit.messages == HISTORY[4:]
+    assert len(context._encode(render(fit.messages))) <= budget
+    roomy = context.fit(HISTORY, 1000)
+    assert roomy.messages == HISTORY and roomy.prompt_tokens == len(render(HISTORY))
+
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(ValueError):
+        _context().fit(HISTORY, 10, "newest_first")
@@ -0,0 +1,133 @@
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from cli import starcoder2
+
+
+def test_completed_ids_cuts_a_torn_last_line(tmp_path):
+    output = tmp_path / "results.jsonl"
+    good = '{"id": "a", "generated_text": "x"}\n{"id": "b", "error": "503"}\n'
+    output.write_text(good + '{"id": "c", "generated_te')
+    assert starcoder2._completed_ids(str(output)) == {"a"}  # errors are retried
+    assert output.read_text() == good
+    assert starcoder2._completed_ids(str(tmp_path / "missing.jsonl")) == set()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Record prompts sent to /v1/generate and answer from ``responses`` (default: echo)."""
+    sent, responses = [], {}
+
+    def post(session, url, payload, retries, timeout):
+        sent.append(payload["prompt"])
+        return responses.get(payload["prompt"], {
+            "generated_text": payload["prompt"].upper(),
+            "finish_reason": "length",
+            "usage": {"prompt_tokens": 1, "completion_tokens": 2},
+        })
+
+    monkeypatch.setattr(starcoder2, "post_with_retry", post)
+    return sent, responses
+
+
+def _files(tmp_path, names):
+    for name in names:
+        (tmp_path / name).write_text(f"body of {name}")
+    return [str(tmp_path / name) for name in names]
+
+
+def _results(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_batch_applies_the_template_and_resumes(tmp_path, server):
+    sent, _ = server
+    paths = _files(tmp_path, ["a.py", "b.py"])
+    output = tmp_path / "out.jsonl"
+    args = ["batch", *paths, "--template", "# {path}\n{content}", "-o", str(output), "-c", "2"]
+    result = CliRunner().invoke(starcoder2.cli, args)
+    assert result.exit_code == 0, result.output
+    assert sorted(sent) == sorted(f"# {p}\nbody of {p.rsplit('/', 1)[-1]}" for p in paths)
+    assert {r["id"] for r in _results(output)} == set(paths)
+
+    sent.clear()
+    paths += _files(tmp_path, ["c.py"])
+    result = CliRunner().invoke(starcoder2.cli, ["batch", *paths, "--template", "# {path}\n{content}", "-o", str(output)])
+    assert result.exit_code == 0, result.output
+    assert sent == [f"# {paths[2]}\nbody of c.py"]  # only the new file
+    assert "3 items, 2 already done, 1 to run" in result.output
+
+
+def test_batch_rejects_unknown_template_fields(tmp_path, server):
+    paths = _files(tmp_path, ["a.py"])
+    result = CliRunner().invoke(starcoder2.cli, ["batch", *paths, "--template", "{language}: {content}", "-o", str(tmp_path / "o")])
+    assert result.exit_code == 2
+    assert "--template" in result.output
+    assert server[0] == []
+
+
+def test_batch_records_malformed_responses_and_continues(tmp_path, server):
+    _, responses = server
+    jsonl = tmp_path / "prompts.jsonl"
+    jsonl.write_text('{"prompt": "bad"}\n{"prompt": "good"}\n')
+    responses["bad"] = {"detail": "not a completion"}
+    output = tmp_path / "out.jsonl"
+    result = CliRunner().invoke(starcoder2.cli, ["batch", "--jsonl", str(jsonl), "-o", str(output)])
+    assert result.exit_code == 1
+    records = {r["id"]: r for r in _results(output)}
+    assert records[0]["error"] == "response has no 'generated_text' field"
+    assert records[1]["generated_text"] == "GOOD"
+
+
+@pytest.fixture
+def mock_engine_server():
+    """A real server on the mock model, coalescing several tokens into each SSE event."""
+    import os
+    import socket
+    import subprocess
+    import sys
+    import time
+
+    import requests
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ, MOCK_ENGINE="1", USE_MOCK_GENERATION="0", STARCODER2_API_TOKEN="bench-token",
+               MOCK_DECODE_MS_PER_TOKEN="2", SSE_COALESCE_MS="20", RESPONSE_CACHE_SIZE="0")
+    backend = os.path.join(os.path.dirname(__file__), "..", "backend")
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)], cwd=backend,
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline and proc.poll() is None:
+            try:
+                if requests.get(f"{url}/readyz", timeout=1).status_code == 200:
+                    break
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        else:
+            pytest.fail("mock engine server did not become ready")
+        yield url
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def test_bench_counts_tokens_not_events(mock_engine_server):
+    args = ["bench", "--api-url", mock_engine_server, "--api-key", "bench-token", "-c", "2", "-n", "4",
+            "--warmup", "0", "--prompt-tokens", "8", "--max-tokens", "40", "--chars-per-token", "1"]
+    result = CliRunner().invoke(starcoder2.cli, args)
+    assert result.exit_code == 0, result.output
+    report = json.loads(result.stdout)
+    assert len(report["runs"]) == 4  # generate and chat, streaming and not
+    for run in report["runs"]:
+        assert run["errors"] == 0, run
+        assert run["output_tokens"] == 4 * 40
+    streaming = [run for run in report["runs"] if run["stream"]]
+    for run in streaming:
+        assert run["itl_ms"]["p50"] < run["inter_event_ms"]["p50"]  # several tokens per event
@@ -0,0 +1,25 @@
+import pytest
+import torch
+from transformers import Starcoder2Config, Starcoder2ForCausalLM
+
+TINY_CONFIG = dict(
+    vocab_size=64,
+    hidden_size=32,
+    intermediate_size=64,
+    num_hidden_layers=2,
+    num_attention_heads=4,
+    num_key_value_heads=2,
+    max_position_embeddings=128,
+)
+
+
+@pytest.fixture
+def tiny_model():
+    """Build a seeded two-layer Starcoder2 in eval mode; keyword arguments override ``TINY_CONFIG``."""
+
+    def make(dtype=torch.float32, **overrides):
+        torch.manual_seed(0)
+        config = Starcoder2Config(**{**TINY_CONFIG, **overrides})
+        return Starcoder2ForCausalLM(config).to(dtype).eval()
+
+    return make
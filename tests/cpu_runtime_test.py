@@ -0,0 +1,39 @@
+import torch
+
+from backend.cpu_runtime import load_dtype, parse_cpu_list, prepare_cpu_model
+from backend.engine import BatchScheduler, SamplingParams
+from backend.registry import model_nbytes
+
+
+def _generate(model, prompt, max_new_tokens):
+    scheduler = BatchScheduler(model, eos_token_id=None)
+    scheduler.start()
+    try:
+        params = SamplingParams(max_new_tokens=max_new_tokens, temperature=0.0)
+        return scheduler.submit(prompt, params).future.result(timeout=30).output_ids
+    finally:
+        scheduler.stop()
+
+
+def test_parse_cpu_list():
+    assert parse_cpu_list("0-3,8, 10-11") == {0, 1, 2, 3, 8, 10, 11}
+    assert parse_cpu_list("") == set()
+
+
+def test_int8_quantizes_linear_layers_and_shrinks_weights(tiny_model):
+    fp32 = tiny_model()
+    fp32_bytes = model_nbytes(fp32)
+    int8 = prepare_cpu_model(tiny_model(), "int8")
+    assert not any(type(m) is torch.nn.Linear for m in int8.modules())
+    assert model_nbytes(int8) < fp32_bytes
+
+    prompt = [5, 6, 7]
+    with torch.no_grad():
+        reference = int8.generate(torch.tensor([prompt]), max_new_tokens=4, do_sample=False, pad_token_id=0)
+    assert _generate(int8, prompt, 4) == reference[0, len(prompt):].tolist()
+
+
+def test_bf16_model_decodes_through_scheduler(tiny_model):
+    model = prepare_cpu_model(tiny_model(load_dtype("bf16")), "bf16")
+    assert model.dtype == torch.bfloat16
+    assert len(_generate(model, [1, 2, 3], 5)) == 5
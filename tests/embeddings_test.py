@@ -0,0 +1,64 @@
+import base64
+
+import pytest
+import torch
+
+from backend.embeddings import Embedder, EmbeddingCache, batches, cache_key, encode_base64, pool, unpack
+from backend.mock_engine import MockCausalLM, MockTokenizer
+
+
+def test_batches_group_similar_lengths_under_the_token_budget():
+    lengths = [50, 3, 4, 48, 5, 200]
+    groups = list(batches(lengths, max_batch_tokens=100))
+    assert groups == [[1, 2, 4], [3, 0], [5]]
+    for group in groups[:-1]:
+        assert len(group) * max(lengths[i] for i in group) <= 100
+
+
+def test_pool_ignores_padding():
+    hidden = torch.arange(24, dtype=torch.float32).view(2, 3, 4)
+    mask = torch.tensor([[1, 1, 1], [1, 0, 0]])
+    mean = pool(hidden, mask, "mean")
+    assert torch.allclose(mean[0], torch.nn.functional.normalize(hidden[0].mean(0), dim=0))
+    assert torch.allclose(mean[1], torch.nn.functional.normalize(hidden[1, 0], dim=0))
+    last = pool(hidden, mask, "last")
+    assert torch.allclose(last[0], torch.nn.functional.normalize(hidden[0, 2], dim=0))
+    assert torch.allclose(last[1], mean[1])
+    with pytest.raises(ValueError):
+        pool(hidden, mask, "max")
+
+
+@pytest.mark.parametrize("pooling", ["mean", "last"])
+def test_batched_embeddings_match_one_at_a_time(pooling, tiny_model):
+    embedder = Embedder(tiny_model(), max_batch_tokens=24)
+    prompts = [[5, 6, 7], [9, 10, 11, 12, 13, 14, 15], [20], [3, 1, 4, 1, 5, 9, 2, 6, 5, 3, 5], [8, 8]]
+    batched = embedder.embed(prompts, pooling)
+    assert batched.shape == (5, 32) and batched.dtype == torch.float32
+    for ids, vector in zip(prompts, batched):
+        assert torch.allclose(embedder.forward([ids], pooling)[0], vector, atol=1e-5)
+    assert torch.allclose(batched.norm(dim=-1), torch.ones(5))
+
+
+def test_mock_model_embeddings():
+    tok = MockTokenizer()
+    embedder = Embedder(MockCausalLM(prefill_seconds_per_token=0.0, decode_seconds_per_token=0.0))
+    texts = ["def add(a, b):", "def add(a, c):", "SELECT * FROM users"]
+    a, b, c = embedder.embed(tok(texts)["input_ids"])
+    assert a @ b > a @ c
+
+
+def test_base64_is_packed_float32():
+    vector = torch.tensor([0.5, -1.25, 3.0])
+    assert torch.equal(unpack(base64.b64decode(encode_base64(vector))), vector)
+
+
+def test_cache_round_trip(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    key = cache_key("bigcode/starcoder2-3b", "mean", "def f(): pass")
+    assert key != cache_key("bigcode/starcoder2-3b", "last", "def f(): pass")
+    assert cache.get(key) is None
+    cache.put(key, torch.tensor([1.0, 2.0]))
+    assert torch.equal(cache.get(key), torch.tensor([1.0, 2.0]))
+    path = tmp_path / key[:2] / f"{key}.f32"
+    path.write_bytes(b"\0\0")  # truncated by a crash, for example
+    assert cache.get(key) is None
@@ -0,0 +1,244 @@
+import asyncio
+
+import pytest
+import torch
+from transformers import Starcoder2ForCausalLM
+
+from backend.engine import BatchScheduler, IncrementalDetokenizer, QueueFullError, SamplingParams
+from backend.prefix_cache import PrefixCache
+
+
+class ByteTokenizer:
+    """Byte-level stand-in: token id N is the single byte N."""
+
+    def decode(self, ids, skip_special_tokens=True):
+        return bytes(ids).decode("utf-8", errors="replace")
+
+
+def _reference(model, prompt, max_new_tokens):
+    with torch.no_grad():
+        out = model.generate(
+            torch.tensor([prompt]),
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=0,
+        )
+    return out[0, len(prompt):].tolist()
+
+
+def test_batched_greedy_matches_sequential(tiny_model):
+    model = tiny_model()
+    prompts = [[5, 6, 7], [9, 10, 11, 12, 13, 14, 15], [20]]
+    limits = [6, 3, 9]
+    scheduler = BatchScheduler(model, eos_token_id=None, max_batch_size=4)
+    scheduler.start()
+    try:
+        seqs = [
+            scheduler.submit(p, SamplingParams(max_new_tokens=n, temperature=0.0))
+            for p, n in zip(prompts, limits)
+        ]
+        results = [s.future.result(timeout=30) for s in seqs]
+    finally:
+        scheduler.stop()
+    for prompt, limit, seq in zip(prompts, limits, results):
+        assert seq.output_ids == _reference(model, prompt, limit)
+        assert seq.finish_reason == "length"
+
+
+def test_eos_finishes_sequence_early(tiny_model):
+    model = tiny_model()
+    prompt = [3, 4, 5]
+    first = _reference(model, prompt, 1)[0]
+    scheduler = BatchScheduler(model, eos_token_id=first, max_batch_size=2)
+    scheduler.start()
+    try:
+        seq = scheduler.submit(prompt, SamplingParams(max_new_tokens=8, temperature=0.0))
+        seq.future.result(timeout=30)
+    finally:
+        scheduler.stop()
+    assert seq.output_ids == []
+    assert seq.finish_reason == "stop"
+
+
+def test_incremental_detokenizer_preserves_whitespace_and_utf8():
+    text = "def f():\n\tif x:\n        return \"é€\"  \n"
+    detok = IncrementalDetokenizer(ByteTokenizer())
+    deltas = [detok.push(b) for b in text.encode("utf-8")]
+    deltas.append(detok.flush())
+    assert "".join(deltas) == text
+    assert not any("\ufffd" in d for d in deltas)
+
+
+def test_stream_yields_tokens_as_sampled(tiny_model):
+    model = tiny_model()
+    scheduler = BatchScheduler(model, eos_token_id=None, max_batch_size=2)
+    scheduler.start()
+
+    async def consume():
+        seq = scheduler.submit([1, 2, 3], SamplingParams(max_new_tokens=5, temperature=0.0), stream=True)
+        streamed = [token async for token in seq.stream]
+        return seq, streamed
+
+    try:
+        seq, streamed = asyncio.run(consume())
+    finally:
+        scheduler.stop()
+    assert streamed == seq.output_ids == _reference(model, [1, 2, 3], 5)
+
+
+def test_submit_rejects_when_queue_full(tiny_model):
+    scheduler = BatchScheduler(tiny_model(), eos_token_id=None, max_queue_size=1)
+    params = SamplingParams(max_new_tokens=2, temperature=0.0)
+    scheduler.submit([1, 2], params)
+    assert scheduler.queue_full
+    with pytest.raises(QueueFullError):
+        scheduler.submit([3, 4], params)
+    assert scheduler.queue_depth == 1
+
+
+def test_prefix_cache_reuses_previous_turn(tiny_model):
+    model = tiny_model()
+    cache = PrefixCache(max_bytes=1 << 20, block_size=4)
+    scheduler = BatchScheduler(model, eos_token_id=None, prefix_cache=cache)
+    scheduler.start()
+    params = SamplingParams(max_new_tokens=4, temperature=0.0)
+    try:
+        first = scheduler.submit(list(range(1, 11)), params).future.result(timeout=30)
+        follow_up = first.prompt_ids + first.output_ids + [40, 41, 42]
+        second = scheduler.submit(follow_up, params).future.result(timeout=30)
+    finally:
+        scheduler.stop()
+    # Everything the first turn computed (prompt + fed outputs) is reused.
+    assert second.cached_tokens == len(first.prompt_ids) + len(first.output_ids) - 1
+    assert second.output_ids == _reference(model, follow_up, 4)
+    assert cache.hits == 1
+    # The second turn's entry supersedes the first one.
+    assert len(cache) == 1
+
+
+def test_prefix_cache_evicts_lru_over_budget():
+    layer = (torch.zeros(1, 1, 8, 4), torch.zeros(1, 1, 8, 4))
+    entry_bytes = 2 * 8 * 4 * 4
+    cache = PrefixCache(max_bytes=2 * entry_bytes, block_size=4)
+    cache.store(list(range(8)), (layer,))
+    cache.store(list(range(10, 18)), (layer,))
+    cache.lookup(list(range(8)) + [99])
+    cache.store(list(range(20, 28)), (layer,))
+    assert len(cache) == 2
+    assert cache.evicted_bytes == entry_bytes
+    past, matched = cache.lookup(list(range(10, 18)) + [99])
+    assert past is None and matched == 0
+    past, matched = cache.lookup(list(range(8)) + [99])
+    assert matched == 8 and past[0][0].shape[2] == 8
+
+
+@pytest.mark.parametrize("mode", ["prompt_lookup", "draft"])
+def test_speculative_decoding_matches_greedy(mode, tiny_model):
+    model = tiny_model()
+    torch.manual_seed(1)
+    draft = Starcoder2ForCausalLM(model.config).eval()
+    # Repetitive prompt so prompt lookup has n-grams to copy.
+    prompts = [[5, 6, 7, 8, 5, 6, 7, 8, 5, 6], [9, 10, 11]]
+    scheduler = BatchScheduler(model, eos_token_id=None, max_batch_size=4, draft_model=draft)
+    scheduler.start()
+    try:
+        seqs = [
+            scheduler.submit(p, SamplingParams(max_new_tokens=12, temperature=0.0, speculation=mode))
+            for p in prompts
+        ]
+        # A plain request shares the loop with the speculating ones.
+        plain = scheduler.submit([20, 21], SamplingParams(max_new_tokens=5, temperature=0.0))
+        results = [s.future.result(timeout=30) for s in seqs + [plain]]
+    finally:
+        scheduler.stop()
+    for prompt, seq in zip(prompts + [[20, 21]], results):
+        assert seq.output_ids == _reference(model, prompt, len(seq.output_ids))
+    assert [len(s.output_ids) for s in results] == [12, 12, 5]
+    stats = scheduler.spec_stats[mode]
+    assert stats.emitted == 2 * 11  # the first token of each comes from prefill
+    assert stats.steps <= stats.emitted
+    assert stats.accepted <= stats.proposed
+
+
+def test_draft_model_proposer_self_draft_is_fully_accepted(tiny_model):
+    model = tiny_model()
+    scheduler = BatchScheduler(model, eos_token_id=None, draft_model=model, speculative_tokens=3)
+    scheduler.start()
+    try:
+        seq = scheduler.submit([1, 2, 3], SamplingParams(max_new_tokens=9, temperature=0.0, speculation="draft"))
+        seq.future.result(timeout=30)
+    finally:
+        scheduler.stop()
+    stats = scheduler.spec_stats["draft"]
+    assert seq.output_ids == _reference(model, [1, 2, 3], 9)
+    assert stats.acceptance_rate == 1.0
+    assert stats.tokens_per_step == 4.0  # 8 tokens after prefill in 2 steps
+
+
+def test_unknown_speculation_mode_is_rejected(tiny_model):
+    scheduler = BatchScheduler(tiny_model(), eos_token_id=None)
+    with pytest.raises(ValueError):
+        scheduler.submit([1, 2], SamplingParams(speculation="draft"))
+
+
+def test_bucketed_batch_prefill_matches_sequential(tiny_model):
+    model = tiny_model()
+    prompts = [[3, 4, 5, 6, 7], [8, 9, 10, 11, 12, 13, 14], [15, 16, 17, 18, 19, 20], [21, 22], [23]]
+    scheduler = BatchScheduler(model, eos_token_id=None, max_batch_size=8)
+    # Queued before the loop starts, so all five are admitted together.
+    seqs = [scheduler.submit(p, SamplingParams(max_new_tokens=5, temperature=0.0)) for p in prompts]
+    scheduler.start()
+    try:
+        results = [s.future.result(timeout=30) for s in seqs]
+    finally:
+        scheduler.stop()
+    for prompt, seq in zip(prompts, results):
+        assert seq.output_ids == _reference(model, prompt, 5)
+
+
+def test_cancel_and_deadline_stop_generation_early(tiny_model):
+    model = tiny_model()
+    scheduler = BatchScheduler(model, eos_token_id=None, max_batch_size=4)
+    scheduler.start()
+    try:
+        # A deadline already in the past: the prefill is skipped entirely.
+        expired = scheduler.submit([5, 6, 7], SamplingParams(max_new_tokens=50, temperature=0.0, deadline=0.0))
+        assert expired.future.result(timeout=30).finish_reason == "timeout"
+        assert expired.output_ids == []
+
+        async def cancel_after_first_token():
+            seq = scheduler.submit([9, 10, 11], SamplingParams(max_new_tokens=100, temperature=0.0), stream=True)
+            async for _ in seq.stream:
+                seq.cancel("disconnected")
+            return seq
+
+        cancelled = asyncio.run(cancel_after_first_token())
+        kept = scheduler.submit([9, 10, 11], SamplingParams(max_new_tokens=5, temperature=0.0)).future.result(timeout=30)
+    finally:
+        scheduler.stop()
+    assert cancelled.finish_reason == "disconnected"
+    assert 1 <= len(cancelled.output_ids) < 100
+    assert cancelled.output_ids == _reference(model, [9, 10, 11], len(cancelled.output_ids))
+    assert kept.output_ids == _reference(model, [9, 10, 11], 5)
+    assert scheduler.cancelled == {"timeout": 1, "disconnected": 1}
+    assert scheduler.cancelled_tokens_saved == {"timeout": 50, "disconnected": 100 - len(cancelled.output_ids)}
+
+
+def test_sequence_records_latency_breakdown(tiny_model):
+    model = tiny_model()
+    scheduler = BatchScheduler(model, eos_token_id=None, max_batch_size=2)
+    scheduler.start()
+    try:
+        seq = scheduler.submit([5, 6, 7], SamplingParams(max_new_tokens=6, temperature=0.0)).future.result(timeout=30)
+    finally:
+        scheduler.stop()
+    assert len(seq.token_times) == len(seq.output_ids) == 6
+    assert len(seq.inter_token_latencies) == 5
+    assert all(gap >= 0 for gap in seq.inter_token_latencies)
+    assert seq.prefill_seconds > 0
+    assert seq.queued_at <= seq.admitted_at <= seq.token_times[0] <= seq.finished_at
+    assert seq.time_to_first_token >= seq.prefill_seconds
+    assert seq.decode_seconds == pytest.approx(seq.finished_at - seq.token_times[0])
+    ttft = seq.time_to_first_token
+    seq.tokenize_seconds, seq.admission_seconds = 0.25, 1.5  # filled in by the server before submitting
+    assert seq.time_to_first_token == pytest.approx(ttft + 1.75)
@@ -0,0 +1,79 @@
+import pytest
+import torch
+
+from backend.engine import BatchScheduler, SamplingParams
+from backend.kv_cache import CACHE_MODES, new_batch_cache
+from backend.prefix_cache import PrefixCache
+
+PROMPTS = [[5, 6, 7], [9, 10, 11, 12, 13, 14, 15], [20], [3, 1, 4, 1, 5, 9, 2, 6, 5, 3, 5]]
+LIMITS = [6, 3, 9, 12]
+
+
+def _generate(model, mode, **kwargs):
+    scheduler = BatchScheduler(model, eos_token_id=None, max_batch_size=4, kv_cache_mode=mode, **kwargs)
+    scheduler.start()
+    try:
+        seqs = [
+            scheduler.submit(p, SamplingParams(max_new_tokens=n, temperature=0.0)) for p, n in zip(PROMPTS, LIMITS)
+        ]
+        return [s.future.result(timeout=30).output_ids for s in seqs]
+    finally:
+        scheduler.stop()
+
+
+@pytest.mark.parametrize("mode", ["static", "offload"])
+def test_full_precision_modes_match_dynamic(mode, tiny_model):
+    model = tiny_model()
+    # A tiny block makes the static buffers grow mid-generation.
+    assert _generate(model, mode, kv_cache_block=2) == _generate(model, "dynamic")
+
+
+@pytest.mark.parametrize("mode", ["int8", "int4"])
+def test_quantized_modes_decode_the_batch(mode, tiny_model):
+    model = tiny_model()
+    outputs = _generate(model, mode, prefix_cache=PrefixCache(1 << 20))
+    assert [len(o) for o in outputs] == LIMITS
+
+
+def _past(layers=2, rows=3, heads=2, length=10, dim=64, dtype=torch.float32):
+    torch.manual_seed(1)
+    return tuple((torch.randn(rows, heads, length, dim, dtype=dtype),) * 2 for _ in range(layers))
+
+
+@pytest.mark.parametrize("mode,tolerance", [("int8", 0.01), ("int4", 0.1)])
+def test_quantization_round_trip(mode, tolerance):
+    past = _past()
+    cache = new_batch_cache(mode)
+    cache.merge(past, 0, 0)
+    for (k, _), (restored, _) in zip(past, cache.row(1, 10)):
+        error = (restored - k[1:2]).abs().max() / k[1:2].abs().max()
+        assert error < tolerance
+
+
+def test_bytes_per_sequence_by_mode():
+    sizes = {}
+    for mode in CACHE_MODES:
+        cache = new_batch_cache(mode, block=16)
+        cache.merge(_past(), 0, 0)
+        sizes[mode] = cache.nbytes / cache.rows
+    assert sizes["dynamic"] == sizes["offload"] == 2 * 2 * 10 * 64 * 4 * 2
+    assert sizes["static"] == sizes["dynamic"] * 16 / 10  # one block of capacity
+    assert sizes["dynamic"] / sizes["int8"] > 3.5
+    assert sizes["dynamic"] / sizes["int4"] > 5
+
+
+def test_merge_and_retain_keep_rows_aligned():
+    past = _past(rows=2, length=4)
+    extra = _past(rows=1, length=6)
+    cache = new_batch_cache("int8")
+    cache.merge(past, 0, 0)
+    cache.merge(extra, 2, 0)
+    assert cache.rows == 3 and cache.get_seq_length() == 6
+    cache.retain(torch.tensor([2]), 0)
+    restored = cache.row(0, 6)[0][0]
+    assert torch.allclose(restored, extra[0][0], atol=0.05)
+
+
+def test_unknown_mode_is_rejected(tiny_model):
+    with pytest.raises(ValueError):
+        BatchScheduler(tiny_model(), eos_token_id=None, kv_cache_mode="fp4")
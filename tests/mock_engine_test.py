@@ -0,0 +1,39 @@
+import time
+
+import torch
+
+from backend.engine import BatchScheduler, SamplingParams
+from backend.mock_engine import SNIPPET, MockCausalLM, MockTokenizer
+from backend.prefix_cache import PrefixCache
+
+
+def test_mock_model_runs_the_real_scheduler():
+    tok = MockTokenizer()
+    model = MockCausalLM(prefill_seconds_per_token=0.0, decode_seconds_per_token=0.001)
+    scheduler = BatchScheduler(model, tok.eos_token_id, max_batch_size=4, prefix_cache=PrefixCache(1 << 20))
+    scheduler.start()
+    try:
+        prompts = [tok("a")["input_ids"], tok("hello there")["input_ids"]]
+        seqs = [scheduler.submit(p, SamplingParams(max_new_tokens=12, temperature=0.7)) for p in prompts]
+        results = [s.future.result(timeout=30) for s in seqs]
+        spec = scheduler.submit(prompts[0], SamplingParams(max_new_tokens=40, temperature=0.0, speculation="prompt_lookup"))
+        spec = spec.future.result(timeout=30)
+    finally:
+        scheduler.stop()
+    for prompt, seq in zip(prompts, results):
+        # Output continues the snippet from the prompt's length, whatever the prompt says.
+        expected = (SNIPPET * 4)[len(prompt):len(prompt) + 12]
+        assert tok.decode(seq.output_ids).encode() == expected
+        assert seq.finish_reason == "length"
+    assert bytes(spec.output_ids) == (SNIPPET * 4)[1:41]
+
+
+def test_mock_model_sleeps_for_the_configured_cost():
+    model = MockCausalLM(prefill_seconds_per_token=0.001, decode_seconds_per_token=0.02, decode_batch_cost=0.5)
+    assert model.cost(rows=1, new_tokens=1, real_tokens=1) == 0.02
+    assert model.cost(rows=3, new_tokens=1, real_tokens=3) == 0.02 * 2
+    assert model.cost(rows=2, new_tokens=50, real_tokens=80) == 0.001 * 80
+    tok = MockTokenizer()
+    started = time.perf_counter()
+    model(input_ids=torch.tensor([tok("x" * 50)["input_ids"]]))
+    assert time.perf_counter() - started >= 0.05
@@ -0,0 +1,19 @@
+from limits import RateLimitItemPerMinute
+from limits.storage import storage_from_string
+from limits.strategies import FixedWindowRateLimiter
+
+from backend import rate_limit_store  # noqa: F401
+
+
+def test_workers_share_fixed_window_counters(tmp_path):
+    uri = f"sqlite:///{tmp_path / 'limits.db'}"
+    worker_a = FixedWindowRateLimiter(storage_from_string(uri))
+    worker_b = FixedWindowRateLimiter(storage_from_string(uri))
+    limit = RateLimitItemPerMinute(3)
+    assert worker_a.hit(limit, "client")
+    assert worker_b.hit(limit, "client")
+    assert worker_a.hit(limit, "client")
+    assert not worker_b.hit(limit, "client")
+    assert worker_b.hit(limit, "other-client")
+    worker_a.clear(limit, "client")
+    assert worker_b.hit(limit, "client")
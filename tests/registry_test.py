@@ -0,0 +1,78 @@
+import pytest
+
+from backend.registry import ModelRegistry, UnknownModelError
+
+
+class FakeModel:
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+
+    def get_memory_footprint(self):
+        return self.nbytes
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.batch_size = 0
+        self.queue_depth = 0
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+def _registry(sizes, **kwargs):
+    loaded = []
+
+    def loader(model_id):
+        loaded.append(model_id)
+        return object(), FakeModel(sizes[model_id]), FakeScheduler()
+
+    return ModelRegistry(list(sizes), loader, **kwargs), loaded
+
+
+def test_unknown_model_is_rejected():
+    registry, _ = _registry({"a": 1})
+    with pytest.raises(UnknownModelError):
+        registry.ensure_loaded("b")
+
+
+def test_evicts_least_recently_used_over_budget():
+    registry, loaded = _registry({"a": 40, "b": 40, "c": 40}, memory_budget=100)
+    a = registry.load("a")
+    b = registry.load("b")
+    registry.load("a")  # touch "a" so "b" is the LRU
+    b_scheduler = b.scheduler
+    registry.load("c")
+    assert a.resident and not b.resident
+    assert b_scheduler.stopped
+    assert registry.resident_bytes == 80
+    assert (registry.loads, registry.evictions) == (3, 1)
+    assert loaded == ["a", "b", "c"]
+
+
+def test_pinned_and_busy_models_are_not_evicted():
+    registry, _ = _registry({"a": 1, "b": 1, "c": 1}, max_resident=2, pinned=("a",))
+    registry.load("a")
+    b = registry.load("b")
+    b.scheduler.batch_size = 1  # mid-generation
+    registry.load("c")
+    assert [h.model_id for h in registry.handles() if h.resident] == ["a", "b", "c"]
+    b.scheduler.batch_size = 0
+    registry.unload("c")
+    registry.load("c")
+    assert registry.state("a") == "ready"
+    assert registry.state("b") == "unloaded"
+
+
+def test_leased_models_are_not_evicted():
+    registry, _ = _registry({"a": 1, "b": 1}, max_resident=1)
+    a = registry.load("a")
+    assert registry.lease(a)  # e.g. tokenizing, or dequeued by the scheduler but not yet prefilled
+    b = registry.load("b")
+    assert a.resident and b.resident
+    registry.release(a)
+    registry.unload("b")
+    registry.load("b")
+    assert not a.resident
+    assert not registry.lease(a)
@@ -0,0 +1,106 @@
+import asyncio
+
+from backend.response_cache import InflightDeduplicator, ResponseCache, request_key
+
+
+def test_request_key_is_order_independent():
+    assert request_key({"a": 1, "b": [1, 2]}) == request_key({"b": [1, 2], "a": 1})
+    assert request_key({"a": 1}) != request_key({"a": 2})
+
+
+def test_lru_and_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("backend.response_cache.time.time", lambda: now[0])
+    cache = ResponseCache(max_entries=2, ttl=10)
+    cache.put("a", {"text": "A"})
+    cache.put("b", {"text": "B"})
+    assert cache.get("a") == {"text": "A"}
+    cache.put("c", {"text": "C"})  # evicts "b", the least recently used
+    assert cache.get("b") is None
+    now[0] += 11
+    assert cache.get("a") is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    ResponseCache(max_entries=4, ttl=60, directory=str(tmp_path)).put("k", {"text": "hi"})
+    restarted = ResponseCache(max_entries=4, ttl=60, directory=str(tmp_path))
+    assert restarted.get("k") == {"text": "hi"}
+
+
+def test_disk_tier_evicts_oldest_files_over_its_size_cap(tmp_path):
+    value = {"text": "x" * 100}
+    ResponseCache(max_entries=1, ttl=60, directory=str(tmp_path / "probe")).put("a", value)
+    size = (tmp_path / "probe" / "a.json").stat().st_size + 2  # expires_at varies slightly in length
+    cache = ResponseCache(max_entries=100, ttl=60, directory=str(tmp_path / "c"), max_disk_bytes=4 * size)
+    for key in "abcdef":
+        cache.put(key, value)
+    tmp_path = tmp_path / "c"
+    assert sorted(p.stem for p in tmp_path.glob("*.json")) == ["c", "d", "e", "f"]
+    assert cache.disk_bytes == sum(p.stat().st_size for p in tmp_path.glob("*.json"))
+    restarted = ResponseCache(max_entries=100, ttl=60, directory=str(tmp_path), max_disk_bytes=2 * size)
+    assert sorted(p.stem for p in tmp_path.glob("*.json")) == ["e", "f"]
+    assert restarted.get("f") == value
+
+
+def test_identical_requests_share_one_generation():
+    starts = []
+
+    async def produce():
+        for part in ("a", "b"):
+            await asyncio.sleep(0.01)
+            yield part
+        yield {"text": "ab"}
+
+    async def start():
+        starts.append(1)
+        return produce()
+
+    async def collect(source):
+        return [item async for item in source]
+
+    async def main():
+        dedup = InflightDeduplicator()
+        first = await dedup.attach("k", start)
+        second = await dedup.attach("k", start)
+        results = await asyncio.gather(collect(first), collect(second))
+        return dedup, results
+
+    dedup, results = asyncio.run(main())
+    assert len(starts) == 1
+    assert dedup.attached == 1
+    assert results[0] == results[1] == ["a", "b", {"text": "ab"}]
+    assert len(dedup) == 0
+
+
+def test_generation_is_cancelled_when_every_follower_leaves():
+    cancelled = []
+
+    async def produce():
+        try:
+            yield "a"
+            await asyncio.sleep(10)
+            yield {"text": "a"}
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def start():
+        return produce()
+
+    async def main():
+        dedup = InflightDeduplicator()
+        first = await dedup.attach("k", start)
+        second = await dedup.attach("k", start)
+        assert await first.__anext__() == "a"
+        assert await second.__anext__() == "a"
+        await first.aclose()
+        await asyncio.sleep(0)
+        assert not cancelled  # one follower is still listening
+        await second.aclose()
+        await asyncio.sleep(0.01)
+        return dedup
+
+    dedup = asyncio.run(main())
+    assert cancelled == [1]
+    assert len(dedup) == 0
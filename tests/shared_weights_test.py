@@ -0,0 +1,26 @@
+import torch
+from transformers import Starcoder2ForCausalLM
+
+from backend.shared_weights import load_shared
+
+
+def test_workers_map_the_same_exported_weights(tmp_path, tiny_model):
+    reference = tiny_model()
+    model_dir = tmp_path / "model"
+    reference.save_pretrained(model_dir)
+    loads = []
+
+    def load():
+        loads.append(1)
+        return Starcoder2ForCausalLM.from_pretrained(model_dir)
+
+    cache = str(tmp_path / "cache")
+    first = load_shared(str(model_dir), torch.float32, cache, load)
+    second = load_shared(str(model_dir), torch.float32, cache, load)
+    assert len(loads) == 1  # only the first process exports
+    assert second.lm_head.weight is second.model.embed_tokens.weight
+    x = torch.tensor([[1, 2, 3, 4]])
+    with torch.no_grad():
+        expected = reference(x).logits
+        assert torch.equal(first(x).logits, expected)
+        assert torch.equal(second(x).logits, expected)
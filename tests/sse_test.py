@@ -0,0 +1,84 @@
+import asyncio
+import json
+import zlib
+
+from backend.sse import DONE, ChatStreamEncoder, TextStreamEncoder, coalesce, gzip_frames
+
+TRICKY = 'print("a\\\\b")\n\tx = \'é\' + " " + chr(0)'
+
+
+def _payload(frame: bytes):
+    assert frame.startswith(b"data: ") and frame.endswith(b"\n\n")
+    return json.loads(frame[len(b"data: "):-2])
+
+
+def test_text_events_escape_generated_code():
+    assert _payload(TextStreamEncoder().text(TRICKY)) == {"text": TRICKY}
+
+
+def test_chat_events_match_full_chunk_serialization():
+    encoder = ChatStreamEncoder("chatcmpl-1", 123, 'org/"model"')
+    envelope = {"id": "chatcmpl-1", "object": "chat.completion.chunk", "created": 123, "model": 'org/"model"'}
+    assert _payload(encoder.role()) == {
+        **envelope, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]
+    }
+    assert _payload(encoder.content(TRICKY)) == {
+        **envelope, "choices": [{"index": 0, "delta": {"content": TRICKY}, "finish_reason": None}]
+    }
+    assert _payload(encoder.finish("length", timings={"total_ms": 1.0})) == {
+        **envelope, "choices": [{"index": 0, "delta": {}, "finish_reason": "length"}], "timings": {"total_ms": 1.0}
+    }
+
+
+def _collect(source):
+    async def run():
+        return [item async for item in source]
+    return asyncio.run(run())
+
+
+async def _tokens(delays, tail=None):
+    for i, delay in enumerate(delays):
+        await asyncio.sleep(delay)
+        yield f"t{i}"
+    if tail is not None:
+        yield tail
+
+
+def test_coalesce_passes_through_when_disabled():
+    assert _collect(coalesce(_tokens([0, 0], {"done": 1}), 0, 0)) == ["t0", "t1", {"done": 1}]
+
+
+def test_coalesce_by_size_and_on_final_item():
+    items = _collect(coalesce(_tokens([0] * 5, {"done": 1}), 0, 4))
+    assert items == ["t0t1", "t2t3", "t4", {"done": 1}]
+
+
+def test_coalesce_flushes_after_max_delay_without_waiting_for_the_next_token():
+    async def run():
+        out = []
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        async for item in coalesce(_tokens([0, 0, 0.3]), 0.05, 0):
+            out.append((item, loop.time() - started))
+        return out
+
+    out = asyncio.run(run())
+    assert [item for item, _ in out] == ["t0t1", "t2"]
+    assert out[0][1] < 0.2  # flushed by the timer, not by the slow third token
+
+
+def test_gzip_frames_flush_each_event():
+    async def frames():
+        yield TextStreamEncoder().text("hello")
+        yield DONE
+
+    async def run():
+        decompressor = zlib.decompressobj(31)
+        seen = []
+        async for chunk in gzip_frames(frames()):
+            seen.append(decompressor.decompress(chunk))
+        return seen
+
+    seen = asyncio.run(run())
+    assert seen[0] == b'data: {"text":"hello"}\n\n'
+    assert seen[1] == DONE
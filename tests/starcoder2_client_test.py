@@ -0,0 +1,122 @@
+import asyncio
+import email.utils
+import json
+import time
+
+import httpx
+
+from backend import starcoder2_client
+from backend.starcoder2_client import AsyncChatClient, ChatClient, _iter_sse
+
+
+def test_sync_generate_posts_to_v1_route(monkeypatch):
+    seen = []
+
+    class Response:
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {"generated_text": "x"}
+
+    client = ChatClient(base_url="http://test", token="t")
+    monkeypatch.setattr(client.session, "post", lambda url, **kw: seen.append(url) or Response())
+    assert client.generate("def f():") == {"generated_text": "x"}
+    assert seen == ["http://test/v1/generate"]
+
+
+def test_retries_honour_retry_after(monkeypatch):
+    delays = []
+    calls = []
+
+    async def fake_sleep(seconds):
+        delays.append(seconds)
+
+    def handler(request):
+        calls.append(request.url.path)
+        if len(calls) == 1:
+            return httpx.Response(429, headers={"Retry-After": "3"})
+        if len(calls) == 2:
+            return httpx.Response(503)
+        return httpx.Response(200, json={"generated_text": "ok"})
+
+    monkeypatch.setattr(starcoder2_client.asyncio, "sleep", fake_sleep)
+
+    async def main():
+        async with AsyncChatClient("http://test", "t", transport=httpx.MockTransport(handler), backoff=0.5) as client:
+            return await client.generate("x")
+
+    assert asyncio.run(main()) == {"generated_text": "ok"}
+    assert calls == ["/v1/generate"] * 3
+    assert delays[0] == 3.0
+    assert 0.25 <= delays[1] <= 1.0  # exponential backoff with jitter, no header
+
+
+def test_sync_post_with_retry_reads_http_date_retry_after(monkeypatch):
+    when = email.utils.formatdate(time.time() + 10, usegmt=True)
+    responses = [httpx.Response(503, headers={"Retry-After": when}), httpx.Response(200, json={"ok": True})]
+    delays = []
+
+    class Session:
+        def post(self, url, json, timeout):
+            response = responses.pop(0)
+            response.request = httpx.Request("POST", url)  # for raise_for_status
+            return response
+
+    monkeypatch.setattr(starcoder2_client.time, "sleep", delays.append)
+    assert starcoder2_client.post_with_retry(Session(), "http://test/v1/generate", {}) == {"ok": True}
+    assert 8 <= delays[0] <= 10
+
+
+def test_map_caps_concurrency_and_keeps_order():
+    active = [0]
+    peak = [0]
+
+    async def handler(request):
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+        await asyncio.sleep(0.01)
+        active[0] -= 1
+        prompt = json.loads(request.content)["prompt"]
+        return httpx.Response(200, json={"generated_text": prompt.upper()})
+
+    async def main():
+        async with AsyncChatClient("http://test", "t", transport=httpx.MockTransport(handler)) as client:
+            return await client.gather_generate([f"p{i}" for i in range(20)], concurrency=3)
+
+    results = asyncio.run(main())
+    assert [r["generated_text"] for r in results] == [f"P{i}" for i in range(20)]
+    assert peak[0] == 3
+
+
+def test_sse_events_are_parsed_as_lines_arrive():
+    async def lines():
+        for line in ["data: {\"text\": \"a\"}", "", ": keep-alive", "data:{\"text\":", "data: \"b\"}", "", "data: [DONE]", ""]:
+            yield line
+
+    async def collect():
+        return [event async for event in _iter_sse(lines())]
+
+    assert asyncio.run(collect()) == ['{"text": "a"}', '{"text":\n"b"}', "[DONE]"]
+
+
+def test_stream_generate_yields_events_before_the_response_ends():
+    received = []
+
+    async def body():
+        yield b'data: {"text": "he'
+        yield b'llo"}\n\n'
+        # The first event must be delivered before the stream finishes.
+        assert received == [{"text": "hello"}]
+        yield b"data: [DONE]\n\n"
+
+    def handler(request):
+        return httpx.Response(200, content=body(), headers={"content-type": "text/event-stream"})
+
+    async def main():
+        async with AsyncChatClient("http://test", "t", transport=httpx.MockTransport(handler)) as client:
+            async for event in client.stream_generate("x"):
+                received.append(event)
+
+    asyncio.run(main())
+    assert received == [{"text": "hello"}]
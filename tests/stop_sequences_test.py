@@ -0,0 +1,68 @@
+import pytest
+
+from backend.engine import BatchScheduler, SamplingParams
+from backend.mock_engine import MockCausalLM, MockTokenizer
+from backend.stop_sequences import CHAT_ROLE_STOPS, CODE_BLOCK_STOP, StopMatcher, default_stops, merge_stops, truncate
+
+
+def _stream(matcher, pieces):
+    return [matcher.push(piece) for piece in pieces]
+
+
+def test_matcher_holds_back_possible_stop_prefixes():
+    matcher = StopMatcher(["\nuser:"])
+    assert _stream(matcher, ["return x", "\n", "us", "ed = 1"]) == ["return x", "", "", "\nused = 1"]
+    assert matcher.matched is None
+    assert _stream(matcher, ["\nus", "er: next turn"]) == ["", ""]
+    assert matcher.matched == "\nuser:"
+    assert matcher.push("more") == "" and matcher.flush() == ""
+
+
+def test_matcher_cuts_inside_a_single_delta():
+    matcher = StopMatcher(["###", "END"])
+    assert matcher.push("a = 1END b = 2###") == "a = 1"
+    assert matcher.matched == "END"
+
+
+def test_matcher_flushes_held_text_without_a_match():
+    matcher = StopMatcher(["\n```"])
+    assert matcher.push("x = 1\n``") == "x = 1"
+    assert matcher.flush() == "\n``"
+
+
+def test_truncate_matches_streaming():
+    text = "def f():\n    pass\nuser: thanks"
+    assert truncate(text, CHAT_ROLE_STOPS) == "def f():\n    pass"
+    assert truncate(text, ()) == text
+
+
+def test_default_stops():
+    assert default_stops("chat", "user: hi\nassistant: ") == CHAT_ROLE_STOPS
+    assert default_stops("generate", "```python\ndef add(") == (CODE_BLOCK_STOP,)
+    assert default_stops("generate", "```python\nx = 1\n```\ndef add(") == ()
+    assert merge_stops(["", "\n```", "END"], [CODE_BLOCK_STOP]) == ("\n```", "END")
+
+
+@pytest.mark.parametrize("speculation", ["off", "prompt_lookup"])
+def test_scheduler_stops_on_the_step_that_completes_a_stop_string(speculation):
+    tok = MockTokenizer()
+    model = MockCausalLM(prefill_seconds_per_token=0.0, decode_seconds_per_token=0.0)
+    scheduler = BatchScheduler(model, tok.eos_token_id, tokenizer=tok)
+    scheduler.start()
+    try:
+        params = SamplingParams(max_new_tokens=40, temperature=0.0, speculation=speculation, stop=("\n    a,",))
+        seq = scheduler.submit(tok("d")["input_ids"], params).future.result(timeout=30)
+    finally:
+        scheduler.stop()
+    # The mock continues "def fibonacci(n: int) -> int:\n    a, b = 0, 1 ..."
+    assert tok.decode(seq.output_ids) == "ef fibonacci(n: int) -> int:\n    a,"
+    assert seq.finish_reason == "stop"
+    assert truncate(tok.decode(seq.output_ids), params.stop) == "ef fibonacci(n: int) -> int:"
+    assert scheduler.early_stops == {"stop_sequence": 1}
+    assert scheduler.early_stop_steps_saved == {"stop_sequence": 40 - len(seq.output_ids)}
+
+
+def test_stop_strings_need_a_tokenizer():
+    scheduler = BatchScheduler(MockCausalLM(), eos_token_id=None)
+    with pytest.raises(ValueError):
+        scheduler.submit([1, 2], SamplingParams(stop=("x",)))